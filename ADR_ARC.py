@@ -33,13 +33,16 @@ class ADR_ARC():
 
     # Save data to an archive file
     # Automatically create new files after a certain limit is reached?
-    def save_arc(self,data,filename=None):
+    # key="data" is the averaged monitor channels. Other keys hold extra
+    # streams in the same file (e.g. "faa_stream" for dense FAA captures).
+    # Extra keyword arguments go to to_hdf (e.g. min_itemsize for text columns).
+    def save_arc(self,data,filename=None,key="data",**kwargs):
         self.check_new_arc()
         
         if filename==None:
             filename = self.arcname
         
-        data.to_hdf(os.path.join(cg.datadir,filename+".hdf5"),key="data",mode="a",format="table",append=True)
+        data.to_hdf(os.path.join(cg.datadir,filename+".hdf5"),key=key,mode="a",format="table",append=True,**kwargs)
         
         return 
     
@@ -56,7 +59,7 @@ class ADR_ARC():
         
         if filename:        
             filename.replace(".hdf5","")        
-            data = pd.read_hdf(os.path.join(cg.datadir,filename+".hdf5"))
+            data = pd.read_hdf(os.path.join(cg.datadir,filename+".hdf5"),key="data")
             return data
         
         timelist = []
@@ -100,7 +103,7 @@ class ADR_ARC():
         
         frames = []
         for af in arcfiles:
-            frames.append(pd.read_hdf(os.path.join(cg.datadir, af), columns=columns))
+            frames.append(pd.read_hdf(os.path.join(cg.datadir, af), key="data", columns=columns))
         
         data = pd.concat(frames, ignore_index=True)
         
@@ -19,6 +19,24 @@ class ADR_Config():
         # DAQ Specifics
         self.daq_sample_rate = 60 # in seconds
         self.daq_verbose_output = False # Will output data to terminal if True
+        self.daq_batch_sim_reads = True # Query all SIM modules in one scatter-gather batch
+        self.daq_block_samples = 4 # Readings per SIM922/SIM970 query (VOLT?/TVAL? c,n)
+        self.faa_stream_chunk = 1 # in seconds. Longest FAA stream capture before the other channels get a turn. Control traffic cuts it short
+        self.daq_async_pt415 = True # Read the compressor on its own I/O thread while the SIM900 is read
+        self.daq_pt415_timeout = 10 # in seconds. Deadline for one compressor status read
+        self.daq_read_dio = True # Log the heat switch and resistor box digital inputs (ADR_DIO)
+        
+        # Magnet ramp specifics
+        self.ramp_update_time = 0.5 # in seconds. Ramp engine feedback loop period
+        self.ramp_log_interval = 10 # in seconds. How often the ramp trajectory is written to the archive
+        self.lead_resistance = 1.2 # in Ohms. Starting guess, the ramp engine estimates it as it goes
+        self.lead_resistance_range = (1.0, 2.0) # in Ohms. The estimate stays in here. The low end sets the ramp output slew limit, keep it below the real value
+        self.ramp_max_accel = 5e-5 # in A/s^2. Limit on d2I/dt2, S-curve ramp ends. None for linear ramps
+        self.mag_current_scale = 1.0 # Amps per volt on Sim970 MagCurr. !!! Check against the Kepco readout
+        self.mag_emf_scale = 1.0 # Volts of magnet back-EMF per volt on Sim970 EMF
+        self.mag_checkpoint_file = os.path.join(self.datadir,'mag_cycle_checkpoint.json') # Mag cycle progress, to pick it up again after a restart
+        self.mag_checkpoint_interval = 60 # in seconds. How often a soak in progress is checkpointed
+        self.heat_switch_timeout = 10 # in seconds. Longest a heat switch move may take (~5 s normally)
         
         # GUI specifics
         self.plot_refresh_rate = 1000 # in milliseconds
@@ -26,10 +44,11 @@ class ADR_Config():
         
         # Channel Specifics
         self.channel_wildcard = "#_"
+        self.pt415_record = pt415_interface.newStatusRecord() # Reused for every compressor read
         
         # Any further initialization we need
         if init_channel_functions:
-            from SRS_SIM9XX_v3 import SIM900, SIM960, SIM921, SIM922, SIM925, SIM970
+            from SRS_SIM9XX_v3 import SIM900, SIM960, SIM921, SIM922, SIM925, SIM970, SIM921_stream
             
             self.sim900 = SIM900
             self.sim960 = SIM960()
@@ -37,8 +56,13 @@ class ADR_Config():
             self.sim925 = SIM925()
             self.sim921 = SIM921()
             self.sim922 = SIM922()
+            self.sim921_stream = SIM921_stream()
             self.time = time
             self.pt415_interface = pt415_interface
+            self.pt415 = pt415_interface.AsyncPT415Client(timeout=self.daq_pt415_timeout)
+            if self.daq_read_dio:
+                import ADR_DIO
+                self.dio = ADR_DIO.DIOSnapshot()
             
             # Init sim921/925
             self.sim921.set_RANG(6) # 6: 20 kO; 7: 200 kO
@@ -59,11 +83,25 @@ class ADR_Config():
         #"scaling factors"]
         self.monitor_channels = {
             "Time": ["time","time", None,None,None],
-            "Stage Temp #_": ["sim922","get_TVAL",(0),["60K","Magnet","4K","4K No.2"],[0,1,2,3]],
+            "Stage Temp #_": ["sim922","get_TVAL",(0,self.daq_block_samples),["60K","Magnet","4K","4K No.2"],[0,1,2,3]],
             "FAA Temp": ["sim921","get_TVAL",None,None,None],
-            "Sim970 #_": ["sim970","get_VOLT",(0),["EMF","MagCurr","MagVolt","Pressure (Torr)"],[0,1,2,3]],
-            "Cmpsr #_" : ["pt415_interface","status_read_simple",None, pt415_interface.pt415_names, range(0,len(pt415_interface.pt415_names))],
+            "Sim970 #_": ["sim970","get_VOLT",(0,self.daq_block_samples),["EMF","MagCurr","MagVolt","Pressure (Torr)"],[0,1,2,3]],
+            "Cmpsr #_" : ["pt415" if self.daq_async_pt415 else "pt415_interface","status_read_record",self.pt415_record, pt415_interface.pt415_names, range(0,len(pt415_interface.pt415_names))],
         }
+        if self.daq_read_dio:
+            # One word per port, line 0 in bit 0. ADR_DIO.decode_frame reads them back
+            self.monitor_channels["DIO #_"] = ["dio","read_async",None,["ADR_DIO port0","ADR_RESISTOR_BOX port2"],[0,1]]
+        
+        # How a channel is reduced over a sample period, if not the mean.
+        # "last": the last reading, for packed bits, flags and codes that
+        # don't average. A wildcard channel covers all its subchannels.
+        self.channel_reductions = {
+            "DIO #_": "last",
+            }
+        # The compressor's error flags and error code
+        for name in pt415_interface.pt415_names:
+            if pt415_interface.status_dtype[name].kind in 'bi':
+                self.channel_reductions["Cmpsr #_".replace(self.channel_wildcard, name)] = "last"
         
         self.channel_plot_options = {
             "Sim970 Pressure (Torr)": {"convert_func":"SIM970_pressure_curve"},
@@ -92,6 +130,7 @@ class ADR_Config():
     def close(self,init_channel_functions=False):
         if init_channel_functions:
             self.sim900.close()
+            self.pt415.close()
 
 
 
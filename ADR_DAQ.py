@@ -8,6 +8,8 @@ Created on Fri Apr 25 09:56:33 2025
 from ADR_ARC import ADR_ARC
 from ADR_Config import ADR_Config
 import copy
+import numpy as np
+import numpy.lib.recfunctions as rfn
 import pandas as pd
 import time
 #import threading as th
@@ -16,6 +18,54 @@ arc = ADR_ARC()
 cg = ADR_Config(init_channel_functions=True)
 mc = cg.monitor_channels
 
+# Running sums for averaging the channels over one sample period.
+# Channels can be given single readings or whole blocks of readings
+# (e.g. the (n, channels) arrays from SIM922/SIM970 reads with n > 1).
+# Channels in last keep their last reading instead (e.g. packed bits).
+class DAQ_Accumulator():
+    def __init__(self, channel_list, last=()):
+        self.channel_list = channel_list
+        self.index = dict([(chan,idx) for idx,chan in enumerate(channel_list)])
+        self.last = np.isin(channel_list, list(last))
+        self.row_index = dict() # tuple of channels: their indices
+        self.reset()
+
+    def reset(self):
+        self.sums = np.zeros(len(self.channel_list))
+        self.counts = np.zeros(len(self.channel_list), dtype=int)
+
+    def add(self, chan, val):
+        # NaNs are skipped like in DataFrame.mean
+        val = np.asarray(val, dtype=float)
+        good = ~np.isnan(val)
+        idx = self.index[chan]
+        if self.last[idx]:
+            if good.any():
+                self.sums[idx] = val[good][-1]
+                self.counts[idx] = 1
+            return
+        self.sums[idx] += val[good].sum()
+        self.counts[idx] += good.sum()
+
+    # A row of channels at once, e.g. from a structured record
+    def add_row(self, chans, vals):
+        key = tuple(chans)
+        if key not in self.row_index:
+            self.row_index[key] = np.array([self.index[chan] for chan in chans])
+        idx = self.row_index[key]
+        vals = np.asarray(vals, dtype=float)
+        good = ~np.isnan(vals)
+        idx, vals = idx[good], vals[good]
+        last = self.last[idx]
+        self.sums[idx] = np.where(last, vals, self.sums[idx] + vals)
+        self.counts[idx] = np.where(last, 1, self.counts[idx] + 1)
+
+    def mean_frame(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = self.sums/self.counts
+        return pd.DataFrame([mean], columns=self.channel_list)
+
+
 class ADR_DAQ():
     def __init__(self):
         arc.init_new_arc()
@@ -28,34 +78,128 @@ class ADR_DAQ():
         self._pause_event.set() # Initially not paused
         self.task = None
         self.data = None
+        self.read_plan = self.make_read_plan()
+        # Channel names and output array indices of the subchannels
+        self.subchannels = dict([(chan,([chan.replace(cg.channel_wildcard,subch) for subch in mc[chan][3]],
+                                        np.array(mc[chan][4])))
+                                 for chan in mc if mc[chan][3]!=None])
+        # Channels that keep their last reading over a sample period
+        self.last_channels = []
+        for chan in cg.channel_reductions:
+            if cg.channel_reductions[chan]=="last":
+                self.last_channels += self.subchannels[chan][0] if chan in self.subchannels else [chan]
+        self.faa_stream_until = 0 # Stream the FAA thermometer until this time
+        self.faa_stream_chunk = copy.deepcopy(cg.faa_stream_chunk)
         return
     
+    # Sort the channels into the ones the SIM900 can query together in one
+    # scatter-gather batch (a get_ getter whose module has the req_ version),
+    # the ones with a coroutine getter (e.g. the PT415 on its own thread)
+    # and the ones we have to call one at a time.
+    def make_read_plan(self):
+        read_plan = {'batch':[], 'async':[], 'direct':[]}
+        for chan in mc:
+            mclist = mc[chan]
+            obj = getattr(cg,mclist[0])
+            # Only get_X has a req_X. Anything else (time.time, the PT415
+            # status read) isn't a SIM900 request
+            req_name = 'req_'+mclist[1][len('get_'):] if mclist[1].startswith('get_') else None
+            if cg.daq_batch_sim_reads and req_name!=None and hasattr(obj,req_name):
+                read_plan['batch'].append((chan,getattr(obj,req_name)))
+            elif aio.iscoroutinefunction(getattr(obj,mclist[1])):
+                read_plan['async'].append((chan,getattr(obj,mclist[1])))
+            else:
+                read_plan['direct'].append((chan,getattr(obj,mclist[1])))
+        return read_plan
+
+    def channel_args(self, chan):
+        args = mc[chan][2]
+        if args is None: # == None doesn't work on the PT415 status record
+            return ()
+        elif isinstance(args,tuple):
+            return args
+        return (args,)
+
+    def read_batch(self):
+        batch = self.read_plan['batch']
+        requests = [req(*self.channel_args(chan)) for chan,req in batch]
+        vals = cg.sim900.read_requests(requests)
+        return dict([(chan,val) for (chan,req),val in zip(batch,vals)])
+
+    # The batch and the direct channels, blocking
+    def read_sync_channels(self):
+        direct = dict(self.read_plan['direct'])
+        async_chans = dict(self.read_plan['async'])
+        vals = dict()
+        for chidx,chan in enumerate(mc):
+            # The whole batch goes out where its first channel used to be read
+            if chan in direct:
+                vals[chan] = direct[chan](*self.channel_args(chan))
+            elif chan not in vals and chan not in async_chans:
+                vals.update(self.read_batch())
+        return vals
+
+    # Pull subchannel idx out of a channel reading. Blocks of n readings
+    # come as (n, channels) arrays, everything else is indexed directly.
+    def subchannel(self, val, idx):
+        if isinstance(val,np.ndarray) and val.ndim==2:
+            return val[:,idx]
+        return val[idx]
 
     # Do the channel reading
-    def read_channels(self):
-        data = copy.deepcopy(arc.empty_data_frame)
+    # Values go into the accumulator if one is given, otherwise a one row
+    # DataFrame of this sweep is returned.
+    async def read_channels(self, acc=None):
+        return_frame = acc==None
+        if return_frame:
+            acc = DAQ_Accumulator(arc.channel_list, self.last_channels)
 
+        # Get the coroutine channels going first, they do their I/O on
+        # their own threads while we read the SIM900 on a worker thread.
+        # The event loop is free the whole time.
+        tasks = dict([(chan,aio.ensure_future(func(*self.channel_args(chan))))
+                      for chan,func in self.read_plan['async']])
+        loop = aio.get_running_loop()
+        vals = await loop.run_in_executor(None, self.read_sync_channels)
+        for chan in tasks:
+            vals[chan] = await tasks[chan]
+            
         for chidx,chan in enumerate(mc):
             
             mclist = mc[chan]
-            if mclist[2]==None:
-                val = getattr(getattr(cg,mclist[0]), mclist[1])()
-            else:
-                val = getattr(getattr(cg,mclist[0]), mclist[1])(mclist[2])
+            val = vals[chan]
                 
             if mclist[3]==None:
-                data.loc[0,chan] = val
+                acc.add(chan,val)
+            elif isinstance(val,np.ndarray) and val.dtype.names:
+                # Typed records (PT415 status) go in as one row
+                names, idx = self.subchannels[chan]
+                acc.add_row(names, rfn.structured_to_unstructured(val, dtype=float)[idx])
             else:
                 for subidx,subch in enumerate(mclist[3]):
-                    data.loc[0,chan.replace(cg.channel_wildcard,subch)] = val[mclist[4][subidx]]
+                    acc.add(chan.replace(cg.channel_wildcard,subch),self.subchannel(val,mclist[4][subidx]))
 
+        if return_frame:
+            return acc.mean_frame()
+        return
 
-        return data
+    # Dense FAA data straight from the SIM921 in stream mode.
+    # The SIM900 link is ours for the whole capture, so it is done in short
+    # chunks with normal sweeps in between, and a chunk ends early when
+    # control traffic (the ramp engine) is waiting for the bus. Runs in a
+    # worker thread so the event loop keeps going.
+    async def read_faa_stream(self, acc):
+        duration = min(self.faa_stream_chunk, self.faa_stream_until-time.time())
+        loop = aio.get_running_loop()
+        t, T = await loop.run_in_executor(None, cg.sim921_stream.capture, duration)
+        if len(T) > 0:
+            acc.add("FAA Temp", T)
+            arc.save_arc(pd.DataFrame({"Time":t, "FAA Temp":T}), key="faa_stream")
 
     async def DAQ_run(self):
         # Just read the channels as fast as we can
         # but average over the sampling rate to reduce noise
-        data = copy.deepcopy(arc.empty_data_frame)
+        acc = DAQ_Accumulator(arc.channel_list, self.last_channels)
         t0 = time.time()
         try:
             print("Starting DAQ")
@@ -67,11 +211,14 @@ class ADR_DAQ():
 
     
                 while (time.time()-t0) < self.sample_rate:
-                    data = pd.concat([data, self.read_channels()], ignore_index=True)
+                    if time.time() < self.faa_stream_until:
+                        await self.read_faa_stream(acc)
+                    await self.read_channels(acc)
                     await aio.sleep(0.001)
                     # to-do: force loop end if sample rate changes
                     
-                data = data.mean(axis=0).to_frame().T
+                data = acc.mean_frame()
+                acc.reset()
                 if self.verbose:
                     print(data)
 
@@ -105,6 +252,9 @@ class ADR_DAQ():
             elif command == 'change_sampling':
                 self.sample_rate = args.get('interval', self.sample_rate)
                 print(f"Sampling interval changed to {self.sample_rate}s.")
+            elif command == 'stream_faa':
+                self.faa_stream_until = time.time() + args.get('duration', 0)
+                print(f"Streaming FAA temperature for {args.get('duration', 0)}s.")
             elif command == 'set_verbose':
                 self.verbose = args.get('flag', self.verbose)
                 print(f"Verbosity set to {self.verbose}.")
@@ -117,6 +267,11 @@ class ADR_DAQ():
     async def change_sampling_rate(self, interval):
         await self.command_queue.put(('change_sampling', {'interval': interval}))
 
+    # Dense FAA temperature data for the next duration seconds,
+    # e.g. during regulation or demag. duration=0 stops it.
+    async def stream_faa(self, duration):
+        await self.command_queue.put(('stream_faa', {'duration': duration}))
+
     async def set_verbose(self, flag):
         await self.command_queue.put(('set_verbose', {'flag': flag}))
 
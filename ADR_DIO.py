@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+All the digital inputs in one snapshot: the heat switch limit lines and
+touch sensors on ADR_DIO port0, and the resistor box relay and resistor
+read-backs on ADR_RESISTOR_BOX port2.
+
+Each port is read as one word per sweep (a single driver call, line 0 in
+bit 0) and the words go into the archive as they are, as the "DIO #_"
+columns. decode() and decode_frame() turn them back into the states
+HPD_Heat_Switch and ADR_Resistor_Box report:
+
+>>> words = DIOSnapshot().read()
+>>> decode(words)['Touch 4K-50mK']
+'No Touch'
+>>> decode_frame(arc.load_arc())[['Time', 'Heat Switch', 'Relay Position']]
+"""
+
+import asyncio as aio
+import sys
+
+import numpy as np
+import pandas as pd
+
+from daqmx_session import session, split_lines
+from ADR_Resistor_Box import switches
+
+# Input ports in archive column order. Column names are the port with a
+# space for the slash (ADR_Config "DIO #_" subchannels).
+ports = ['ADR_DIO/port0', 'ADR_RESISTOR_BOX/port2']
+port_columns = ['DIO '+port.replace('/', ' ') for port in ports]
+
+# name: (input lines, {line states: value}, value for any other state)
+inputs = {
+    'Heat Switch': ('ADR_DIO/port0/line0:1', {(1, 1):'At Limit'}, 'Moving'),
+    'Touch 4K-1K': ('ADR_DIO/port0/line2', {(0,):'Touch', (1,):'No Touch'}, None),
+    'Touch 4K-50mK': ('ADR_DIO/port0/line3', {(0,):'Touch', (1,):'No Touch'}, None),
+    'Touch 1K-50mK': ('ADR_DIO/port0/line4', {(0,):'Touch', (1,):'No Touch'}, None),
+    }
+# The resistor box read-backs, as the driver has them
+for quant, (pulses, sense, states) in switches.items():
+    inputs[quant] = (sense, states, 'Invalid')
+
+
+class DIOSnapshot():
+    def __init__(self, ports=ports):
+        self.ports = ports
+
+    # One word per port
+    def read(self):
+        return [session.read_port(port) for port in self.ports]
+
+    # For the DAQ: read on a worker thread, off the event loop. If the DIO
+    # can't be read the error goes to errfile and the words are NaN for
+    # this sweep, so the DAQ keeps going.
+    async def read_async(self, errfile=sys.stderr):
+        loop = aio.get_running_loop()
+        try:
+            return await loop.run_in_executor(None, self.read)
+        except Exception as err:
+            errfile.write("DIO read failed: "+repr(err)+'\n')
+            return [np.nan]*len(self.ports)
+
+
+# Line states of channel (e.g. 'ADR_DIO/port0/line2:4') from {port: word}
+def lines(words, channel):
+    port, line_numbers = split_lines(channel)
+    return tuple([(int(words[port]) >> line) & 1 for line in line_numbers])
+
+
+# {input name: value} from the port words, a list in ports order or a
+# {port: word} dict
+def decode(words):
+    if not isinstance(words, dict):
+        words = dict(zip(ports, words))
+    return dict([(name, states.get(lines(words, channel), other))
+                 for name, (channel, states, other) in inputs.items()])
+
+
+# The archive with a column per input, decoded from the DIO columns.
+# Rows from before the DIO was logged are left empty.
+def decode_frame(data):
+    data = data.copy()
+    logged = data[port_columns].notna().all(axis=1).values
+    decoded = [decode(words) for words in data[port_columns].values[logged]]
+    for name in inputs:
+        column = np.full(len(data), None, dtype=object)
+        column[logged] = [row[name] for row in decoded]
+        data[name] = column
+    return data
+
+
+if __name__ == '__main__':
+    words = DIOSnapshot().read()
+    print(dict(zip(port_columns, words)))
+    print(pd.Series(decode(words)))
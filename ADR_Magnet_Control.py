@@ -6,70 +6,358 @@ Created on Tue Apr 29 09:58:22 2025
 """
 
 import asyncio as aio
+from datetime import datetime
+import json
+import os
+import time
 
+import numpy as np
+import pandas as pd
 
-# WIP. Don't use this yet.
+from HPD_Heat_Switch import Driver as hs
+from ADR_Ramp import RampEngine
+from ADR_Ramp_Profile import piecewise_profile, scurve_profile
+
+
+# A mag cycle is a list of steps, each a dict with a name, an action and the
+# action's parameters:
+#   {'name':..., 'action':'heat_switch', 'position':'Open' or 'Close'}
+#   {'name':..., 'action':'ramp', 'target':A, 'minutes':min}
+#   {'name':..., 'action':'ramp', 'waypoints':[[A, A/s], ...]} (piecewise rates)
+#   {'name':..., 'action':'soak', 'minutes':min}
+# All times in args are in minutes.
+def mag_cycle_steps(magup_time=30, magsoak_time=60, magdown_time=60,
+                    is_first_cycle=False, final_max_current=9):
+    steps = []
+    if is_first_cycle: # Make sure the heat switch is closed
+        steps += [{'name':'hs_open_first', 'action':'heat_switch', 'position':'Open'},
+                  {'name':'hs_close_first', 'action':'heat_switch', 'position':'Close'}]
+    steps += [{'name':'mag_up', 'action':'ramp', 'target':final_max_current, 'minutes':magup_time},
+              # reset the heat switch since the magnet will have put tension on things.
+              {'name':'hs_open_reset', 'action':'heat_switch', 'position':'Open'},
+              {'name':'hs_close_reset', 'action':'heat_switch', 'position':'Close'},
+              {'name':'soak', 'action':'soak', 'minutes':magsoak_time},
+              {'name':'hs_open', 'action':'heat_switch', 'position':'Open'},
+              {'name':'mag_down', 'action':'ramp', 'target':0, 'minutes':magdown_time}]
+    return steps
+
+
+# Magnet control as a task on the event loop, next to the DAQ.
+# Commands (pause, resume, abort, change_rate) are handled as soon as they
+# are queued and act on the ramp or soak in progress. The instruments are
+# only touched from the executor, so a ramp and DAQ sampling don't hold
+# each other up.
+#
+# >>> mag = ADR_MAG(daq.adr_config, arc)
+# >>> await mag.start(final_max_current=9, magup_time=30, magsoak_time=60, magdown_time=60)
+# >>> await mag.pause()
+# >>> await mag.change_rate(2e-3)
+# >>> await mag.resume()
+# >>> await mag.abort()
+#
+# Cycle progress is checkpointed to adr_config.mag_checkpoint_file after every
+# step, so after a restart
+# >>> await mag.recover()
+# picks the cycle up from the measured magnet current. The steps are logged
+# to the archive under key "mag_events".
 class ADR_MAG():
-    def __init__(self):
+    def __init__(self, adr_config, arc=None, heat_switch=hs, clock=None):
+        self.adr_config = adr_config
+        self.arc = arc
+        self.heat_switch = heat_switch
+        self.engine = RampEngine(adr_config.sim960, adr_config.sim970, arc=arc,
+                                 update_time=adr_config.ramp_update_time,
+                                 lead_resistance=adr_config.lead_resistance,
+                                 lead_resistance_range=adr_config.lead_resistance_range,
+                                 current_scale=adr_config.mag_current_scale,
+                                 emf_scale=adr_config.mag_emf_scale,
+                                 log_interval=adr_config.ramp_log_interval,
+                                 max_accel=adr_config.ramp_max_accel, clock=clock)
+        self.clock = self.engine.clock
         self.command_queue = aio.Queue() #Allow for command changes
         self._stop_event = aio.Event()
         self._pause_event = aio.Event()
         self._pause_event.set() # Initially not paused
         self.task = None
-        self.data = None
-        
-        
+        self.command_task = None
+        self.verbose = True
+        self.state = 'idle'
+        self.checkpoint = None
         return
-    
-    
-    
-    
-    
-    async def start(self):
-        if self.task is None or self.task.done():
-            self._stop_event.clear()
-            self._pause_event.set()
-            self.task = aio.create_task(self.DAQ_run())
-            
-   
+
+    async def start(self, **kwargs):
+        """
+        Start a mag cycle, see mag_cycle_steps for the arguments.
+        """
+        await self.start_sequence(mag_cycle_steps(**kwargs))
+
+    async def start_sequence(self, steps):
+        if not self.check_steps(steps):
+            return
+        checkpoint = {'steps':steps, 'step':0, 'progress':{}, 'status':'running'}
+        await self.run(self.run_sequence(checkpoint))
+
+    # Refuse a cycle with a rate the engine would stop on, before it starts
+    def check_steps(self, steps):
+        for step in steps:
+            rates = [abs(w[1]) for w in step.get('waypoints', [])]
+            if rates and max(rates) > self.engine.max_rate:
+                print(f"Step {step['name']} ramps at {max(rates)*1000:.2f} mA/s, "
+                      f"the limit is {self.engine.max_rate*1000:.2f} mA/s. Not started.")
+                return False
+        return True
+
+    async def recover(self, checkpoint_file=None):
+        """
+        Carry on with the cycle in the checkpoint file after a restart.
+
+        A ramp that was running goes on at its rate from the current the
+        magnet is at now. If the next step isn't a ramp and the magnet isn't
+        at the current the last ramp left it at (e.g. the supply tripped),
+        that ramp is done again first.
+        """
+        checkpoint = self.load_checkpoint(checkpoint_file)
+        if checkpoint is None or checkpoint['step'] >= len(checkpoint['steps']):
+            print("No mag cycle to recover.")
+            return
+        steps, i = checkpoint['steps'], checkpoint['step']
+        t, V960, I, EMF, Vmag = await self.engine.measure()
+        print(f"Recovering at step {i} ({steps[i]['name']}): OMON = {V960:.4f} V, I = {I:.3f} A")
+
+        ramps = [step for step in steps[:i] if step['action'] == 'ramp']
+        if ramps and 'waypoints' in ramps[-1]:
+            ramps[-1] = dict(ramps[-1], target=ramps[-1]['waypoints'][-1][0])
+        if steps[i]['action'] != 'ramp' and ramps and np.abs(I - ramps[-1]['target']) > 10*self.engine.tolerance:
+            restore = dict(ramps[-1], name='restore_'+ramps[-1]['name'])
+            print(f"Magnet is not at {restore['target']} A, ramping back first.")
+            checkpoint['steps'] = steps[:i] + [restore] + steps[i:]
+            checkpoint['progress'] = {}
+        checkpoint['status'] = 'running'
+        checkpoint.pop('error', None)
+        self.log_event(checkpoint['step'], checkpoint['steps'][checkpoint['step']], 'recover', I)
+        await self.run(self.run_sequence(checkpoint))
+
+    async def start_ramp(self, final_magnet_current=0, time_to_final_voltage=30):
+        """
+        Start a single ramp, time_to_final_voltage in minutes.
+        """
+        await self.run(self.ramp(final_magnet_current, time_to_final_voltage))
+
+    async def run(self, coro):
+        if self.task is not None and not self.task.done():
+            coro.close()
+            print("Magnet is busy, abort it first.")
+            return
+        self._stop_event.clear()
+        self._pause_event.set()
+        self.engine.resume()
+        while not self.command_queue.empty(): # Left over from a run that's over
+            self.command_queue.get_nowait()
+        self.task = aio.create_task(coro)
+        command_task = self.command_task = aio.create_task(self._handle_commands())
+        # Commands are only taken while the task runs
+        self.task.add_done_callback(lambda task: command_task.cancel())
+
     async def _handle_commands(self):
-        # Process all available commands without blocking
-        while not self.command_queue.empty():
+        # Handle commands as they come, while the magnet task runs
+        while True:
             command, args = await self.command_queue.get()
             if command == 'pause':
                 self._pause_event.clear()
-                print("DAQ paused.")
+                self.engine.pause()
+                print("Magnet paused.")
             elif command == 'resume':
                 self._pause_event.set()
-                print("DAQ resumed.")
-            elif command == 'change_sampling':
-                self.sample_rate = args.get('interval', self.sample_rate)
-                print(f"Sampling interval changed to {self.sample_rate}s.")
+                self.engine.resume()
+                print("Magnet resumed.")
+            elif command == 'change_rate':
+                rate = args.get('rate', self.engine.rate)
+                if rate is None or abs(rate) > self.engine.max_rate:
+                    print(f"Ramp rate {rate} A/s refused, the limit is {self.engine.max_rate} A/s.")
+                else:
+                    self.engine.set_rate(rate)
+                    if self.state == 'ramping' and self.checkpoint is not None:
+                        self.checkpoint['progress']['rate'] = abs(rate)
+                    print(f"Ramp rate changed to {abs(rate)*1000:.2f} mA/s.")
             elif command == 'set_verbose':
                 self.verbose = args.get('flag', self.verbose)
                 print(f"Verbosity set to {self.verbose}.")
-            elif command == 'stop':
+            elif command == 'abort':
                 self._stop_event.set()
                 self._pause_event.set()  # in case it's paused
-                print("DAQ stopping...")        
-        await aio.sleep(0.001)
-    
-    async def change_sampling_rate(self, interval):
-        await self.command_queue.put(('change_sampling', {'interval': interval}))
+                self.engine.abort()
+                print("Magnet aborting, holding the current where it is.")
+
+    # The switch moves on its own thread, the move time goes to the archive
+    # under key "heat_switch"
+    async def set_heat_switch(self, position):
+        t = self.clock.time()
+        error = None
+        try:
+            duration = await aio.wrap_future(self.heat_switch.startMove(position, self.adr_config.heat_switch_timeout))
+        except Exception as err: # Timed out, or the DIO failed
+            error = err
+            duration = np.nan
+        if self.arc is not None:
+            data = pd.DataFrame({"Time":[t], "Position":[position], "Duration":[duration], "Completed":[error is None]})
+            self.arc.save_arc(data, key="heat_switch", min_itemsize={"Position":8})
+        if error is not None:
+            raise RuntimeError(f"Heat switch move failed: {error}") from error
+        return duration
+
+    def aborted(self):
+        if self._stop_event.is_set():
+            self.state = 'aborted'
+            print("Mag cycle aborted.")
+            return True
+        return False
+
+    # Sleep for duration seconds, not counting time paused.
+    # Returns early on abort.
+    async def soak(self, duration):
+        remaining = duration
+        while remaining > 0 and not self._stop_event.is_set():
+            await self._pause_event.wait()
+            t0 = self.clock.monotonic()
+            try:
+                await aio.wait_for(self._stop_event.wait(), self.clock.sleep_time(min(remaining, 1.0)))
+            except aio.TimeoutError:
+                pass
+            if self._pause_event.is_set():
+                remaining -= self.clock.monotonic() - t0
+
+    async def ramp(self, final_magnet_current=0, time_to_final_voltage=30):
+        self.state = 'ramping'
+        try:
+            I = await self.engine.ramp(final_magnet_current, duration=time_to_final_voltage*60,
+                                       verbose=self.verbose)
+        except Exception as err:
+            self.state = 'failed'
+            print(f"Ramp failed: {err!r}")
+            raise
+        self.state = 'aborted' if self.engine.aborted else 'idle'
+        return I
+
+    async def run_sequence(self, checkpoint):
+        steps = checkpoint['steps']
+        while checkpoint['step'] < len(steps):
+            i = checkpoint['step']
+            step = steps[i]
+            self.log_event(i, step, 'start')
+            self.save_checkpoint(checkpoint)
+            try:
+                await self.run_step(step, checkpoint)
+            except Exception as err:
+                # Leave it where recover() can pick it up, and say so
+                checkpoint['status'] = 'failed'
+                checkpoint['error'] = repr(err)
+                self.save_checkpoint(checkpoint)
+                self.log_event(i, step, 'failed')
+                self.state = 'failed'
+                print(f"Mag cycle failed at step {i} ({step['name']}): {err!r}")
+                raise
+            if self._stop_event.is_set():
+                checkpoint['status'] = 'aborted'
+                self.save_checkpoint(checkpoint)
+                self.log_event(i, step, 'abort')
+                self.aborted()
+                return
+            self.log_event(i, step, 'done')
+            checkpoint['step'] += 1
+            checkpoint['progress'] = {}
+            self.save_checkpoint(checkpoint)
+        checkpoint['status'] = 'done'
+        self.save_checkpoint(checkpoint)
+        self.state = 'idle'
+        comp_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        print(f'Mag cycle completed at:\n{comp_time}')
+
+    async def run_step(self, step, checkpoint):
+        progress = checkpoint['progress']
+        if step['action'] == 'heat_switch':
+            await self.set_heat_switch(step['position'])
+        elif step['action'] == 'ramp' and 'waypoints' in step:
+            self.state = 'ramping'
+            t, V960, I, EMF, Vmag = await self.engine.measure()
+            # What's left of the path from here, after a recovery
+            direction = np.sign(step['waypoints'][-1][0] - I)
+            waypoints = [w for w in step['waypoints'] if (w[0] - I)*direction > 0]
+            if waypoints:
+                # Stepped out in a loop, so off the event loop
+                loop = aio.get_running_loop()
+                profile = await loop.run_in_executor(None, piecewise_profile, I, waypoints,
+                                                     self.engine.max_accel)
+                await self.engine.ramp(None, profile=profile, verbose=self.verbose)
+        elif step['action'] == 'ramp':
+            self.state = 'ramping'
+            if 'rate' not in progress: # Keep the rate on a recovered ramp
+                t, V960, I, EMF, Vmag = await self.engine.measure()
+                profile = scurve_profile(I, step['target'], duration=step['minutes']*60,
+                                         max_accel=self.engine.max_accel, max_rate=self.engine.max_rate)
+                progress['rate'] = float(profile.max_rate)
+                self.save_checkpoint(checkpoint)
+            await self.engine.ramp(step['target'], rate=progress['rate'], verbose=self.verbose)
+        elif step['action'] == 'soak':
+            self.state = 'soaking'
+            remaining = progress.get('remaining', step['minutes']*60)
+            print(f'Soaking for {remaining/60:.1f} minutes.')
+            while remaining > 0 and not self._stop_event.is_set():
+                chunk = min(remaining, self.adr_config.mag_checkpoint_interval)
+                await self.soak(chunk)
+                if not self._stop_event.is_set():
+                    remaining -= chunk
+                    progress['remaining'] = remaining
+                    self.save_checkpoint(checkpoint)
+        else:
+            raise ValueError(f"Unknown mag cycle action {step['action']}")
+        if self.verbose and not self._stop_event.is_set():
+            comp_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            print(f"{step['name']} completed at:\n{comp_time}")
+
+    def save_checkpoint(self, checkpoint):
+        checkpoint['time'] = time.time()
+        self.checkpoint = checkpoint
+        path = self.adr_config.mag_checkpoint_file
+        with open(path+'.tmp', 'w') as f:
+            json.dump(checkpoint, f, indent=1)
+        os.replace(path+'.tmp', path) # Never leave a half written checkpoint
+
+    def load_checkpoint(self, checkpoint_file=None):
+        path = self.adr_config.mag_checkpoint_file if checkpoint_file is None else checkpoint_file
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def log_event(self, i, step, event, current=None):
+        if current is None:
+            current = np.nan if self.engine.estimator.I is None else self.engine.estimator.I
+        if self.verbose:
+            print(f"Mag cycle step {i} {step['name']}: {event}")
+        if self.arc is not None:
+            data = pd.DataFrame({"Time":[self.clock.time()], "Step":[i], "Name":[step['name']],
+                                 "Action":[step['action']], "Event":[event], "Current":[current]})
+            self.arc.save_arc(data, key="mag_events", min_itemsize={"Name":32, "Action":16, "Event":16})
+
+    async def change_rate(self, rate):
+        await self.command_queue.put(('change_rate', {'rate': rate}))
 
     async def set_verbose(self, flag):
         await self.command_queue.put(('set_verbose', {'flag': flag}))
 
     async def pause(self):
         await self.command_queue.put(('pause',{}))
-        
+
     async def resume(self):
         await self.command_queue.put(('resume',{}))
-        
-    async def stop(self):
-        await self.command_queue.put(('stop',{}))
-        if self.task:
-            await self.task
+
+    async def abort(self):
+        if self.task is None or self.task.done():
+            return
+        await self.command_queue.put(('abort',{}))
+        await self.task
+
+    stop = abort
 
 
     def __del__(self):
@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+"""
+Closed loop magnet ramps.
+
+The Kepco supply is voltage programmed from the SIM960 manual output
+(V_Kepco = V_GAIN * MOUT), so the magnet current follows
+    V_Kepco = I*R_lead + L*dI/dt
+Instead of stepping MOUT open loop on a timer, RampEngine measures the
+magnet current and back-EMF on the Sim970 every update, keeps running
+estimates of the lead resistance and magnet inductance, and sets MOUT to
+make the current follow a reference ramping at the requested dI/dt.
+
+The output slew is limited to R_min*SAFE_RAMP_RATE, with R_min the low end
+of the configured lead resistance range, not the estimate. So the current
+can't ramp faster than SAFE_RAMP_RATE even if the reference or the estimates
+are off. The SIM960 output (OMON) is checked against what was set on every
+update.
+
+>>> engine = RampEngine(sim960, sim970, arc=arc)
+>>> await engine.ramp(9, duration=30*60) # to 9 A in 30 minutes
+
+The trajectory goes to the archive under key "ramp".
+"""
+
+import asyncio as aio
+import time
+
+import numpy as np
+import pandas as pd
+
+from ADR_Ramp_Profile import SAFE_RAMP_RATE, V_GAIN, MOUT_RESOLUTION, scurve_profile
+
+OMON_TOLERANCE = 0.005 # V, most SIM960 OMON may be off what MOUT was set to
+
+# Sim970 VOLT? 0 array index of each signal (channels 1-4)
+EMF_IDX = 0
+MAGCURR_IDX = 1
+MAGVOLT_IDX = 2
+
+ramp_columns = ["Time", "I_ref", "I", "dIdt_ref", "V_Kepco_set", "V960", "EMF", "MagVolt", "R_lead", "L_mag"]
+
+
+class RampEstimator():
+    """
+    Running estimates of the lead resistance and the magnet inductance.
+
+    R from V_Kepco = I*R + EMF while there is current, L from EMF = L*dI/dt
+    while the current is changing. Both are smoothed with time constant
+    tau (s) so measurement noise doesn't get into the output. R is kept
+    inside R_range (Ohm).
+    """
+    def __init__(self, R0=1.2, L0=None, tau=20., I_min=0.05, rate_min=1e-3, R_range=(0., np.inf)):
+        self.R = R0
+        self.R_range = R_range
+        self.L = L0 # None until the current has moved enough to tell
+        self.tau = tau
+        self.I_min = I_min # A, least current to estimate R from
+        self.rate_min = rate_min # A/s, least dI/dt to estimate L from
+        self.t = None
+        self.I = None
+        self.rate = 0. # Smoothed dI/dt
+        self.EMF = 0. # Smoothed the same way
+
+    def update(self, t, V_kepco, I, EMF):
+        if self.t is not None and t > self.t:
+            dt = t - self.t
+            a = min(dt/self.tau, 1.)
+            if np.abs(I) > self.I_min:
+                self.R += a*((V_kepco - EMF)/I - self.R)
+                self.R = np.clip(self.R, *self.R_range)
+            self.rate += a*((I - self.I)/dt - self.rate)
+            self.EMF += a*(EMF - self.EMF)
+            if np.abs(self.rate) > self.rate_min and self.EMF/self.rate > 0:
+                self.L = self.EMF/self.rate
+        self.t, self.I = t, I
+
+
+# Where the engine gets the time from. ADR_Simulator has one that runs
+# faster than real time.
+class RealClock():
+    speedup = 1.
+
+    def time(self):
+        return time.time()
+
+    def monotonic(self):
+        return time.monotonic()
+
+    # Real seconds to wait for dt seconds on this clock
+    def sleep_time(self, dt):
+        return dt
+
+
+class RampEngine():
+    def __init__(self, sim960, sim970, arc=None, update_time=0.5, max_rate=SAFE_RAMP_RATE,
+                 lead_resistance=1.2, lead_resistance_range=(1.0, 2.0), current_scale=1.0,
+                 emf_scale=1.0, kp=0.5, tolerance=0.01, settle_time=60., log_interval=10.,
+                 max_accel=None, clock=None):
+        self.sim960 = sim960
+        self.sim970 = sim970
+        self.sim900 = sim960.parent
+        self.arc = arc # ADR_ARC to log to, or None
+        self.update_time = update_time # s between updates
+        self.max_rate = max_rate # A/s, never ramp faster than this
+        self.current_scale = current_scale # A per V of Sim970 MagCurr
+        self.emf_scale = emf_scale # V per V of Sim970 EMF
+        self.kp = kp # Current error correction, fraction of the error per update
+        self.tolerance = tolerance # A, done when the current is this close to the target
+        self.settle_time = settle_time # s, most we wait for that after the reference gets there
+        self.log_interval = log_interval # s between archive writes
+        self.read_retries = 3 # Failed reads in a row before the ramp stops
+        self.max_accel = max_accel # A/s^2 for the S-curve ramps, None for linear
+        self.clock = RealClock() if clock is None else clock
+        # The output slew limit uses the lowest the leads could be, so a
+        # high estimate can't let the current ramp faster than max_rate
+        self.R_slew = lead_resistance_range[0]
+        self.estimator = RampEstimator(R0=lead_resistance, R_range=lead_resistance_range)
+        self.V960 = None # Last output set
+        self.I_ref = None
+        self.rate = None # A/s, of the ramp in progress
+        self.paused = False # Hold the reference where it is
+        self.aborted = False # Stop the ramp where it is
+        self._wake = aio.Event() # Set to run the next update right away
+        self.log_rows = []
+        self.t_logged = 0.
+
+    # Changes to the ramp in progress, applied at the next update, which
+    # runs right away. Call from the event loop thread.
+    def pause(self):
+        self.paused = True
+        self._wake.set()
+
+    def resume(self):
+        self.paused = False
+        self._wake.set()
+
+    def abort(self):
+        self.aborted = True
+        self._wake.set()
+
+    def set_rate(self, rate):
+        # A profile fitted to max_rate can come out an ulp over
+        assert np.abs(rate) <= self.max_rate*(1 + 1e-9), 'Mag-up rate exceeds limit'
+        self.rate = np.abs(rate)
+        self._wake.set()
+
+    # Sleep until the next update is due, or until something changes
+    async def wait_update(self, timeout):
+        try:
+            await aio.wait_for(self._wake.wait(), self.clock.sleep_time(max(timeout, 0)))
+        except aio.TimeoutError:
+            pass
+        self._wake.clear()
+
+    # Magnet current, back-EMF, magnet voltage and SIM960 output, in one
+    # SIM900 batch at the SIM960's (control) priority. Blocking, run it off
+    # the event loop.
+    def read_inputs(self):
+        omon, volts = self.sim900.read_requests([self.sim960.req_OMON(), self.sim970.req_VOLT(0)],
+                                                self.sim960.priority)
+        return (self.clock.time(), omon,
+                volts[MAGCURR_IDX]*self.current_scale,
+                volts[EMF_IDX]*self.emf_scale,
+                volts[MAGVOLT_IDX])
+
+    # A failed read (e.g. a timeout behind other SIM900 traffic) is tried
+    # again next update, with the output left where it is. Only
+    # read_retries failures in a row stop the ramp.
+    async def measure(self):
+        loop = aio.get_running_loop()
+        for attempt in range(self.read_retries):
+            try:
+                return await loop.run_in_executor(None, self.read_inputs)
+            except Exception as err:
+                if attempt == self.read_retries - 1:
+                    raise
+                print('Ramp read failed, holding the output: {!r}'.format(err))
+                await self.wait_update(self.update_time)
+
+    async def set_output(self, V960):
+        V960 = np.round(V960/MOUT_RESOLUTION)*MOUT_RESOLUTION
+        if V960 != self.V960:
+            loop = aio.get_running_loop()
+            await loop.run_in_executor(None, self.sim960.set_MOUT, V960)
+            self.V960 = V960
+        return V960
+
+    # The SIM960 has to be putting out what it was last set to
+    def check_output(self, V960):
+        if self.V960 is not None:
+            assert np.abs(V960 - self.V960) < OMON_TOLERANCE, 'SIM960 output is not tracing set point'
+
+    # Kepco voltage for the current to follow I_ref, rising at rate_ref,
+    # from measured current I.
+    # The output never moves faster than R_slew*max_rate. The magnet current
+    # is the output through the L/R low pass, with R_slew no more than the
+    # real R, so it can't then ramp faster than max_rate whatever the
+    # estimates are.
+    def control(self, I_ref, rate_ref, I, dt):
+        est = self.estimator
+        V = est.R*I_ref + est.R*self.kp*(I_ref - I)
+        if est.L is not None:
+            V += est.L*rate_ref
+        if self.V960 is not None:
+            # A late update doesn't get a bigger step
+            dV = self.R_slew*self.max_rate*min(dt, self.update_time)
+            V = np.clip(V, self.V960*V_GAIN - dV, self.V960*V_GAIN + dV)
+        return V
+
+    def log(self, row, force=False):
+        self.log_rows.append(row)
+        if self.arc is not None and (force or row[0] - self.t_logged >= self.log_interval):
+            self.arc.save_arc(pd.DataFrame(self.log_rows, columns=ramp_columns), key="ramp")
+            self.log_rows = []
+            self.t_logged = row[0]
+        elif self.arc is None and len(self.log_rows) > 100000:
+            del self.log_rows[:50000]
+
+    async def ramp(self, target, rate=None, duration=None, profile=None, verbose=True):
+        """
+        Ramp the magnet current to target (A), at rate (A/s) or over
+        duration (s), on an S-curve if max_accel is set. Or follow a
+        RampProfile. Returns the final measured current.
+
+        pause(), resume(), set_rate() and abort() act on the ramp while it
+        runs. set_rate speeds up or slows down the whole profile. An
+        aborted ramp holds the current where it got to.
+        """
+        t, V960, I, EMF, Vmag = await self.measure()
+        self.V960 = V960
+        if profile is None:
+            profile = scurve_profile(I, target, rate, duration, self.max_accel, max_rate=self.max_rate)
+            if verbose and duration is not None and profile.duration > duration + 1.:
+                print('{:.1f} minutes would go over {:.2f} mA/s, taking longer'.format(
+                    duration/60, self.max_rate*1000))
+        else:
+            target = profile.I[-1]
+        nominal_rate = max(profile.max_rate, 1e-12)
+        self.aborted = False
+        self.set_rate(nominal_rate)
+        if verbose:
+            print('Ramp from {:.3f} A to {:.3f} A at {:.2f} mA/s, {:.1f} minutes'.format(
+                I, target, self.rate*1000, profile.duration/60))
+
+        est = self.estimator
+        est.update(t, V960*V_GAIN, I, EMF)
+        self.I_ref = profile.I[0]
+        tau = 0. # Time along the profile, stops on pause
+        t_last = self.clock.time() # Not from before the profile was made
+        t_ref_done = None
+        t_next = self.clock.monotonic()
+        while True:
+            t_next = max(t_next + self.update_time, self.clock.monotonic())
+            await self.wait_update(t_next - self.clock.monotonic())
+
+            t, V960, I, EMF, Vmag = await self.measure()
+            self.check_output(V960)
+            dt = t - t_last
+            t_last = t
+            est.update(t, V960*V_GAIN, I, EMF)
+            if self.aborted:
+                break
+
+            speed = 0. if self.paused else self.rate/nominal_rate
+            tau = min(tau + speed*dt, profile.duration)
+            self.I_ref = profile.current(tau)
+            rate_ref = profile.rate_at(tau)*speed if tau < profile.duration else 0.
+
+            V_set = self.control(self.I_ref, rate_ref, I, dt)
+            V960_set = await self.set_output(V_set/V_GAIN)
+            self.log([t, self.I_ref, I, rate_ref, V960_set*V_GAIN, V960, EMF, Vmag, est.R,
+                      np.nan if est.L is None else est.L])
+
+            if tau >= profile.duration:
+                if t_ref_done is None:
+                    t_ref_done = t
+                if np.abs(I - target) < self.tolerance or t - t_ref_done > self.settle_time:
+                    break
+
+        I = await self.hold(I if self.aborted else target, t_last)
+        if verbose:
+            print('Ramp Mag {} at {:.3f} A, R_lead = {:.3f} Ohm'.format(
+                'aborted' if self.aborted else 'finished', I, est.R))
+        return I
+
+    async def hold(self, hold, t_last):
+        """
+        Walk the output to just the resistive drop for hold (A), no
+        back-EMF, under the same slew limit as the ramp. Returns the
+        measured current once the output is there.
+        """
+        est = self.estimator
+        self.I_ref = hold
+        V960_hold = np.round(hold*est.R/V_GAIN/MOUT_RESOLUTION)*MOUT_RESOLUTION
+        t_next = self.clock.monotonic()
+        while True:
+            t = self.clock.time()
+            V960_set = await self.set_output(self.control(hold, 0., hold, t - t_last)/V_GAIN)
+            t_last = t
+            t_next = max(t_next + self.update_time, self.clock.monotonic())
+            await self.wait_update(t_next - self.clock.monotonic())
+            t, V960, I, EMF, Vmag = await self.measure()
+            self.check_output(V960)
+            done = V960_set == V960_hold
+            self.log([t, hold, I, 0., V960_set*V_GAIN, V960, EMF, Vmag, est.R,
+                      np.nan if est.L is None else est.L], force=done)
+            if done:
+                return I
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""
+Magnet ramp profiles, and what they will do before we run them.
+
+Linear, S-curve (dI/dt ramps up and down at no more than max_accel) and
+piecewise (different rates over different current ranges) profiles, sampled
+densely so the SIM960 output can follow them to its last bit rather than in
+10 mV steps. RampEngine follows them closed loop.
+
+predict() runs the quantized output through the magnet's L/R circuit and
+gives the ramp time and the eddy current heating, so ramp plans can be
+compared without a cryostat cycle:
+    python ADR_Ramp_Profile.py
+"""
+
+import numpy as np
+
+SAFE_RAMP_RATE = 5.6e-3 # Amps/second
+V_GAIN = 2 # Kepco V = 2 * SIM960
+MOUT_RESOLUTION = 20./2**16 # V, SIM960 output DAC (16 bit over +-10 V)
+
+
+# A profile is the magnet current against time, sampled every dt. They all
+# come out of make_profile, which steps the current along a path of
+# waypoints: the rate moves towards each segment's rate by no more than
+# max_accel, and slows in time to get under the next segment's rate (or to
+# stop at the end). max_accel=None gives straight linear segments. A single
+# segment (linear and S-curve ramps) is worked out in closed form.
+
+class RampProfile():
+    def __init__(self, t, I):
+        self.t = t # s from the start of the ramp
+        self.I = I # A
+        self.rate = np.gradient(I, t) if len(t) > 1 else np.zeros(len(t))
+
+    @property
+    def duration(self):
+        return self.t[-1]
+
+    @property
+    def max_rate(self):
+        return np.max(np.abs(self.rate))
+
+    @property
+    def max_accel(self):
+        if len(self.t) < 3:
+            return 0.
+        return np.max(np.abs(np.diff(self.rate)/np.diff(self.t)))
+
+    def current(self, t):
+        return np.interp(t, self.t, self.I)
+
+    def rate_at(self, t):
+        return np.interp(t, self.t, self.rate)
+
+    def setpoints(self, R, L=0., V_gain=V_GAIN):
+        """
+        Open loop SIM960 output for the profile through lead resistance R and
+        magnet inductance L: times and MOUT values, quantized to the output
+        resolution, one entry each time the output changes by an LSB.
+        """
+        V960 = np.round((R*self.I + L*self.rate)/V_gain/MOUT_RESOLUTION)*MOUT_RESOLUTION
+        change = np.concatenate([[True], np.diff(V960) != 0])
+        return self.t[change], V960[change]
+
+    def predict(self, R, L, eddy_coeff, V_gain=V_GAIN, times=None, V960=None, dt=None):
+        """
+        Simulate the magnet current driven by the setpoints (the profile's
+        own unless times/V960 are given) through the L/R circuit.
+
+        Returns a dict with the total ramp time until the current has
+        settled, the eddy current heat load on the salt pill (eddy_coeff in
+        W per (A/s)^2), its peak, and the peak dI/dt.
+        """
+        if times is None:
+            times, V960 = self.setpoints(R, L, V_gain)
+        if dt is None:
+            dt = min(L/R/20, self.t[1] - self.t[0]) if len(self.t) > 1 else L/R/20
+        settle = 5*L/R
+        t = np.arange(0, times[-1] + settle, dt)
+        V = V960[np.searchsorted(times, t, side='right') - 1]*V_gain
+        # Exact step response of the RL circuit for a piecewise constant drive
+        decay = np.exp(-dt*R/L)
+        I = np.empty(len(t))
+        I[0] = self.I[0]
+        for k in range(1, len(t)):
+            I[k] = V[k-1]/R + (I[k-1] - V[k-1]/R)*decay
+        rate = np.diff(I)/dt
+        power = eddy_coeff*rate**2
+        err = np.abs(I - self.I[-1])
+        tol = max(np.max(err)*1e-3, MOUT_RESOLUTION*V_gain/R)
+        done = np.nonzero(err > tol)[0]
+        return {'duration': t[done[-1]+1] if len(done) and done[-1]+1 < len(t) else t[-1],
+                'heat': np.sum(power)*dt, # J
+                'peak_power': np.max(power) if len(power) else 0., # W
+                'max_rate': np.max(np.abs(rate)) if len(rate) else 0., # A/s
+                't': t, 'I': I}
+
+
+def make_profile(I0, waypoints, max_accel=None, dt=0.1):
+    """
+    waypoints: list of (current, rate) in ramp order, all on the same side of
+    I0. Each segment ramps at up to its rate to its current.
+    """
+    currents = np.array([w[0] for w in waypoints], dtype=float)
+    rates = np.abs(np.array([w[1] for w in waypoints], dtype=float))
+    direction = np.sign(currents[-1] - I0)
+    assert np.all(np.diff(np.concatenate([[I0], currents]))*direction >= 0), 'Waypoints must go one way'
+    if direction == 0:
+        return RampProfile(np.array([0.]), np.array([I0]))
+    if len(waypoints) == 1:
+        return trapezoid_profile(I0, currents[0], rates[0], max_accel, dt)
+    # Slowest rate allowed when crossing each waypoint, 0 at the end
+    exit_rates = np.concatenate([np.minimum(rates[:-1], rates[1:]), [0.]])
+    pos = 0. # Distance travelled
+    dist = np.abs(currents - I0)
+    v = 0.
+    t = [0.]
+    x = [0.]
+    seg = 0
+    while pos < dist[-1]:
+        while pos >= dist[seg]:
+            seg += 1
+        # Fast as this segment allows, but able to slow down for what's ahead
+        v_target = rates[seg]
+        if max_accel is None:
+            v = v_target
+        else:
+            ahead = dist[seg:] - pos
+            v_target = min(v_target, np.min(np.sqrt(exit_rates[seg:]**2 + 2*max_accel*ahead)))
+            v = min(v_target, v + max_accel*dt) if v_target > v else max(v_target, v - max_accel*dt)
+            v = max(v, max_accel*dt) # Don't stall just short of the end
+        pos = min(pos + v*dt, dist[-1])
+        t.append(t[-1] + dt)
+        x.append(pos)
+    return RampProfile(np.array(t), I0 + direction*np.array(x))
+
+
+# One segment in closed form: up to rate at max_accel, along at rate, and
+# down again, or a triangle if there isn't room to get to rate. The same path
+# make_profile's loop steps along, without the loop.
+def trapezoid_profile(I0, I1, rate, max_accel=None, dt=0.1):
+    D = np.abs(I1 - I0)
+    if max_accel is None:
+        t_acc = 0.
+    else:
+        rate = min(rate, np.sqrt(D*max_accel))
+        t_acc = rate/max_accel
+    T = t_acc + D/rate
+    t = np.append(np.arange(0., T, dt), T)
+    x = rate*(t - 0.5*t_acc)
+    if t_acc > 0:
+        x = np.where(t < t_acc, 0.5*max_accel*t**2, x)
+        x = np.where(t > T - t_acc, D - 0.5*max_accel*(T - t)**2, x)
+    return RampProfile(t, I0 + np.sign(I1 - I0)*np.minimum(x, D))
+
+
+def linear_profile(I0, I1, rate, dt=0.1):
+    return make_profile(I0, [(I1, rate)], None, dt)
+
+
+def scurve_profile(I0, I1, rate=None, duration=None, max_accel=None, dt=0.1, max_rate=None):
+    """
+    Trapezoidal dI/dt limited to max_accel, so the current follows an S.
+    Give rate, or duration for the whole ramp including the rounded ends.
+    A duration that would need a peak rate over max_rate (or more than
+    max_accel allows) gives the fastest ramp there is instead, which takes
+    longer.
+    """
+    D = np.abs(I1 - I0)
+    if rate is None:
+        if max_accel is None or D == 0:
+            rate = D/duration
+        else:
+            # D = rate*(duration - rate/max_accel) for the trapezoid
+            disc = (max_accel*duration)**2 - 4*max_accel*D
+            if disc < 0: # Too short, the triangle is as fast as it gets
+                rate = np.sqrt(D*max_accel)
+            else:
+                rate = (max_accel*duration - np.sqrt(disc))/2
+        if max_rate is not None:
+            rate = min(rate, max_rate)
+    return make_profile(I0, [(I1, rate)], max_accel, dt)
+
+
+def piecewise_profile(I0, waypoints, max_accel=None, dt=0.1):
+    """
+    e.g. piecewise_profile(0, [(5, 5e-3), (9, 2e-3)], max_accel=5e-5):
+    fast to 5 A then slower to 9 A.
+    """
+    return make_profile(I0, waypoints, max_accel, dt)
+
+
+# The old open loop ramp_mag output: 10 mV steps, the last one rounded to mV
+def staircase_setpoints(I0, I1, rate, R, V_gain=V_GAIN):
+    V0, V1 = I0*R/V_gain, I1*R/V_gain
+    step = 0.01*np.sign(V1 - V0)
+    V960 = np.arange(V0, V1, step)
+    if np.abs(V1 - V960[-1]) > 0.0005:
+        V960 = np.append(V960, int(V1*1000)/1000)
+    tstep = np.abs(step*V_gain/R/rate)
+    return np.arange(len(V960))*tstep, V960
+
+
+if __name__ == '__main__':
+    # 0 to 9 A in 30 minutes through 1.2 Ohm, with a guess at the magnet
+    R, L, eddy_coeff = 1.2, 20., 0.04
+    I1, duration = 9., 30*60
+    plans = {'staircase (old)': None,
+             'linear': linear_profile(0, I1, I1/duration),
+             'S-curve': scurve_profile(0, I1, duration=duration, max_accel=5e-5),
+             'piecewise': piecewise_profile(0, [(6, 5.5e-3), (I1, 4e-3)], max_accel=5e-5)}
+    for name, profile in plans.items():
+        if profile is None:
+            times, V960 = staircase_setpoints(0, I1, I1/duration, R)
+            pred = linear_profile(0, I1, I1/duration).predict(R, L, eddy_coeff, times=times, V960=V960)
+            n = len(times)
+        else:
+            n = len(profile.setpoints(R, L)[0])
+            pred = profile.predict(R, L, eddy_coeff)
+        print(f"{name:16s} {pred['duration']/60:6.1f} min, {n:6d} setpoints, "
+              f"heat {pred['heat']*1e3:8.4f} mJ, peak {pred['peak_power']*1e6:8.3f} uW, "
+              f"max dI/dt {pred['max_rate']*1e3:6.2f} mA/s")
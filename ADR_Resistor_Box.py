@@ -1,241 +1,55 @@
-import numpy as np
-import PyDAQmx as mx
-import time
+from daqmx_session import session
+
+
+# quant: {value: DO line pulsed to get there}, DI lines read back,
+# {line states read back: value}
+# The pulses and the read back are the same for all of them, only the lines differ.
+switches = {
+    'Relay Position': ({'Mag Cycle':'ADR_RESISTOR_BOX/port1/line0',
+                        'Regulate':'ADR_RESISTOR_BOX/port1/line1'},
+                       'ADR_RESISTOR_BOX/port2/line0:1',
+                       {(0, 1):'Mag Cycle', (1, 0):'Regulate'}),
+    '5 Ohm Resistor': ({'5 Ohm in':'ADR_RESISTOR_BOX/port1/line2',
+                        '5 Ohm out':'ADR_RESISTOR_BOX/port1/line3'},
+                       'ADR_RESISTOR_BOX/port2/line2:3',
+                       {(0, 1):'5 Ohm in', (1, 0):'5 Ohm out'}),
+    '10 Ohm Resistor': ({'10 Ohm in':'ADR_RESISTOR_BOX/port1/line4',
+                         '10 Ohm out':'ADR_RESISTOR_BOX/port1/line5'},
+                        'ADR_RESISTOR_BOX/port2/line4:5',
+                        {(0, 1):'10 Ohm in', (1, 0):'10 Ohm out'}),
+    '25 Ohm Resistor': ({'25 Ohm in':'ADR_RESISTOR_BOX/port1/line6',
+                         '25 Ohm out':'ADR_RESISTOR_BOX/port1/line7'},
+                        'ADR_RESISTOR_BOX/port2/line6:7',
+                        {(0, 1):'25 Ohm in', (1, 0):'25 Ohm out'}),
+    }
 
 
 class Driver():
 
     def performSetValue( quant, value, sweepRate=0.0, options={}):
-        """Create task, set value, close task."""
+        """Pulse the line for the value."""
 
-        if quant == 'Relay Position':
-            if value == 'Mag Cycle':
-                channel = 'ADR_RESISTOR_BOX/port1/line0'
-            elif value == 'Regulate':
-                channel = 'ADR_RESISTOR_BOX/port1/line1'
-            else:
-                assert False, "Error, bad value"
+        assert quant in switches, "Requesting unknown quantity"
+        channels = switches[quant][0]
+        assert value in channels, "Error, bad value"
 
-            #Create a new task
-            writeChan = mx.Task()
-            writeChan.CreateDOChan(channel, '', mx.DAQmx_Val_ChanPerLine)
-
-            setVal0 = np.array([0], dtype=np.uint8)
-            setVal1 = np.array([1], dtype=np.uint8)
-            sampsPer = mx.int32()
-
-            #Send a 100 ms pulse to the appropriate channel (0 is on)
-            writeChan.WriteDigitalLines(1, mx.bool32(
-                True), 0, mx.DAQmx_Val_GroupByScanNumber, setVal0, mx.byref(sampsPer), None)
-            time.sleep(0.1)
-
-            #Set it back to low (1 is off)
-            writeChan.WriteDigitalLines(1, mx.bool32(
-                True), 0, mx.DAQmx_Val_GroupByScanNumber, setVal1, mx.byref(sampsPer), None)
-
-            #Memory Management!
-            writeChan.ClearTask()
-        elif quant == '5 Ohm Resistor':
-            if value == '5 Ohm in':
-                channel = 'ADR_RESISTOR_BOX/port1/line2'
-            elif value == '5 Ohm out':
-                channel = 'ADR_RESISTOR_BOX/port1/line3'
-            else:
-                assert False, "Error, bad value"
-
-            #Create a new task
-            writeChan = mx.Task()
-            writeChan.CreateDOChan(channel, '', mx.DAQmx_Val_ChanPerLine)
-
-            setVal0 = np.array([0], dtype=np.uint8)
-            setVal1 = np.array([1], dtype=np.uint8)
-            sampsPer = mx.int32()
-
-            #Send a 100 ms pulse to the appropriate channel (0 is on)
-            writeChan.WriteDigitalLines(1, mx.bool32(
-                True), 0, mx.DAQmx_Val_GroupByScanNumber, setVal0, mx.byref(sampsPer), None)
-            time.sleep(0.1)
-
-            #Set it back to low (1 is off)
-            writeChan.WriteDigitalLines(1, mx.bool32(
-                True), 0, mx.DAQmx_Val_GroupByScanNumber, setVal1, mx.byref(sampsPer), None)
-
-            #Memory Management!
-            writeChan.ClearTask()
-        elif quant == '10 Ohm Resistor':
-            if value == '10 Ohm in':
-                channel = 'ADR_RESISTOR_BOX/port1/line4'
-            elif value == '10 Ohm out':
-                channel = 'ADR_RESISTOR_BOX/port1/line5'
-            else:
-                assert False, "Error, bad value"
-
-            #Create a new task
-            writeChan = mx.Task()
-            writeChan.CreateDOChan(channel, '', mx.DAQmx_Val_ChanPerLine)
-
-            setVal0 = np.array([0], dtype=np.uint8)
-            setVal1 = np.array([1], dtype=np.uint8)
-            sampsPer = mx.int32()
-
-            #Send a 100 ms pulse to the appropriate channel (0 is on)
-            writeChan.WriteDigitalLines(1, mx.bool32(
-                True), 0, mx.DAQmx_Val_GroupByScanNumber, setVal0, mx.byref(sampsPer), None)
-            time.sleep(0.1)
-
-            #Set it back to low (1 is off)
-            writeChan.WriteDigitalLines(1, mx.bool32(
-                True), 0, mx.DAQmx_Val_GroupByScanNumber, setVal1, mx.byref(sampsPer), None)
-
-            #Memory Management!
-            writeChan.ClearTask()
-        elif quant == '25 Ohm Resistor':
-            if value == '25 Ohm in':
-                channel = 'ADR_RESISTOR_BOX/port1/line6'
-            elif value == '25 Ohm out':
-                channel = 'ADR_RESISTOR_BOX/port1/line7'
-            else:
-                assert False, "Error, bad value"
-
-            #Create a new task
-            writeChan = mx.Task()
-            writeChan.CreateDOChan(channel, '', mx.DAQmx_Val_ChanPerLine)
-
-            setVal0 = np.array([0], dtype=np.uint8)
-            setVal1 = np.array([1], dtype=np.uint8)
-            sampsPer = mx.int32()
-
-            #Send a 100 ms pulse to the appropriate channel (0 is on)
-            writeChan.WriteDigitalLines(1, mx.bool32(
-                True), 0, mx.DAQmx_Val_GroupByScanNumber, setVal0, mx.byref(sampsPer), None)
-            time.sleep(0.1)
-
-            #Set it back to low (1 is off)
-            writeChan.WriteDigitalLines(1, mx.bool32(
-                True), 0, mx.DAQmx_Val_GroupByScanNumber, setVal1, mx.byref(sampsPer), None)
-
-            #Memory Management!
-            writeChan.ClearTask()
-        else:
-            assert False, "Requesting unknown quantity"
+        #Send a 100 ms pulse to the appropriate channel (0 is on, 1 is off)
+        session.pulse(channels[value], on=0, off=1)
 
         return value
 
     def performGetValue( quant, options={}):
-        """Create task, get value, close task."""
-
-        if quant == 'Relay Position':
-            #Create some values to put things in
-            retVal = np.zeros(2, dtype=np.uint8)
-            sampsPer = mx.int32()
-            numBytesPer = mx.int32()
+        """Read back the position lines."""
 
-            #Create a new task
-            readChan = mx.Task()
-            readChan.CreateDIChan(
-                'ADR_RESISTOR_BOX/port2/line0:1', '', mx.DAQmx_Val_ChanPerLine)
+        assert quant in switches, "Error: Unknown quantity"
+        channels, sense, states = switches[quant]
 
-            #This does the measurement and updates the values created above
-            readChan.ReadDigitalLines(1, 0, mx.DAQmx_Val_GroupByScanNumber, retVal, 2, mx.byref(
-                sampsPer), mx.byref(numBytesPer), None)
+        retVal = session.read_lines(sense)
 
-            #Memory management!
-            readChan.ClearTask()
+        assert not all(retVal) and any(
+            retVal), "Both channels should not be the same!"
 
-            assert not all(retVal) and any(
-                retVal), "Both channels should not be the same!"
+        key = tuple([int(v) for v in retVal])
+        assert key in states, "Error: unexpected value returned "+repr(retVal)
 
-            if all(retVal == [0, 1]):
-                value = "Mag Cycle"
-            elif all(retVal == [1, 0]):
-                value = "Regulate"
-            else:
-                assert False, "Error: unexpected value returned "+repr(retVal)
-
-        elif quant == '5 Ohm Resistor':
-            #Create some values to put things in
-            retVal = np.zeros(2, dtype=np.uint8)
-            sampsPer = mx.int32()
-            numBytesPer = mx.int32()
-
-            #Create a new task
-            readChan = mx.Task()
-            readChan.CreateDIChan(
-                'ADR_RESISTOR_BOX/port2/line2:3', '', mx.DAQmx_Val_ChanPerLine)
-
-            #This does the measurement and updates the values created above
-            readChan.ReadDigitalLines(1, 0, mx.DAQmx_Val_GroupByScanNumber, retVal, 2, mx.byref(
-                sampsPer), mx.byref(numBytesPer), None)
-
-            #Memory management!
-            readChan.ClearTask()
-
-            assert not all(retVal) and any(
-                retVal), "Both channels should not be the same!"
-
-            if all(retVal == [0, 1]):
-                value = "5 Ohm in"
-            elif all(retVal == [1, 0]):
-                value = "5 Ohm out"
-            else:
-                assert False, "Error: unexpected value returned "+repr(retVal)
-
-        elif quant == '10 Ohm Resistor':
-            #Create some values to put things in
-            retVal = np.zeros(2, dtype=np.uint8)
-            sampsPer = mx.int32()
-            numBytesPer = mx.int32()
-
-            #Create a new task
-            readChan = mx.Task()
-            readChan.CreateDIChan(
-                'ADR_RESISTOR_BOX/port2/line4:5', '', mx.DAQmx_Val_ChanPerLine)
-
-            #This does the measurement and updates the values created above
-            readChan.ReadDigitalLines(1, 0, mx.DAQmx_Val_GroupByScanNumber, retVal, 2, mx.byref(
-                sampsPer), mx.byref(numBytesPer), None)
-
-            #Memory management!
-            readChan.ClearTask()
-
-            assert not all(retVal) and any(
-                retVal), "Both channels should not be the same!"
-
-            if all(retVal == [0, 1]):
-                value = "10 Ohm in"
-            elif all(retVal == [1, 0]):
-                value = "10 Ohm out"
-            else:
-                assert False, "Error: unexpected value returned "+repr(retVal)
-
-        elif quant == '25 Ohm Resistor':
-            #Create some values to put things in
-            retVal = np.zeros(2, dtype=np.uint8)
-            sampsPer = mx.int32()
-            numBytesPer = mx.int32()
-
-            #Create a new task
-            readChan = mx.Task()
-            readChan.CreateDIChan(
-                'ADR_RESISTOR_BOX/port2/line6:7', '', mx.DAQmx_Val_ChanPerLine)
-
-            #This does the measurement and updates the values created above
-            readChan.ReadDigitalLines(1, 0, mx.DAQmx_Val_GroupByScanNumber, retVal, 2, mx.byref(
-                sampsPer), mx.byref(numBytesPer), None)
-
-            #Memory management!
-            readChan.ClearTask()
-
-            assert not all(retVal) and any(
-                retVal), "Both channels should not be the same!"
-
-            if all(retVal == [0, 1]):
-                value = "25 Ohm in"
-            elif all(retVal == [1, 0]):
-                value = "25 Ohm out"
-            else:
-                assert False, "Error: unexpected value returned "+repr(retVal)
-        else:
-            assert False, "Error: Unknown quantity"
-
-        return value
+        return states[key]
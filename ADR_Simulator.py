@@ -0,0 +1,378 @@
+# -*- coding: utf-8 -*-
+"""
+Lumped element model of the magnet and the ADR, to try ramp rates, soak
+times, lead_resistance guesses, ... without a cryostat cycle.
+
+    Kepco:       V = V_GAIN * SIM960 output
+    Magnet:      V = I*R_lead + L*dI/dt, B = field_per_amp * I
+    Salt pill:   FAA (ferric ammonium alum, J = 5/2) paramagnet,
+                 T dS/dt = heat switch conduction + parasitic + eddy heating
+    Heat switch: conductance to the 4K bath, closed or open, moved through
+                 HPD_Heat_Switch on daqmx_emulator DIO lines
+
+The model runs on a SteppedClock, which only moves on when the code waits
+on it, or a VirtualClock that runs at speedup times real time. Two ways to
+hook it up:
+
+Straight to the magnet code, no serial ports, as fast as it goes. sim900,
+sim960 and sim970 here stand in for the drivers:
+>>> sim = ADRSimulator()
+>>> mag = ADR_MAG(sim.config(), heat_switch=sim.heat_switch, clock=sim.clock)
+>>> await mag.start(magup_time=30, magsoak_time=60, magdown_time=60)
+>>> await mag.task; print(sim.physics.report())
+
+Or as the signals of the SIM900 emulator, so the DAQ and ADR_run run on the
+real drivers against it (at a speedup the pty round trips can keep up with):
+    python ADR_Simulator.py --emulator [speedup]
+
+Or run a mag cycle and print the predicted FAA temperatures and hold time:
+    python ADR_Simulator.py [speedup]
+
+On a VirtualClock the host's own time is scaled up too: every ms spent
+computing is speedup ms of magnet time the ramp engine doesn't see coming,
+so a loaded host, or much over 100x, gives ramps and soaks that wouldn't
+happen on the cryostat. Leave speedup out to get the SteppedClock, which
+doesn't have that problem and gives the same results however fast the host
+is.
+
+The parameters are a starting point, not a fit to our cryostat.
+"""
+
+import asyncio as aio
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from ADR_Ramp import RealClock
+from ADR_Ramp_Profile import V_GAIN
+from daqmx_session import DIOSession
+from daqmx_emulator import DAQmxEmulator
+import HPD_Heat_Switch
+
+R_GAS = 8.314 # J/K/mol
+MU_B_K = 0.6717 # Bohr magneton over Boltzmann constant, K/T
+
+
+####################################################################
+class VirtualClock(RealClock):
+    def __init__(self, speedup=1.):
+        self.speedup = speedup
+        self.m0 = time.monotonic()
+        self.t0 = time.time()
+
+    def monotonic(self):
+        return self.from_real(time.monotonic())
+
+    def time(self):
+        return self.t0 + (time.monotonic() - self.m0)*self.speedup
+
+    # Clock time at real time.monotonic() m
+    def from_real(self, m):
+        return self.m0 + (m - self.m0)*self.speedup
+
+    def sleep_time(self, dt):
+        return dt/self.speedup
+
+
+# Time that only passes when someone waits: sleep_time(dt) moves the clock
+# on by dt and returns 0, so the computing in between takes no time at all.
+# That's only right when one thing at a time is waiting on the clock, as in
+# a mag cycle without the DAQ (the ramp updates, the soak and the heat switch
+# polls take turns). Waits cut short (abort, a rate change) still count in
+# full.
+class SteppedClock(RealClock):
+    speedup = np.inf
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.m = time.monotonic()
+        self.t0 = time.time() - self.m
+
+    def monotonic(self):
+        return self.m
+
+    def time(self):
+        return self.t0 + self.m
+
+    def sleep_time(self, dt):
+        with self.lock:
+            self.m += max(dt, 0.)
+        return 0.
+
+
+####################################################################
+# Paramagnet entropy, per mole over R, as a function of
+# x = g*mu_B*B_eff/(k*T) only
+def _log_sinh(y):
+    return y + np.log1p(-np.exp(-2*y)) - np.log(2)
+
+def spin_entropy(x, J=2.5):
+    a = (2*J + 1)/2
+    lnZ = _log_sinh(a*x) - _log_sinh(x/2)
+    dlnZ = a/np.tanh(a*x) - 0.5/np.tanh(x/2)
+    return lnZ - x*dlnZ
+
+
+class ADRPhysics():
+    defaults = {'L':20., # H, magnet inductance. Guess
+                'R_lead':1.2, # Ohm, last measured Aug 2024
+                'V_gain':V_GAIN,
+                'field_per_amp':4./9, # T/A, 4 T at 9 A. Guess
+                'n_faa':0.2, # mol of FAA in the pill
+                'J':2.5, 'g':2.,
+                'b_int':0.05, # T, FAA internal field
+                'T_bath':3.5, # K, what the heat switch connects to
+                'G_closed':5e-3, # W/K, heat switch closed
+                'G_open':2e-8, # W/K, heat switch open
+                'Q_parasitic':1e-6, # W, radiation and supports
+                'eddy_coeff':0.04, # W per (A/s)^2
+                'current_scale':1.0, # A per V on Sim970 MagCurr, as ADR_Config.mag_current_scale
+                'emf_scale':1.0, # V per V on Sim970 EMF, as ADR_Config.mag_emf_scale
+                'max_step':0.1} # s, longest integration step
+
+    def __init__(self, clock=None, **params):
+        self.p = dict(self.defaults)
+        self.p.update(params)
+        self.clock = RealClock() if clock is None else clock
+        self.lock = threading.RLock()
+        self.t = self.clock.monotonic()
+        self.I = 0.
+        self.V960 = 0.
+        self.mout = lambda: self.V960 # SIM960 output, replaced by attach()
+        self.hs_closed = True
+        self.T = self.p['T_bath']
+        self.S = self.entropy(0., self.T)
+        self.rate = 0. # dI/dt
+        self.Q = 0. # W into the pill
+        self.history = [] # (t, I, B, T, Q, hs_closed) every history_interval
+        self.history_interval = 10.
+        # x against entropy for solving T from S
+        self.x_table = np.logspace(-4, np.log10(300), 4000)
+        self.s_table = spin_entropy(self.x_table, self.p['J'])[::-1] # Increasing
+
+    def B(self, I=None):
+        return self.p['field_per_amp']*(self.I if I is None else I)
+
+    def x(self, B, T):
+        return self.p['g']*MU_B_K*np.sqrt(B**2 + self.p['b_int']**2)/T
+
+    def entropy(self, B, T):
+        return self.p['n_faa']*R_GAS*spin_entropy(self.x(B, T), self.p['J'])
+
+    def temperature(self, S, B):
+        s = S/(self.p['n_faa']*R_GAS)
+        x = np.interp(s, self.s_table, self.x_table[::-1])
+        return self.p['g']*MU_B_K*np.sqrt(B**2 + self.p['b_int']**2)/x
+
+    def heat_load(self, T, rate=0., hs_closed=None):
+        hs_closed = self.hs_closed if hs_closed is None else hs_closed
+        G = self.p['G_closed'] if hs_closed else self.p['G_open']
+        return G*(self.p['T_bath'] - T) + self.p['Q_parasitic'] + self.p['eddy_coeff']*rate**2
+
+    # Run the model forward to clock time t, with the present inputs
+    def advance(self, t=None):
+        t = self.clock.monotonic() if t is None else t
+        with self.lock:
+            V = self.p['V_gain']*self.mout()
+            R, L = self.p['R_lead'], self.p['L']
+            while self.t < t:
+                dt = min(t - self.t, self.p['max_step'])
+                I = V/R + (self.I - V/R)*np.exp(-dt*R/L)
+                self.rate = (I - self.I)/dt
+                self.I = I
+                self.Q = self.heat_load(self.T, self.rate)
+                self.S += self.Q/self.T*dt
+                self.T = self.temperature(self.S, self.B())
+                self.t += dt
+                if not self.history or self.t - self.history[-1][0] >= self.history_interval:
+                    self.history.append((self.t, self.I, self.B(), self.T, self.Q, self.hs_closed))
+            self.rate = (V - self.I*R)/L
+
+    def set_heat_switch(self, closed):
+        with self.lock:
+            self.advance()
+            self.hs_closed = closed
+
+    def set_output(self, V960):
+        with self.lock:
+            self.advance()
+            self.V960 = V960
+
+    # Sim970 channels 1-4: EMF, MagCurr, MagVolt, Pressure
+    def sim970_volts(self, pressure=2.0):
+        V = self.p['V_gain']*self.mout()
+        return [self.p['L']*self.rate/self.p['emf_scale'], self.I/self.p['current_scale'], V, pressure]
+
+    def hold_time(self, T_reg=0.1):
+        """
+        s the pill can be regulated at T_reg from its present entropy,
+        taking the field down to zero, with the heat switch open.
+        """
+        S_max = self.entropy(0., T_reg)
+        if self.S >= S_max:
+            return 0.
+        return T_reg*(S_max - self.S)/self.heat_load(T_reg, hs_closed=False)
+
+    def report(self, T_reg=0.1):
+        T = np.array([h[3] for h in self.history] + [self.T])
+        return {'I':self.I, 'B':self.B(), 'T_faa':self.T, 'T_min':np.min(T),
+                'hold_time':self.hold_time(T_reg), 'T_reg':T_reg}
+
+    def attach(self, modules):
+        """
+        Drive the SIM900 emulator's modules (SIM900_emulator.default_modules())
+        from the model: the SIM960 output in, magnet and FAA readings out.
+        """
+        sim960, sim970, sim921 = modules['3'], modules['7'], modules['1']
+        self.mout = lambda: sim960.measure('OMON', None, 0.)
+        pressure = sim970.values.get(('VOLT', 4), 2.0)
+        def signal(func):
+            def value(t):
+                self.advance(max(self.clock.from_real(t), self.t))
+                return func()
+            return value
+        for c in range(3):
+            sim970.signals[('VOLT', c+1)] = signal(lambda c=c: self.sim970_volts(pressure)[c])
+        sim921.signals[('TVAL', None)] = signal(lambda: self.T)
+        sim960.signals[('MMON', None)] = signal(lambda: self.T) # PID input, 1 V/K
+
+
+####################################################################
+# Stand-ins for the drivers, straight onto the model
+
+class SimRequest():
+    def __init__(self, func):
+        self.func = func
+
+
+class SimSIM900():
+    def __init__(self, physics):
+        self.physics = physics
+
+    def read_requests(self, requests, priority=None):
+        self.physics.advance()
+        return [req.func() for req in requests]
+
+    def read_request(self, req, priority=None):
+        return self.read_requests([req])[0]
+
+
+class SimSIM960():
+    priority = 0 # PRIORITY_CONTROL
+
+    def __init__(self, parent):
+        self.parent = parent
+        self.physics = parent.physics
+
+    def req_OMON(self):
+        return SimRequest(lambda: self.physics.V960)
+
+    def get_OMON(self):
+        return self.parent.read_request(self.req_OMON())
+
+    def get_MMON(self):
+        return self.parent.read_request(SimRequest(lambda: self.physics.T))
+
+    def set_MOUT(self, value):
+        self.physics.set_output(float(value))
+
+
+class SimSIM970():
+    priority = 1 # PRIORITY_MONITOR
+
+    def __init__(self, parent):
+        self.parent = parent
+        self.physics = parent.physics
+
+    def req_VOLT(self, c, n=1):
+        if c == 0:
+            return SimRequest(lambda: self.physics.sim970_volts())
+        return SimRequest(lambda: self.physics.sim970_volts()[c-1])
+
+    def get_VOLT(self, c, n=1):
+        return self.parent.read_request(self.req_VOLT(c, n))
+
+
+class ADRSimulator():
+    # speedup None for a SteppedClock
+    def __init__(self, speedup=None, **params):
+        self.clock = SteppedClock() if speedup is None else VirtualClock(speedup)
+        self.physics = ADRPhysics(self.clock, **params)
+        self.sim900 = SimSIM900(self.physics)
+        self.sim960 = SimSIM960(self.sim900)
+        self.sim970 = SimSIM970(self.sim900)
+        # The heat switch driver itself, on emulated DIO lines moving the
+        # model's switch. They're on a session of their own, the process's
+        # DIO session stays on whatever it was on.
+        self.dio = DAQmxEmulator(self.clock, hs_closed=self.physics.hs_closed,
+                                 on_heat_switch=self.physics.set_heat_switch)
+        self.session = DIOSession(self.dio)
+        self.heat_switch = HPD_Heat_Switch.on_session(self.session)
+
+    def config(self, checkpoint_file=None):
+        """
+        ADR_Config with the simulated instruments in it, for ADR_MAG.
+        """
+        from ADR_Config import ADR_Config
+        cg = ADR_Config()
+        cg.sim900, cg.sim960, cg.sim970 = self.sim900, self.sim960, self.sim970
+        cg.lead_resistance = self.physics.p['R_lead']
+        cg.mag_current_scale = self.physics.p['current_scale']
+        cg.mag_emf_scale = self.physics.p['emf_scale']
+        if checkpoint_file is None:
+            checkpoint_file = os.path.join(tempfile.gettempdir(), 'adr_sim_checkpoint.json')
+        cg.mag_checkpoint_file = checkpoint_file
+        return cg
+
+
+async def simulate_mag_cycle(speedup=None, T_reg=0.1, params={}, **cycle):
+    """
+    Run ADR_MAG's mag cycle (see mag_cycle_steps for the arguments) on the
+    model and return the report and the model's history.
+    """
+    from ADR_Magnet_Control import ADR_MAG
+    sim = ADRSimulator(speedup, **params)
+    mag = ADR_MAG(sim.config(), heat_switch=sim.heat_switch, clock=sim.clock)
+    mag.verbose = False
+    t0 = sim.clock.monotonic()
+    await mag.start(**cycle)
+    await mag.task
+    sim.physics.advance()
+    report = sim.physics.report(T_reg)
+    report['cycle_time'] = sim.clock.monotonic() - t0
+    return report, np.array(sim.physics.history)
+
+
+if __name__ == '__main__':
+    args = [a for a in sys.argv[1:] if not a.startswith('--')]
+    if '--emulator' in sys.argv:
+        from SIM900_emulator import SIM900Emulator
+        clock = VirtualClock(float(args[0]) if args else 10.)
+        physics = ADRPhysics(clock)
+        emu = SIM900Emulator()
+        physics.attach(emu.modules)
+        emu.start()
+        print(f'SIM900 emulator with the ADR model on {emu.port_name}, {clock.speedup:g}x')
+        print(f'SIM900_ADDRESS={emu.visa_address} SIM900_VISALIB=@py ADR_DIO_BACKEND=emulator')
+        try:
+            while True:
+                time.sleep(10)
+                physics.advance()
+                print(f"I = {physics.I:.3f} A, T_FAA = {physics.T*1000:.1f} mK")
+        except KeyboardInterrupt:
+            pass
+        emu.close()
+    else:
+        speedup = float(args[0]) if args else None
+        t0 = time.perf_counter()
+        report, history = aio.run(simulate_mag_cycle(speedup, magup_time=30, magsoak_time=60, magdown_time=60))
+        print(f"Mag cycle: {report['cycle_time']/60:.1f} min simulated in {time.perf_counter()-t0:.1f} s")
+        print(f"FAA at the end {report['T_faa']*1000:.1f} mK, lowest {report['T_min']*1000:.1f} mK")
+        print(f"Hold time at {report['T_reg']*1000:.0f} mK: {report['hold_time']/3600:.1f} h")
+        for t, I, B, T, Q, hs_closed in history[::max(len(history)//20, 1)]:
+            print(f"  {(t-history[0][0])/60:6.1f} min  I = {I:6.3f} A  T = {T*1000:8.1f} mK  "
+                  f"Q = {Q*1e6:9.2f} uW  {'closed' if hs_closed else 'open'}")
@@ -13,22 +13,24 @@ from HPD_Heat_Switch import Driver as hs
 from ADR_Resistor_Box import Driver as rb
 #from SRS_SIM9XX_v3 import SIM900, SIM960, SIM921, SIM922, SIM925, SIM970
 
-from ADR_DAQ import ADR_DAQ
+from ADR_DAQ import ADR_DAQ, arc
+from ADR_Ramp import SAFE_RAMP_RATE, V_GAIN
+from ADR_Magnet_Control import ADR_MAG
 import asyncio as aio
 daq = ADR_DAQ()
 
 daq_task = aio.create_task(daq.start())
 
 #%
-SAFE_RAMP_RATE = 5.6e-3 #Amps/second
-V_GAIN = 2 # Kepco V = 2 * SIM960
-
 sim960 = daq.adr_config.sim960
 #sim925 = daq.adr_config.sim925
 
 #%% Reinit the FAA thermometer
 # Do this whenever we go above 5K.
 sim921 = daq.adr_config.sim921
+# The cached EXCI may already say 3 whatever the module is at now, and
+# set_EXCI skips a write to what's cached, so forget it first.
+sim921.invalidate_cache('EXCI')
 sim921.set_EXCI(3)
 
 #%% Turn off the pulse tube
@@ -56,72 +58,27 @@ rb.performSetValue('Relay Position', 'Mag Cycle')
 
 #%% Define Mag ramp
 # -- Mag ramp
+# Closed loop on the measured magnet current (see ADR_Ramp), run as a task
+# next to the DAQ. mag.pause(), mag.resume(), mag.change_rate(rate) and
+# mag.abort() act on the ramp or soak in progress.
+mag = ADR_MAG(daq.adr_config, arc)
+
 async def ramp_mag(final_magnet_current=0, time_to_final_voltage=30,
-             lead_resistance=1.2):
+             lead_resistance=None):
     # final_magnet_current = 9 # Amp
     # time_to_final_voltage = 30 # min
-    # lead_resistance last measured in Aug 2024 by James C.
-
-    V960 = sim960.get_OMON() # output voltage
-    Imag = V960 * V_GAIN / lead_resistance
-    ramp_irate = np.abs((final_magnet_current - Imag)/(time_to_final_voltage*60))
-    assert  ramp_irate <= SAFE_RAMP_RATE, 'Mag-up rate exceeds limit'
-
-    final_kepco_voltage = final_magnet_current * lead_resistance
-    print('Ramp from {:.3f} V to {:.3f} V in {:.2f} minutes'.format(
-        V960*V_GAIN, final_kepco_voltage, time_to_final_voltage))
-
-    ramp_vstep_960 = 0.01 * np.sign(final_kepco_voltage/V_GAIN - V960) # V
-    ramp_tstep = np.abs(ramp_vstep_960 * V_GAIN / lead_resistance / ramp_irate)
-    print(ramp_tstep)
-    set_points = np.arange(V960, final_kepco_voltage/V_GAIN, ramp_vstep_960)
-    if np.abs(final_kepco_voltage/V_GAIN - set_points[-1]) > 0.0005:
-        set_points = np.append(set_points, int(final_kepco_voltage/V_GAIN*1000)/1000) # to mV resolution
-
-    t0 = time.time()
-    for V960_set in set_points:
-        sim960.set_MOUT(V960_set)
-        t = time.time()
-        print('t = {:.2f} min, V_Kepco = {:.3f} V'.format((t-t0)/60, V960_set*V_GAIN))
-        await aio.sleep(ramp_tstep)
-        V960 = sim960.get_OMON()
-        print(V960_set, V960)
-        assert np.abs(V960-V960_set) < 0.005, 'SIM960 output is not tracing set point'
-            
-    print('Ramp Mag finished')
+    # lead_resistance is only a starting guess now, the engine measures it.
+    if lead_resistance is not None:
+        mag.engine.estimator.R = lead_resistance
+    await mag.start_ramp(final_magnet_current, time_to_final_voltage)
+    return await mag.task
 
 
-async def do_mag_cycle(magup_time=30, magsoak_time=60, magdown_time=60, is_first_cycle=False, final_max_current=9, lead_resistance=1.2):
+async def do_mag_cycle(magup_time=30, magsoak_time=60, magdown_time=60, is_first_cycle=False, final_max_current=9):
     # All times in args are in minutes.
-    
-    # Note: the mag ramp code is borrowed from previous ADR user. To-do: rewrite.
-    # Have all of the current/voltage info... Why do we not use it?
-    
-    if is_first_cycle: # Make sure the heat switch is closed
-        hs.performSetValue('Heat Switch', 'Open')
-        hs.performSetValue('Heat Switch', 'Close')
-    
-    await ramp_mag(final_magnet_current=final_max_current,time_to_final_voltage=magup_time,lead_resistance=lead_resistance)
-    
-    # reset the heat switch since the magnet will have put tension on things.
-    hs.performSetValue('Heat Switch', 'Open')
-    hs.performSetValue('Heat Switch', 'Close')
-    
-    # Soak the magnet
-    comp_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    print(f'Mag Up completed at:\n{comp_time}')
-    print(f'Soaking until for {magsoak_time} minutes.')
-    #print('Use mag.stop to stop or mag.pause to pause in the terminal.')
-    await aio.sleep(magsoak_time*60) # make this into a breakable loop when we put it into a class.
-    
-    hs.performSetValue('Heat Switch', 'Open')
-        
-    await ramp_mag(final_magnet_current=0,time_to_final_voltage=magdown_time,lead_resistance=lead_resistance)
-    
-    comp_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    print(f'Mag Down completed at:\n{comp_time}')
-    
-    return
+    await mag.start(magup_time=magup_time, magsoak_time=magsoak_time, magdown_time=magdown_time,
+                    is_first_cycle=is_first_cycle, final_max_current=final_max_current)
+    return await mag.task
 
 
 
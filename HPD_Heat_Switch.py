@@ -1,97 +1,84 @@
-import time
-import numpy as np
-import PyDAQmx as mx
+import asyncio as aio
+import threading
+from concurrent.futures import Future
+from daqmx_session import session
 
+poll_interval = 0.05 # s between limit line reads while the switch moves
 
-class Driver():
+# Lines pulsed to open or close the switch (1 is on), and the limit lines
+# that are both high once it gets there
+move_lines = {'Open':'ADR_DIO/port1/line1',
+              'Close':'ADR_DIO/port1/line2'}
+limit_lines = 'ADR_DIO/port0/line0:1'
 
-    def performOpen(options={}):
-        """Reset the DIO, and then set lines to low in this order: 1/1, 1/2, 1/0."""
 
-        mx.DAQmxResetDevice('ADR_DIO')
+class Driver():
+    session = session # The DIO lines, see on_session for others
 
-        # The value to set
-        setVal0 = np.array([0], dtype=np.uint8)
+    @classmethod
+    def performOpen(cls, options={}):
+        """Reset the DIO, and then set lines to low in this order: 1/1, 1/2, 1/0."""
 
-        # A placeholder to catch the return data of samples written
-        sampsPer = mx.int32()
+        cls.session.reset_device('ADR_DIO')
 
-        # Set up the task
         channels = ['ADR_DIO/port1/line1',  # Lines 1 & 2 controls the heat switch relay -jz
                     'ADR_DIO/port1/line2',
                     'ADR_DIO/port1/line0']
 
         # Set the channels to low in the appropriate order
         for channel in channels:
-            writeChan = mx.Task()
-            writeChan.CreateDOChan(channel, '', mx.DAQmx_Val_ChanPerLine)
-            writeChan.WriteDigitalLines(1, mx.bool32(
-                True), 0, mx.DAQmx_Val_GroupByScanNumber, setVal0, mx.byref(sampsPer), None)
-            writeChan.ClearTask()
+            cls.session.write_lines(channel, 0)
 
-    def performSetValue(quant, value, sweepRate=0.0, options={}):
-        """Create task, set value, close task."""
+    @classmethod
+    def performSetValue(cls, quant, value, sweepRate=0.0, options={}):
+        """Pulse the open/close line, then wait for the limit lines."""
 
         if quant == 'Heat Switch':
-            if value == 'Open':
-                channel = 'ADR_DIO/port1/line1'
-                duration = 4.8  # seconds
-            elif value == 'Close':
-                channel = 'ADR_DIO/port1/line2'
-                duration = 3.8  # seconds
-            else:
-                assert False, "Error, bad value"
-
-            # Create a new task
-            writeChan = mx.Task()
-            writeChan.CreateDOChan(channel, '', mx.DAQmx_Val_ChanPerLine)
-
-            setVal0 = np.array([0], dtype=np.uint8)
-            setVal1 = np.array([1], dtype=np.uint8)
-            sampsPer = mx.int32()
-
-            # Send a 100 ms pulse to the appropriate channel (1 is on)
-            writeChan.WriteDigitalLines(1, mx.bool32(
-                True), 0, mx.DAQmx_Val_GroupByScanNumber, setVal1, mx.byref(sampsPer), None)
-            time.sleep(0.1)
-
-            # Set it back to low (0 is off)
-            writeChan.WriteDigitalLines(1, mx.bool32(
-                True), 0, mx.DAQmx_Val_GroupByScanNumber, setVal0, mx.byref(sampsPer), None)
-
-            # Memory Management!
-            writeChan.ClearTask()
-
-            # Now set up a task to monitor the Opening/Closing lines (port0 lines 0,1)
-            # We want to block the program until it is finished
-
-            # Default to ones so that if it's already closed it will pick that up right away
-            monVal = np.ones(2, dtype=np.uint8)
-            sampsPer = mx.int32()
-            numBytesPer = mx.int32()
-            monitorToggle = mx.Task()
-            monitorToggle.CreateDIChan(
-                'ADR_DIO/port0/line0:1', '', mx.DAQmx_Val_ChanPerLine)
-
-            isToggling = True
-            startTime = time.time()
-            while isToggling == True:
-                monitorToggle.ReadDigitalLines(1, 0, mx.DAQmx_Val_GroupByScanNumber, monVal, 2, mx.byref(
-                    sampsPer), mx.byref(numBytesPer), None)
-                if all(monVal):
-                    isToggling = False
-                time.sleep(0.2)
-
-                # Report progress hates values greater than 1?
-                if (time.time()-startTime)/duration < 1.0:
-                    print((time.time()-startTime)/duration)
-
-            monitorToggle.ClearTask()
+            cls.startMove(value).result()
 
         return value
 
-    def performGetValue(quant, options={}):
-        """Create task, get value, close task."""
+    @classmethod
+    def startMove(cls, value, timeout=10.0):
+        """
+        Start opening or closing the heat switch and return straight away.
+
+        Returns a concurrent.futures.Future that a background thread resolves
+        with the move time in seconds once the limit lines (port0 lines 0,1)
+        are both high, or with TimeoutError after timeout seconds. Times
+        are on the session backend's clock.
+        """
+        assert value in move_lines, "Error, bad value"
+        channel = move_lines[value]
+        session = cls.session
+
+        future = Future()
+        future.set_running_or_notify_cancel()
+
+        def watch():
+            try:
+                # Send a 100 ms pulse to the appropriate channel (1 is on)
+                startTime = session.monotonic()
+                session.pulse(channel, on=1, off=0)
+                while not all(session.read_lines(limit_lines)):
+                    if session.monotonic() - startTime > timeout:
+                        raise TimeoutError(f"Heat switch didn't {value.lower()} in {timeout} s")
+                    session.sleep(poll_interval)
+                future.set_result(session.monotonic() - startTime)
+            except Exception as err:
+                future.set_exception(err)
+
+        threading.Thread(target=watch, name='heat switch', daemon=True).start()
+        return future
+
+    @classmethod
+    async def move(cls, value, timeout=10.0):
+        """Open or close the heat switch without blocking the event loop. Returns the move time."""
+        return await aio.wrap_future(cls.startMove(value, timeout))
+
+    @classmethod
+    def performGetValue(cls, quant, options={}):
+        """Read the touch sensor line."""
 
         if quant == 'Touch 4K-1K':
             channel = 'ADR_DIO/port0/line2'
@@ -102,22 +89,7 @@ class Driver():
         else:
             assert False, "Error: unknown quantity"
 
-        # Create some values to put things in
-        retVal = np.zeros(1, dtype=np.uint8)
-        sampsPer = mx.int32()
-        numBytesPer = mx.int32()
-
-        # Create a new task
-        readChan = mx.Task()
-
-        readChan.CreateDIChan(channel, '', mx.DAQmx_Val_ChanPerLine)
-
-        # This does the measurement and updates the values created above
-        readChan.ReadDigitalLines(1, 0, mx.DAQmx_Val_GroupByScanNumber, retVal, 1, mx.byref(
-            sampsPer), mx.byref(numBytesPer), None)
-
-        # Memory management!
-        readChan.ClearTask()
+        retVal = cls.session.read_lines(channel)
 
         if retVal == [0]:
             value = "Touch"
@@ -126,4 +98,12 @@ class Driver():
         else:
             assert False, "Error: unexpected value returned "+repr(retVal)
 
-        return value
\ No newline at end of file
+        return value
+
+
+# The driver on another DIO session, e.g. DIOSession(DAQmxEmulator(...)),
+# leaving the process's session alone
+def on_session(dio_session):
+    class SessionDriver(Driver):
+        session = dio_session
+    return SessionDriver
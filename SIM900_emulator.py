@@ -0,0 +1,384 @@
+# -*- coding: utf-8 -*-
+"""
+Emulator of the SIM900 mainframe and the modules we use in it, on a pty.
+
+The driver in SRS_SIM9XX_v3 runs against it unchanged. Point it at the
+emulator with environment variables before it is imported:
+
+>>> from SIM900_emulator import SIM900Emulator
+>>> emu = SIM900Emulator().start()
+>>> os.environ['SIM900_ADDRESS'] = emu.visa_address
+>>> os.environ['SIM900_VISALIB'] = '@py'
+>>> from SRS_SIM9XX_v3 import SIM900, SIM921
+
+Or run this file to start an emulator and time the driver against it:
+    python SIM900_emulator.py [--serve]
+
+Mainframe commands: *IDN?, TERM, TERM?, FLSH, SNDT, NINP?, RAWN?, GETN?, CONN.
+Every port has its own output buffer. Module replies only land in it after
+the module's response delay, and n > 1 readings arrive one reading_time apart,
+so the polling and batching in the driver see realistic timing.
+
+Measurement values come from module.values, or from module.signals if a
+function of time is set there (e.g. by a physics simulator).
+
+Needs pyvisa-py for the driver side (SIM900_VISALIB=@py).
+"""
+
+import os
+import sys
+import threading
+import time
+from collections import deque
+
+from pty_emulator import PtyEmulator
+
+
+####################################################################
+class SIMModuleModel():
+    """
+    Generic SIM module. Settings are stored as the strings that were sent,
+    and queries of a setting return them. Measurements come from values
+    or signals.
+    """
+    name = 'SIM9XX'
+    response_delay = 0.02 # s from the end of a query to its reply
+    reading_time = 0.1 # s between streamed readings
+    nchannels = 0 # Modules with channels take "CMD? c" and "CMD c,value"
+    defaults = dict()
+    channel_settings = [] # Settings that are per channel
+    measurements = [] # Queries that are read from values/signals
+
+    def __init__(self):
+        self.settings = dict(self.defaults)
+        for name in self.channel_settings:
+            for c in range(1, self.nchannels+1):
+                self.settings.setdefault((name, c), self.settings.get(name, '0'))
+        self.values = dict() # (name, channel): value
+        self.signals = dict() # (name, channel): function of time giving the value
+        self.output = deque() # (time due, bytes)
+        self.lock = threading.Lock()
+
+    def idn(self):
+        return f'Stanford_Research_Systems,{self.name},s/n000000,ver2.0'
+
+    def measure(self, name, c, t):
+        if (name, c) in self.signals:
+            return self.signals[(name, c)](t)
+        return self.values.get((name, c), 0.0)
+
+    def reading(self, name, c, t):
+        if c == 0:
+            return ','.join([f'{self.measure(name, _c, t):+.6E}' for _c in range(1, self.nchannels+1)])
+        return f'{self.measure(name, c, t):+.6E}'
+
+    def reply(self, due, text):
+        self.output.append((due, (text + '\r\n').encode()))
+
+    def write(self, msg, now):
+        """Handle one command line sent to the module."""
+        msg = msg.strip()
+        if not msg:
+            return
+        head, _, args = msg.partition(' ')
+        args = [_a.strip() for _a in args.split(',')] if args.strip() else []
+        due = now + self.response_delay
+        with self.lock:
+            if head == '*IDN?':
+                self.reply(due, self.idn())
+            elif head == 'SOUT': # Stop streaming
+                self.output.clear()
+            elif head.endswith('?'):
+                self.query(head[:-1], args, due)
+            else:
+                self.set(head, args)
+
+    def query(self, name, args, due):
+        if name in self.measurements:
+            if self.nchannels:
+                c = int(args[0]) if args else 1
+                n = int(args[1]) if len(args) > 1 else 1
+            else:
+                c = None
+                n = int(args[0]) if args else 1
+            for _i in range(n):
+                t = due + _i*self.reading_time
+                self.reply(t, self.reading(name, c, t))
+        elif name in self.channel_settings:
+            c = int(args[0])
+            if c == 0:
+                self.reply(due, ','.join([self.settings[(name, _c)] for _c in range(1, self.nchannels+1)]))
+            else:
+                self.reply(due, self.settings[(name, c)])
+        elif name in self.settings:
+            self.reply(due, self.settings[name])
+        # Unknown queries get no reply, like a command error on the module
+
+    def set(self, name, args):
+        if name in self.channel_settings:
+            c, value = int(args[0]), args[1]
+            channels = range(1, self.nchannels+1) if c == 0 else [c]
+            for _c in channels:
+                self.settings[(name, _c)] = value
+        elif args:
+            self.settings[name] = args[0]
+
+    # Output that is due by now
+    def read_due(self, now):
+        out = bytearray()
+        with self.lock:
+            while self.output and self.output[0][0] <= now:
+                out += self.output.popleft()[1]
+        return bytes(out)
+
+    def flush(self):
+        with self.lock:
+            self.output.clear()
+
+
+class SIM921Model(SIMModuleModel):
+    name = 'SIM921'
+    response_delay = 0.03
+    reading_time = 0.3 # Display update at TCON 0
+    defaults = {'FREQ':'13.0', 'RANG':'6', 'EXCI':'3', 'CURV':'1', 'EXON':'1', 'MODE':'2',
+                'DISP':'0', 'AGAI':'1', 'ADIS':'1', 'TCON':'0'}
+    measurements = ['TVAL', 'RVAL', 'PHAS', 'IEXC', 'VEXC']
+
+    def __init__(self):
+        super().__init__()
+        self.values[('TVAL', None)] = 0.100
+        self.values[('RVAL', None)] = 5000.0
+
+
+class SIM922Model(SIMModuleModel):
+    name = 'SIM922'
+    response_delay = 0.25 # Needs to take the reading first
+    reading_time = 0.25
+    nchannels = 4
+    defaults = {'EXON':'1', 'CURV':'0', 'DISX':'0', 'DTEM':'0', 'TOKN':'0', 'LCME':'0',
+                'LEXE':'0', 'TERM':'2'}
+    channel_settings = ['EXON', 'CURV']
+    measurements = ['VOLT', 'TVAL']
+
+    def __init__(self):
+        super().__init__()
+        for c, T in zip(range(1, 5), [45.0, 4.2, 3.5, 3.6]):
+            self.values[('TVAL', c)] = T
+            self.values[('VOLT', c)] = 1.0
+
+
+class SIM925Model(SIMModuleModel):
+    name = 'SIM925'
+    defaults = {'MODE':'0', 'BPAS':'0', 'BUFR':'0', 'CHAN':'1'}
+
+
+class SIM960Model(SIMModuleModel):
+    name = 'SIM960'
+    defaults = {'GAIN':'1', 'INTG':'1', 'DERV':'0', 'AMAN':'0', 'PCTL':'1', 'ICTL':'1',
+                'DCTL':'0', 'OCTL':'0', 'RAMP':'0', 'INPT':'0', 'SETP':'0', 'MOUT':'0',
+                'ULIM':'10', 'LLIM':'-10'}
+    measurements = ['OMON', 'SMON', 'MMON', 'EMON']
+
+    def manual(self):
+        return self.settings['AMAN'] in ['0', 'MAN']
+
+    # In manual mode the output follows MOUT within the limits.
+    # There is no PID loop here; in PID mode the output holds where it was.
+    def measure(self, name, c, t):
+        if (name, c) in self.signals:
+            return self.signals[(name, c)](t)
+        if name == 'OMON':
+            if self.manual():
+                mout = float(self.settings['MOUT'])
+                self.values[('OMON', None)] = min(max(mout, float(self.settings['LLIM'])),
+                                                 float(self.settings['ULIM']))
+            return self.values.get(('OMON', None), 0.0)
+        elif name == 'SMON':
+            return float(self.settings['SETP'])
+        elif name == 'EMON':
+            return float(self.settings['SETP']) - self.measure('MMON', c, t)
+        return self.values.get((name, c), 0.0)
+
+
+class SIM970Model(SIMModuleModel):
+    name = 'SIM970'
+    response_delay = 0.05
+    reading_time = 0.05
+    nchannels = 4
+    measurements = ['VOLT']
+
+    def __init__(self):
+        super().__init__()
+        self.values[('VOLT', 4)] = 2.0 # Pressure gauge, ~1e-7 Torr
+
+
+# Ports as wired in our SIM900, see the module classes in SRS_SIM9XX_v3
+def default_modules():
+    return {'1':SIM921Model(), '3':SIM960Model(), '5':SIM922Model(),
+            '6':SIM925Model(), '7':SIM970Model()}
+
+
+####################################################################
+class SIM900Emulator(PtyEmulator):
+    idn = 'Stanford_Research_Systems,SIM900,s/n000000,ver3.6'
+
+    def __init__(self, modules=None):
+        super().__init__()
+        self.modules = default_modules() if modules is None else modules
+        self.buffers = dict([(port, bytearray()) for port in self.modules])
+        self.term = dict()
+        self.rx = bytearray()
+        self.conn = None # (port, escape string) while connected with CONN
+        self.commands = 0 # Host commands handled
+
+    def collect(self, now):
+        for port, module in self.modules.items():
+            self.buffers[port] += module.read_due(now)
+
+    def tick(self, now):
+        if self.conn is not None:
+            out = self.modules[self.conn[0]].read_due(now)
+            if out:
+                self.send(out)
+
+    def handle_bytes(self, data):
+        if self.conn is not None:
+            self.rx += data
+            port, escape = self.conn
+            idx = self.rx.find(escape)
+            if idx < 0:
+                # Whole lines go on to the module, keep anything that may be
+                # the start of the escape string
+                cut = self.rx.rfind(b'\n') + 1
+                lines, self.rx = self.rx[:cut], self.rx[cut:]
+            else:
+                lines, self.rx = self.rx[:idx], self.rx[idx+len(escape):]
+                self.conn = None
+            now = time.monotonic()
+            for line in lines.decode(errors='replace').split('\n'):
+                self.modules[port].write(line, now)
+            if self.conn is not None:
+                return
+            data = b''
+
+        self.rx += data
+        while b'\n' in self.rx:
+            line, _, self.rx = self.rx.partition(b'\n')
+            self.handle_line(line.decode(errors='replace').strip())
+            if self.conn is not None: # The rest is for the module
+                rest, self.rx = bytes(self.rx), bytearray()
+                self.handle_bytes(rest)
+                return
+
+    @staticmethod
+    def unquote(s):
+        s = s.strip()
+        if len(s) >= 2 and s[0] in '"\'' and s[-1] == s[0]:
+            s = s[1:-1]
+        return s
+
+    def handle_line(self, line):
+        if not line:
+            return
+        self.commands += 1
+        now = time.monotonic()
+        head, _, rest = line.partition(' ')
+        head = head.upper()
+        if head == '*IDN?':
+            self.send(self.idn + '\n')
+        elif head == 'TERM':
+            args = rest.split(',')
+            self.term[args[0].strip() if len(args) > 1 else 'D'] = args[-1].strip()
+        elif head == 'TERM?':
+            self.send(self.term.get(rest.strip() or 'D', 'LF') + '\n')
+        elif head == 'FLSH':
+            ports = [rest.strip()] if rest.strip() else list(self.modules)
+            for port in ports:
+                if port in self.modules:
+                    self.modules[port].flush()
+                    self.buffers[port].clear()
+        elif head == 'SNDT':
+            port, _, msg = rest.partition(',')
+            port = port.strip()
+            if port in self.modules:
+                self.modules[port].write(self.unquote(msg), now)
+        elif head == 'NINP?':
+            port = rest.strip()
+            self.collect(now)
+            self.send(f'{len(self.buffers.get(port, b""))}\n')
+        elif head in ['RAWN?', 'GETN?']:
+            port, _, n = rest.partition(',')
+            port = port.strip()
+            self.collect(now)
+            buf = self.buffers.get(port, bytearray())
+            out = bytes(buf[:int(n)])
+            del buf[:int(n)]
+            if head == 'GETN?':
+                out = f'#3{len(out):03d}'.encode() + out
+            self.send(out)
+        elif head == 'CONN':
+            port, _, escape = rest.partition(',')
+            port = port.strip()
+            if port in self.modules:
+                self.conn = (port, self.unquote(escape).encode())
+        # Anything else (*RST, *CLS, SRST, ...) is accepted and ignored
+
+
+####################################################################
+def bench(emu, nrep=20):
+    """Time the driver against the emulator, old fixed sleeps vs. polling."""
+    os.environ['SIM900_ADDRESS'] = emu.visa_address
+    os.environ.setdefault('SIM900_VISALIB', '@py')
+    from SRS_SIM9XX_v3 import SIM900, SIM921, SIM922, SIM970
+
+    sim921 = SIM921()
+    sim922 = SIM922()
+    sim970 = SIM970()
+
+    # What the getters used to do: SNDT, fixed wait, NINP?, wait, RAWN?, wait
+    def legacy_read(port, cmd, settle):
+        SIM900.host_write(f'SNDT {port},"{cmd}"')
+        time.sleep(settle)
+        time.sleep(0.05)
+        n = SIM900.get_NINP(port)
+        time.sleep(0.05)
+        return SIM900.get_RAWN(port, n)
+
+    def timeit(func):
+        t0 = time.perf_counter()
+        for _i in range(nrep):
+            func()
+        return (time.perf_counter() - t0)/nrep*1000
+
+    results = [
+        ('SIM921 TVAL?, fixed sleeps', timeit(lambda: legacy_read(1, 'TVAL?', 0.1))),
+        ('SIM921 TVAL?, polled', timeit(sim921.get_TVAL)),
+        ('SIM922 TVAL? 0, fixed sleeps', timeit(lambda: legacy_read(5, 'TVAL? 0,1', 0.5))),
+        ('SIM922 TVAL? 0, polled', timeit(lambda: sim922.get_TVAL(0))),
+        ('Sweep, one module at a time', timeit(lambda: [sim922.get_TVAL(0), sim921.get_TVAL(), sim970.get_VOLT(0)])),
+        ('Sweep, scatter-gather batch', timeit(lambda: SIM900.read_requests([sim922.req_TVAL(0), sim921.req_TVAL(), sim970.req_VOLT(0)]))),
+        ('SIM922 TVAL? 0,4 (4 readings)', timeit(lambda: sim922.get_TVAL(0, 4))),
+    ]
+    print(f'Emulator at {emu.visa_address}, mean of {nrep}')
+    for name, dt in results:
+        print(f'  {name:32s} {dt:8.1f} ms')
+    print('Latency per command (n, mean s, max s):')
+    for key, stats in SIM900.latency_stats().items():
+        print(f'  {key:8s} {stats}')
+    print('Bus:', SIM900.transport_stats())
+    SIM900.close()
+
+
+if __name__ == '__main__':
+    emu = SIM900Emulator().start()
+    if '--serve' in sys.argv:
+        print(f'SIM900 emulator on {emu.port_name}')
+        print(f'SIM900_ADDRESS={emu.visa_address} SIM900_VISALIB=@py')
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+    else:
+        bench(emu)
+    emu.close()
@@ -11,8 +11,18 @@ Created on Mon May 10 14:47:40 2021
 @author: svc_csi359876
 """
 
+import os
 import time
+import heapq
+import itertools
+import threading
+from collections import deque, namedtuple
+from contextlib import contextmanager
+import numpy as np
 from pyvisa.resources.serial import SerialInstrument
+from pyvisa.errors import VisaIOError
+
+import serial_trace
 
 from qcodes.instrument import (
     Instrument,
@@ -23,6 +33,80 @@ from qcodes.instrument import (
     InstrumentModule
 )
 
+# A module query for SIM9XX.read_requests.
+# nlines is the number of terminated lines in the reply (n > 1 readings
+# come back one per line) and timeout is the most we wait for all of them.
+SIMRequest = namedtuple('SIMRequest', ['port', 'cmd', 'parse', 'nlines', 'timeout'],
+                        defaults=[1, 2.0])
+
+# Transaction priorities on the SIM900 bus, lower goes first.
+# Control traffic (e.g. set_MOUT during a mag ramp) jumps ahead of monitoring.
+PRIORITY_CONTROL = 0
+PRIORITY_MONITOR = 1
+
+
+class PriorityLock():
+    """
+    Lock that is handed to the waiting thread with the lowest priority
+    number, first come first served within a priority.
+    Keeps queue depth and wait time statistics.
+    """
+    def __init__(self, history=1000):
+        self._cond = threading.Condition()
+        self._locked = False
+        self._waiting = [] # heap of (priority, sequence number)
+        self._seq = itertools.count()
+        self.history = history
+        self.wait_times = dict() # priority: recent waits in seconds
+        self.max_depth = 0
+
+    def acquire(self, priority=PRIORITY_MONITOR):
+        t0 = time.perf_counter()
+        with self._cond:
+            entry = (priority, next(self._seq))
+            heapq.heappush(self._waiting, entry)
+            self.max_depth = max(self.max_depth, len(self._waiting))
+            while self._locked or self._waiting[0] != entry:
+                self._cond.wait()
+            heapq.heappop(self._waiting)
+            self._locked = True
+            self.wait_times.setdefault(priority, deque(maxlen=self.history)).append(time.perf_counter() - t0)
+
+    def release(self):
+        with self._cond:
+            self._locked = False
+            self._cond.notify_all()
+
+    @contextmanager
+    def hold(self, priority=PRIORITY_MONITOR):
+        self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def depth(self):
+        return len(self._waiting)
+
+    # Is anyone at priority or more urgent waiting for the lock?
+    def contended(self, priority=PRIORITY_CONTROL):
+        with self._cond:
+            return any([entry[0] <= priority for entry in self._waiting])
+
+    def stats(self):
+        """
+        Returns
+        -------
+        dict with the current and largest queue depth and, for every
+        priority, (number of waits, mean wait [s], max wait [s]).
+
+        """
+        with self._cond:
+            waits = dict([(priority, (len(dts), sum(dts)/len(dts), max(dts)))
+                          for priority, dts in self.wait_times.items()])
+            return {'depth': len(self._waiting), 'max_depth': self.max_depth, 'wait': waits}
+
+
 # Base class
 class SIM9XX(VisaInstrument):
 
@@ -41,6 +125,27 @@ class SIM9XX(VisaInstrument):
         self.visa_handle.baud_rate = 115200
         self.visa_handle.write('TERM LF') # Set terminator
 
+        # Polling of port buffers while waiting on a reply
+        self.poll_min = 0.002 # s, first wait after sending
+        self.poll_max = 0.02 # s, backoff limit
+        self.latency_history = 1000
+        self.latency = dict()
+
+        # The DAQ and the magnet control code share this one connection,
+        # possibly from different threads.
+        # bus: one exchange with the SIM900 (a write and the read of its reply)
+        # port_locks: a whole SNDT ... reply transaction with one module, so
+        #   nobody else can take the reply out of that port's buffer.
+        # Other ports stay free, so a ramp can talk to the SIM960 while the
+        # DAQ waits on a slow SIM922 reading.
+        self.bus = PriorityLock(self.latency_history)
+        self.port_locks = dict()
+        self._port_locks_lock = threading.Lock()
+
+        # Record all traffic if ADR_SERIAL_TRACE is set
+        if serial_trace.default_recorder() is not None:
+            self.start_trace(serial_trace.default_recorder())
+
         # it's a good idea to call connect_message at the end of your constructor.
         # this calls the 'IDN' parameter that the base Instrument class creates for
         # every instrument (you can override the `get_idn` method if it doesn't work
@@ -49,51 +154,282 @@ class SIM9XX(VisaInstrument):
         # 2) gets the ID info so it will be included with metadata snapshots later.
         self.connect_message()
 
+    # Put a trace recorder (serial_trace.TraceRecorder) between us and the
+    # visa handle. visa_handle is a read-only property in newer qcodes.
+    def start_trace(self, recorder):
+        self.stop_trace()
+        self._set_handle(serial_trace.TracedVisaHandle(self.visa_handle, recorder, self.name))
+
+    def stop_trace(self):
+        if isinstance(self.visa_handle, serial_trace.TracedVisaHandle):
+            self._set_handle(self.visa_handle.handle)
+
+    def _set_handle(self, handle):
+        with self.bus.hold(PRIORITY_CONTROL):
+            if isinstance(getattr(type(self), 'visa_handle', None), property):
+                self._visa_handle = handle
+            else:
+                self.visa_handle = handle
+
+    # Single exchanges with the SIM900 itself, under the bus lock
+    def host_write(self, msg, priority=PRIORITY_MONITOR):
+        with self.bus.hold(priority):
+            self.visa_handle.write(msg)
+
+    # Reads one terminated line, or exactly nbytes if given
+    def host_query(self, msg, nbytes=None, priority=PRIORITY_MONITOR):
+        with self.bus.hold(priority):
+            self.visa_handle.write(msg)
+            if nbytes is None:
+                return self.visa_handle.read()
+            return self.visa_handle.read_bytes(nbytes).decode()
+
+    def port_lock(self, port):
+        with self._port_locks_lock:
+            if port not in self.port_locks:
+                self.port_locks[port] = threading.Lock()
+            return self.port_locks[port]
+
+    # Hold the transaction locks for several ports.
+    # Always taken in port order so two batches cannot deadlock.
+    @contextmanager
+    def hold_ports(self, ports):
+        locks = [self.port_lock(port) for port in sorted(set(ports), key=str)]
+        for lock in locks:
+            lock.acquire()
+        try:
+            yield
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
     # Generic function to read a port/module
+    # Returns whatever is waiting in the port buffer, or None if it is empty.
     def read_port(self, port):
-        self.visa_handle.write(f'NINP? {port}')
-        time.sleep(0.05)
-        nbytes = self.visa_handle.read()
-        # print(nbytes.encode())
         try:
-            n = int(nbytes.strip())
-            if n > 0:
-                self.visa_handle.write(f'RAWN? {port},{n}')
-                time.sleep(0.05)
-                msg = self.visa_handle.read()
-                return msg
+            with self.hold_ports([port]):
+                n = self.get_NINP(port)
+                if n > 0:
+                    return self.get_RAWN(port, n)
         except:
             return None
 
+    # Number of bytes waiting in a port's output buffer
+    def get_NINP(self, port, priority=PRIORITY_MONITOR):
+        nbytes = self.host_query(f'NINP? {port}', priority=priority)
+        return int(nbytes.strip())
+
+    # RAWN? returns exactly n bytes with no terminator added, so read by count.
+    # Reading up to the terminator would hang on a partial response.
+    def get_RAWN(self, port, n, priority=PRIORITY_MONITOR):
+        return self.host_query(f'RAWN? {port},{n}', nbytes=n, priority=priority)
+
+    # Send a query to a module and wait for the reply.
+    # Instead of sleeping a fixed time we poll NINP? with a short backoff and
+    # return as soon as a terminated reply is in the buffer. The timeout is
+    # the most we will ever wait.
+    def query_port(self, port, cmd, timeout=1.0, nlines=1, priority=PRIORITY_MONITOR):
+        return self.query_ports([(port, cmd, nlines)], timeout=timeout, priority=priority)[0]
+
+    # Scatter-gather version of query_port.
+    # The SIM900 buffers every port separately, so we send all of the SNDT
+    # queries first and then collect the replies as they come in. A sweep
+    # then costs as much as the slowest module instead of the sum of them.
+    def query_ports(self, queries, timeout=1.0, priority=PRIORITY_MONITOR):
+        """
+        Query several modules at once.
+
+        Parameters
+        ----------
+        queries : list of (port, cmd) or (port, cmd, nlines)
+            The same port may appear more than once; its replies come back in
+            the order the queries were sent. A query that returns several
+            readings gives nlines terminated lines, which are kept together.
+        timeout : float
+            Longest time to wait for all of the replies, in seconds.
+        priority : int
+            PRIORITY_CONTROL or PRIORITY_MONITOR, for access to the bus.
+
+        Returns
+        -------
+        list of str, replies in the same order as queries.
+
+        """
+        with self.hold_ports([query[0] for query in queries]):
+            return self._query_ports(queries, timeout, priority)
+
+    def _query_ports(self, queries, timeout, priority):
+        t0 = time.perf_counter()
+        pending = dict() # port: indices of queries still waiting for a reply
+        nlines = []
+        for idx, query in enumerate(queries):
+            port, cmd = query[:2]
+            nlines.append(query[2] if len(query) > 2 else 1)
+            self.host_write(f'SNDT {port},"{cmd}"', priority)
+            pending.setdefault(port, []).append(idx)
+        # From when the queries are out, not from waiting for the bus
+        deadline = time.perf_counter() + timeout
+
+        buf = dict([(port, '') for port in pending])
+        replies = [''] * len(queries)
+        wait = self.poll_min
+        while True:
+            for port in list(pending):
+                n = self.get_NINP(port, priority)
+                if n == 0:
+                    continue
+                buf[port] += self.get_RAWN(port, n, priority)
+                wait = self.poll_min # More may be coming, check again soon
+                while '\n' in buf[port] and pending[port]:
+                    line, buf[port] = buf[port].split('\n', 1)
+                    idx = pending[port][0]
+                    replies[idx] += line + '\n'
+                    nlines[idx] -= 1
+                    if nlines[idx] == 0:
+                        pending[port].pop(0)
+                        self.log_latency(queries[idx][1], time.perf_counter() - t0)
+                if not pending[port]:
+                    del pending[port]
+
+            if not pending:
+                break
+            if time.perf_counter() > deadline:
+                # Drop anything half received so a late reply does not get
+                # handed to the next query on that port
+                for port in pending:
+                    self.host_write(f'FLSH {port}', priority)
+                waiting = [queries[idx] for idxs in pending.values() for idx in idxs]
+                raise TimeoutError(f'{self.name}: no reply to {waiting} after {timeout} s')
+            time.sleep(wait)
+            wait = min(2*wait, self.poll_max)
+
+        return replies
+
+    # Batched read of module requests, see the req_ methods on the modules.
+    # Takes a list of SIMRequest and returns the parsed values.
+    def read_requests(self, requests, priority=PRIORITY_MONITOR):
+        timeout = max([req.timeout for req in requests])
+        replies = self.query_ports([(req.port, req.cmd, req.nlines) for req in requests],
+                                   timeout=timeout, priority=priority)
+        return [req.parse(g) for req, g in zip(requests, replies)]
+
+    # Send a command to a module that has no reply.
+    # Sets are control traffic unless told otherwise.
+    def send_port(self, port, cmd, priority=PRIORITY_CONTROL):
+        with self.hold_ports([port]):
+            self.host_write(f'SNDT {port},"{cmd}"', priority)
+
+    # Run a single request
+    def read_request(self, req, priority=PRIORITY_MONITOR):
+        return req.parse(self.query_port(req.port, req.cmd, timeout=req.timeout,
+                                         nlines=req.nlines, priority=priority))
+
+    # Keep a short history of round trip times per command (e.g. "TVAL?")
+    def log_latency(self, cmd, dt):
+        key = cmd.split(' ')[0]
+        if key not in self.latency:
+            self.latency[key] = deque(maxlen=self.latency_history)
+        self.latency[key].append(dt)
+
+    def latency_stats(self):
+        """
+        Round trip statistics for every command sent with query_port.
+
+        Returns
+        -------
+        dict of command: (number of samples, mean [s], max [s])
+
+        """
+        stats = {}
+        for key, dts in list(self.latency.items()):
+            stats[key] = (len(dts), sum(dts)/len(dts), max(dts))
+        return stats
+
+    def transport_stats(self):
+        """
+        Queue depth and wait times for the bus, see PriorityLock.stats.
+        Wait times are keyed by PRIORITY_CONTROL and PRIORITY_MONITOR.
+        """
+        return self.bus.stats()
+
+    # Throw away whatever is sitting in the host input buffer.
+    # Only call this while holding the bus.
+    def drain_input(self, quiet_time=0.05):
+        timeout = self.visa_handle.timeout
+        self.visa_handle.timeout = quiet_time*1000 # ms
+        try:
+            while True:
+                self.visa_handle.read_raw()
+        except VisaIOError:
+            pass
+        finally:
+            self.visa_handle.timeout = timeout
+
     def idn_port(self, port):
         # self.visa_handle.write('FLSH {port}')
         # time.sleep(0.1)
-        self.visa_handle.write(f'SNDT {port},"*IDN?"')
-        time.sleep(0.1)
-        idn = self.read_port(port)
+        try:
+            idn = self.query_port(port, '*IDN?')
+        except TimeoutError:
+            idn = None
         print(idn)
         return idn
 
     def get_TERM(self, port='D'): # D is host
-        self.visa_handle.write(f'TERM? {port}')
-        time.sleep(0.05)
-        g = self.visa_handle.read()
-        return g
+        return self.host_query(f'TERM? {port}')
 
 
 
 # Main frame
 # Make sure baud rate is set correctly for the COM port
-SIM900 = SIM9XX(name='SIM900', address='ASRL7::INSTR')
+# SIM900_ADDRESS/SIM900_VISALIB point the driver somewhere else,
+# e.g. at SIM900_emulator.
+SIM900 = SIM9XX(name='SIM900', address=os.environ.get('SIM900_ADDRESS', 'ASRL7::INSTR'),
+                visalib=os.environ.get('SIM900_VISALIB'))
+
+# Fixed size buffer of (time, value) samples that overwrites the oldest ones
+class RingBuffer():
+    def __init__(self, size):
+        self.t = np.zeros(size)
+        self.val = np.zeros(size)
+        self.size = size
+        self.count = 0 # Total samples ever added
+
+    def append(self, t, val):
+        idx = self.count % self.size
+        self.t[idx] = t
+        self.val[idx] = val
+        self.count += 1
+
+    # Samples in time order, optionally only the ones newer than t0
+    def get(self, t0=None):
+        n = min(self.count, self.size)
+        order = (np.arange(n) + self.count - n) % self.size
+        t, val = self.t[order], self.val[order]
+        if t0 is not None:
+            keep = t > t0
+            t, val = t[keep], val[keep]
+        return t, val
+
+    def clear(self):
+        self.count = 0
+
 
 # SIM 921
 # !!! In stream mode, only one module can be connected at a time !!!
+# CONN takes over the whole host link, so the SIM900 bus is held for the
+# entire capture and every other module (and thread) waits until we escape.
 class SIM921_stream(InstrumentModule):
-    def __init__(self, parent=SIM900, name='SIM921', port=1, **kwargs): # Make sure port is correct
+    def __init__(self, parent=SIM900, name='SIM921_stream', port=1, escape='AAA',
+                 buffer_size=100000, **kwargs): # Make sure port is correct
         super().__init__(parent, name)
         self.port = port
-        SIM900.visa_handle.write(f"CONN {self.port},'AAA'") # AAA is arbitrary escape string
-        self.idn()
+        self.escape = escape # Arbitrary escape string
+        self.max_capture_time = 60 # s, longest we keep the link to ourselves
+        self.ring = RingBuffer(buffer_size)
+
+    def open(self):
+        SIM900.visa_handle.write(f"CONN {self.port},'{self.escape}'")
 
     def idn(self):
         SIM900.visa_handle.write("*IDN?")
@@ -101,7 +437,68 @@ class SIM921_stream(InstrumentModule):
         print(idn)
 
     def close(self):
-        SIM900.visa_handle.write('AAA')
+        SIM900.visa_handle.write(self.escape)
+
+    def capture(self, duration, max_points=10000):
+        """
+        Stream FAA temperatures straight from the SIM921 at its own update
+        rate for a bounded time, then go back to mainframe mode.
+        The capture ends early, within a few ms, as soon as a
+        PRIORITY_CONTROL transaction (e.g. the ramp engine's set_MOUT or
+        its OMON/Sim970 reads) is waiting for the bus: the input buffer is
+        polled, and only read once a reading is coming in.
+
+        Parameters
+        ----------
+        duration : float
+            Capture time in seconds, at most max_capture_time.
+        max_points : int
+            Most readings to ask the SIM921 for.
+
+        Returns
+        -------
+        (t, T) arrays of unix times and temperatures captured this time.
+        The samples are also kept in self.ring.
+
+        """
+        duration = min(duration, self.max_capture_time)
+        t_start = time.time()
+        t, T = [], []
+        with SIM900.bus.hold(PRIORITY_MONITOR):
+            timeout = SIM900.visa_handle.timeout
+            try:
+                SIM900.drain_input()
+                self.open()
+                SIM900.visa_handle.timeout = 100 # ms, the rest of a line that has started
+                SIM900.visa_handle.write(f'TVAL? {max_points:d}') # Streams the readings
+                t_read = time.time()
+                while time.time() - t_start < duration and len(T) < max_points:
+                    if SIM900.bus.contended(PRIORITY_CONTROL):
+                        break # Control goes first, the DAQ streams again next chunk
+                    if SIM900.visa_handle.bytes_in_buffer == 0:
+                        if time.time() - t_read > 2.: # s, a few updates even at long TCON
+                            break
+                        time.sleep(0.005)
+                        continue
+                    t_read = time.time()
+                    try:
+                        g = SIM900.visa_handle.read()
+                    except VisaIOError:
+                        break
+                    try:
+                        T.append(float(g.strip()))
+                    except ValueError:
+                        continue
+                    t.append(time.time())
+                    self.ring.append(t[-1], T[-1])
+            finally:
+                # Always get back to mainframe mode, whatever happened above
+                SIM900.visa_handle.write('SOUT') # Stop streaming
+                self.close()
+                SIM900.drain_input()
+                SIM900.visa_handle.write(f'FLSH {self.port}')
+                SIM900.visa_handle.timeout = timeout
+        return np.array(t), np.array(T)
 
 # SIM 960
 # PCTL(?) z -- Proportional action ON/OFF
@@ -135,533 +532,294 @@ class SIM960_stream(InstrumentModule):
         SIM900.visa_handle.write('CCC')
 
 
-# SIM960, text based
-class SIM960(InstrumentModule):
-    def __init__(self, parent=SIM900, name='SIM960', port=3, **kwargs): # Make sure port is correct
+# SIM module commands
+# Every module class below is generated from a table of these.
+#   name: command mnemonic, e.g. 'RANG' gives get_RANG, set_RANG and req_RANG
+#   dtype: float, int or str. Sets are formatted and replies parsed with it.
+#   access: 'get', 'set' or 'getset'
+#   cached: Settings only change when we set them, so they are kept in a
+#       write-through shadow cache. Gets are then free and a set to the value
+#       we already have is skipped. Measurements (TVAL, VOLT, OMON, ...)
+#       are never cached and always go to the hardware.
+#   settle: Time to wait after a set, in seconds
+#   channel: The command takes a channel first, e.g. SIM922 'CURV? c' and 'CURV c,i'
+SIMCommand = namedtuple('SIMCommand', ['name', 'dtype', 'access', 'cached', 'settle', 'channel'],
+                        defaults=['getset', True, 0.1, False])
+
+SET_FORMAT = {float: '{:g}', int: '{:d}', str: '{}'}
+
+
+def parse_reply(cmd, g):
+    g = g.strip()
+    if cmd.channel and ',' in g: # Channel 0 is all of them
+        return [cmd.dtype(_x) for _x in g.split(',')]
+    return cmd.dtype(g)
+
+
+def make_getter(cmd):
+    if cmd.channel:
+        def getter(self, c):
+            return self.get_command(cmd, c)
+    else:
+        def getter(self):
+            return self.get_command(cmd)
+    getter.__doc__ = f"Query {cmd.name}" + (" (cached)" if cmd.cached else "")
+    return getter
+
+
+def make_setter(cmd):
+    if cmd.channel:
+        def setter(self, c, value):
+            self.set_command(cmd, value, c)
+    else:
+        def setter(self, value):
+            self.set_command(cmd, value)
+    setter.__doc__ = f"Set {cmd.name}"
+    return setter
+
+
+def make_request(cmd):
+    def request(self):
+        return SIMRequest(self.port, f'{cmd.name}?', lambda g: parse_reply(cmd, g), timeout=1.0)
+    request.__doc__ = f"SIMRequest for {cmd.name}?, for batched reads"
+    return request
+
+
+# Class decorator that adds the get_/set_/req_ methods for a command table.
+# Methods written out by hand in the class are left alone.
+def sim_commands(table):
+    def decorate(cls):
+        cls.commands = dict([(cmd.name, cmd) for cmd in table])
+        for cmd in table:
+            methods = []
+            if 'get' in cmd.access:
+                methods.append(('get_'+cmd.name, make_getter(cmd)))
+                if not cmd.channel and not cmd.cached:
+                    methods.append(('req_'+cmd.name, make_request(cmd)))
+            if 'set' in cmd.access:
+                methods.append(('set_'+cmd.name, make_setter(cmd)))
+            for mname, method in methods:
+                if mname not in cls.__dict__:
+                    method.__name__ = mname
+                    setattr(cls, mname, method)
+        return cls
+    return decorate
+
+
+# Base class for the modules we talk to through the SIM900 with SNDT
+class SIM9XXModule(InstrumentModule):
+    commands = dict()
+    priority = PRIORITY_MONITOR # for queries, sets are always PRIORITY_CONTROL
+
+    def __init__(self, parent, name, port):
         super().__init__(parent, name)
         self.port = port
-        # SIM900.visa_handle.write(f"CONN {self.port},'CCC'") # CCC is arbitrary escape string
-        SIM900.visa_handle.write(f'TERM {self.port},LF')
-        SIM900.visa_handle.write(f'FLSH {self.port}')
-        SIM900.idn_port(self.port)
-
-    # def read(self):
-    #     SIM900.visa_handle.write(f'NINP? {self.port}')
-    #     # time.sleep(0.1)
-    #     nbytes = SIM900.visa_handle.read()
-    #     # print(nbytes.encode())
-    #     try:
-    #         n = int(nbytes.strip())
-    #         if n > 0:
-    #             SIM900.visa_handle.write(f'RAWN? {self.port},{n}')
-    #             # time.sleep(0.1)
-    #             msg = SIM900.visa_handle.read()
-    #             return msg
-    #     except:
-    #         return None
-
-    # def idn(self):
-    #     # SIM900.visa_handle.write('FLSH {self.port}')
-    #     # time.sleep(0.1)
-    #     SIM900.visa_handle.write(f'SNDT {self.port},"*IDN?"')
-    #     time.sleep(0.1)
-    #     idn = self.read()
-    #     print(idn)
-    #     return idn
-
-    def get_GAIN(self):
-        SIM900.visa_handle.write(f'SNDT {self.port},"GAIN?"')
-        time.sleep(0.1)
-        g = SIM900.read_port(self.port)
-        return float(g.strip())
-
-    def set_GAIN(self, GAIN):
-        SIM900.visa_handle.write(f'SNDT {self.port},"GAIN {GAIN:g}"')
-        time.sleep(0.1)
-
-    def get_INTG(self):
-        SIM900.visa_handle.write(f'SNDT {self.port},"INTG?"')
-        time.sleep(0.1)
-        g = SIM900.read_port(self.port)
-        return float(g.strip())
-
-    def set_INTG(self, INTG):
-        SIM900.visa_handle.write(f'SNDT {self.port},"INTG {INTG:g}"')
-        time.sleep(0.1)
-
-    def get_DERV(self):
-        SIM900.visa_handle.write(f'SNDT {self.port},"DERV?"')
-        time.sleep(0.1)
-        g = SIM900.read_port(self.port)
-        return float(g.strip())
-
-    def set_DERV(self, DERV):
-        SIM900.visa_handle.write(f'SNDT {self.port},"DERV {DERV:g}"')
-        time.sleep(0.1)
-
-    def get_AMAN(self):
-        SIM900.visa_handle.write(f'SNDT {self.port},"AMAN?"')
-        time.sleep(0.1)
-        g = SIM900.read_port(self.port)
-        return g.strip()
-
-    def set_AMAN(self, AMAN):
-        SIM900.visa_handle.write(f'SNDT {self.port},"AMAN {AMAN}"')
-        time.sleep(0.1)
-        
-    def get_PCTL(self):
-        SIM900.visa_handle.write(f'SNDT {self.port},"PCTL?"')
-        time.sleep(0.1)
-        g = SIM900.read_port(self.port)
-        return g.strip()
-
-    def set_PCTL(self, PCTL):
-        SIM900.visa_handle.write(f'SNDT {self.port},"PCTL {PCTL}"')
-        time.sleep(0.1)
-        
-    def get_ICTL(self):
-        SIM900.visa_handle.write(f'SNDT {self.port},"ICTL?"')
-        time.sleep(0.1)
-        g = SIM900.read_port(self.port)
-        return g.strip()
-
-    def set_ICTL(self, ICTL):
-        SIM900.visa_handle.write(f'SNDT {self.port},"ICTL {ICTL}"')
-        time.sleep(0.1)
-
-    def get_DCTL(self):
-        SIM900.visa_handle.write(f'SNDT {self.port},"DCTL?"')
-        time.sleep(0.1)
-        g = SIM900.read_port(self.port)
-        return g.strip()
-
-    def set_DCTL(self, DCTL):
-        SIM900.visa_handle.write(f'SNDT {self.port},"DCTL {DCTL}"')
-        time.sleep(0.1)  
-    def get_OCTL(self):
-        SIM900.visa_handle.write(f'SNDT {self.port},"OCTL?"')
-        time.sleep(0.1)
-        g = SIM900.read_port(self.port)
-        return g.strip()
-
-    def set_OCTL(self, OCTL):
-        SIM900.visa_handle.write(f'SNDT {self.port},"OCTL {OCTL}"')
-        time.sleep(0.1)
-
-    def get_RAMP(self):
-        SIM900.visa_handle.write(f'SNDT {self.port},"RAMP?"')
-        time.sleep(0.1)
-        g = SIM900.read_port(self.port)
-        return g.strip()
-
-    def set_RAMP(self, RAMP):
-        SIM900.visa_handle.write(f'SNDT {self.port},"RAMP {RAMP}"')
-        time.sleep(0.1)
-
-    def get_INPT(self):
-        SIM900.visa_handle.write(f'SNDT {self.port},"INPT?"')
-        time.sleep(0.1)
-        g = SIM900.read_port(self.port)
-        return g.strip()
-
-    def set_INPT(self, INPT):
-        SIM900.visa_handle.write(f'SNDT {self.port},"INPT {INPT}"')
-        time.sleep(0.1)
-
-    def get_SETP(self):
-        SIM900.visa_handle.write(f'SNDT {self.port},"SETP?"')
-        time.sleep(0.1)
-        g = SIM900.read_port(self.port)
-        return float(g.strip())
-
-    def set_SETP(self, SETP):
-        SIM900.visa_handle.write(f'SNDT {self.port},"SETP {SETP:g}"')
-        time.sleep(0.1)
-
-    def get_MOUT(self):
-        SIM900.visa_handle.write(f'SNDT {self.port},"MOUT?"')
-        time.sleep(0.1)
-        g = SIM900.read_port(self.port)
-        return float(g.strip())
-
-    def set_MOUT(self, MOUT):
-        SIM900.visa_handle.write(f'SNDT {self.port},"MOUT {MOUT:g}"')
-        time.sleep(0.1)
-
-    def get_OMON(self):
-        SIM900.visa_handle.write(f'SNDT {self.port},"OMON?"')
-        time.sleep(0.1)
-        g = SIM900.read_port(self.port)
-        return float(g.strip())
-
-    def get_SMON(self):
-        SIM900.visa_handle.write(f'SNDT {self.port},"SMON?"')
-        time.sleep(0.1)
-        g = SIM900.read_port(self.port)
-        return float(g.strip())
-
-    def get_MMON(self):
-        SIM900.visa_handle.write(f'SNDT {self.port},"MMON?"')
-        time.sleep(0.1)
-        g = SIM900.read_port(self.port)
-        return float(g.strip())
-
-    def get_EMON(self):
-        SIM900.visa_handle.write(f'SNDT {self.port},"EMON?"')
-        time.sleep(0.1)
-        g = SIM900.read_port(self.port)
-        return float(g.strip())
-
-    def get_ULIM(self):
-        SIM900.visa_handle.write(f'SNDT {self.port},"ULIM?"')
-        time.sleep(0.1)
-        g = SIM900.read_port(self.port)
-        return float(g.strip())
-
-    def set_ULIM(self, ULIM):
-        SIM900.visa_handle.write(f'SNDT {self.port},"ULIM {ULIM:g}"')
-        time.sleep(0.1)
-
-    def get_LLIM(self):
-        SIM900.visa_handle.write(f'SNDT {self.port},"LLIM?"')
-        time.sleep(0.1)
-        g = SIM900.read_port(self.port)
-        return float(g.strip())
-
-    def set_LLIM(self, LLIM):
-        SIM900.visa_handle.write(f'SNDT {self.port},"LLIM {LLIM:g}"')
-        time.sleep(0.1)
+        self.shadow = dict() # (name, channel): value we last set or read
+        self.parent.host_write(f'TERM {self.port},LF')
+        self.parent.host_write(f'FLSH {self.port}')
+        self.parent.idn_port(self.port)
+
+    def get_command(self, cmd, c=None):
+        key = (cmd.name, c)
+        if cmd.cached and key in self.shadow:
+            return self.shadow[key]
+        q = f'{cmd.name}?' if c is None else f'{cmd.name}? {c}'
+        value = parse_reply(cmd, self.parent.query_port(self.port, q, priority=self.priority))
+        if cmd.cached:
+            self.shadow[key] = value
+        return value
+
+    def set_command(self, cmd, value, c=None):
+        value = cmd.dtype(value)
+        key = (cmd.name, c)
+        if cmd.cached and key in self.shadow and self.shadow[key] == value:
+            return # Already set
+        arg = SET_FORMAT[cmd.dtype].format(value)
+        if c is not None:
+            arg = f'{c},{arg}'
+        self.parent.send_port(self.port, f'{cmd.name} {arg}')
+        time.sleep(cmd.settle)
+        if cmd.cached:
+            if c == 0:
+                # Set every channel. The get for channel 0 answers with a
+                # list of them, so read that back rather than cache a scalar
+                self.invalidate_cache(cmd.name)
+                return
+            if c is not None: # The all-channels list is out of date
+                self.shadow.pop((cmd.name, 0), None)
+            self.shadow[key] = value
+
+    def invalidate_cache(self, name=None):
+        """
+        Forget cached settings so they are read from the module again.
+        Call this after anything outside this code changes the module,
+        e.g. front panel changes or a power cycle.
+
+        Parameters
+        ----------
+        name : str, optional
+            Only forget this command. Everything is forgotten if None.
+
+        """
+        if name is None:
+            self.shadow.clear()
+            super().invalidate_cache() # qcodes parameters
+        else:
+            for key in [key for key in self.shadow if key[0] == name]:
+                del self.shadow[key]
+
+
+# SIM960, text based
+SIM960_COMMANDS = [
+    SIMCommand('GAIN', float),
+    SIMCommand('INTG', float),
+    SIMCommand('DERV', float),
+    SIMCommand('AMAN', str),
+    SIMCommand('PCTL', str),
+    SIMCommand('ICTL', str),
+    SIMCommand('DCTL', str),
+    SIMCommand('OCTL', str),
+    SIMCommand('RAMP', str),
+    SIMCommand('INPT', str),
+    SIMCommand('SETP', float, cached=False), # Moves while the setpoint ramp is on
+    SIMCommand('MOUT', float, cached=False), # Can follow the PID output on a switch to manual
+    SIMCommand('OMON', float, 'get', cached=False),
+    SIMCommand('SMON', float, 'get', cached=False),
+    SIMCommand('MMON', float, 'get', cached=False),
+    SIMCommand('EMON', float, 'get', cached=False),
+    SIMCommand('ULIM', float),
+    SIMCommand('LLIM', float),
+]
+
+@sim_commands(SIM960_COMMANDS)
+class SIM960(SIM9XXModule):
+    priority = PRIORITY_CONTROL # Drives the magnet
+
+    def __init__(self, parent=SIM900, name='SIM960', port=3, **kwargs): # Make sure port is correct
+        super().__init__(parent, name, port)
+
 
 # SIM921, text based
-class SIM921(InstrumentModule):
+SIM921_COMMANDS = [
+    SIMCommand('FREQ', float),
+    SIMCommand('RANG', int),
+    SIMCommand('EXCI', int),
+    SIMCommand('CURV', int),
+    SIMCommand('EXON', str),
+    SIMCommand('MODE', str),
+    SIMCommand('IEXC', float, 'get', cached=False),
+    SIMCommand('VEXC', float, 'get', cached=False),
+    SIMCommand('RVAL', float, 'get', cached=False),
+    SIMCommand('TVAL', float, 'get', cached=False),
+    SIMCommand('PHAS', float, 'get', cached=False),
+    SIMCommand('DISP', int),
+    SIMCommand('AGAI', str),
+    SIMCommand('ADIS', str),
+    SIMCommand('TCON', int),
+]
+
+@sim_commands(SIM921_COMMANDS)
+class SIM921(SIM9XXModule):
     def __init__(self, parent=SIM900, name='SIM921', port=1, **kwargs): # Make sure port is correct
-        super().__init__(parent, name)
-        self.port = port
-        # SIM900.visa_handle.write(f"CONN {self.port},'CCC'") # CCC is arbitrary escape string
-        SIM900.visa_handle.write(f'TERM {self.port},LF')
-        SIM900.visa_handle.write(f'FLSH {self.port}')
-        SIM900.idn_port(self.port)
-
-    def get_FREQ(self):
-        SIM900.visa_handle.write(f'SNDT {self.port},"FREQ?"')
-        time.sleep(0.1)
-        g = SIM900.read_port(self.port)
-        return float(g.strip())
-
-    def set_FREQ(self, FREQ):
-        SIM900.visa_handle.write(f'SNDT {self.port},"FREQ {FREQ:g}"')
-        time.sleep(0.1)
-
-    def get_RANG(self):
-        SIM900.visa_handle.write(f'SNDT {self.port},"RANG?"')
-        time.sleep(0.1)
-        g = SIM900.read_port(self.port)
-        return int(g.strip())
-
-    def set_RANG(self, RANG):
-        SIM900.visa_handle.write(f'SNDT {self.port},"RANG {RANG:d}"')
-        time.sleep(0.1)
-
-    def get_EXCI(self):
-        SIM900.visa_handle.write(f'SNDT {self.port},"EXCI?"')
-        time.sleep(0.1)
-        g = SIM900.read_port(self.port)
-        return int(g.strip())
-
-    def set_EXCI(self, EXCI):
-        SIM900.visa_handle.write(f'SNDT {self.port},"EXCI {EXCI:d}"')
-        time.sleep(0.1)
-
-    def get_CURV(self):
-        SIM900.visa_handle.write(f'SNDT {self.port},"CURV?"')
-        time.sleep(0.1)
-        g = SIM900.read_port(self.port)
-        return int(g.strip())
-
-    def set_CURV(self, CURV):
-        SIM900.visa_handle.write(f'SNDT {self.port},"CURV {CURV:d}"')
-        time.sleep(0.1)
-
-    def get_EXON(self):
-        SIM900.visa_handle.write(f'SNDT {self.port},"EXON?"')
-        time.sleep(0.1)
-        g = SIM900.read_port(self.port)
-        return g.strip()
-
-    def set_EXON(self, EXON):
-        SIM900.visa_handle.write(f'SNDT {self.port},"EXON {EXON}"')
-        time.sleep(0.1)
-
-    def get_MODE(self):
-        SIM900.visa_handle.write(f'SNDT {self.port},"MODE?"')
-        time.sleep(0.1)
-        g = SIM900.read_port(self.port)
-        return g.strip()
-
-    def set_MODE(self, MODE):
-        SIM900.visa_handle.write(f'SNDT {self.port},"MODE {MODE}"')
-        time.sleep(0.1)
-
-    def get_IEXC(self):
-        SIM900.visa_handle.write(f'SNDT {self.port},"IEXC?"')
-        time.sleep(0.1)
-        g = SIM900.read_port(self.port)
-        return float(g.strip())
-
-    def get_VEXC(self):
-        SIM900.visa_handle.write(f'SNDT {self.port},"VEXC?"')
-        time.sleep(0.1)
-        g = SIM900.read_port(self.port)
-        return float(g.strip())
-
-    def get_RVAL(self):
-        SIM900.visa_handle.write(f'SNDT {self.port},"RVAL?"')
-        time.sleep(0.1)
-        g = SIM900.read_port(self.port)
-        return float(g.strip())
-
-    def get_TVAL(self):
-        SIM900.visa_handle.write(f'SNDT {self.port},"TVAL?"')
-        time.sleep(0.1)
-        g = SIM900.read_port(self.port)
-        return float(g.strip())
-
-    def get_PHAS(self):
-        SIM900.visa_handle.write(f'SNDT {self.port},"PHAS?"')
-        time.sleep(0.1)
-        g = SIM900.read_port(self.port)
-        return float(g.strip())
-
-    def get_DISP(self):
-        SIM900.visa_handle.write(f'SNDT {self.port},"DISP?"')
-        time.sleep(0.1)
-        g = SIM900.read_port(self.port)
-        return int(g.strip())
-
-    def set_DISP(self, DISP):
-        SIM900.visa_handle.write(f'SNDT {self.port},"DISP {DISP:d}"')
-        time.sleep(0.1)
-
-    def get_AGAI(self):
-        SIM900.visa_handle.write(f'SNDT {self.port},"AGAI?"')
-        time.sleep(0.1)
-        g = SIM900.read_port(self.port)
-        return g.strip()
-
-    def set_AGAI(self, AGAI):
-        SIM900.visa_handle.write(f'SNDT {self.port},"AGAI {AGAI}"')
-        time.sleep(0.1)
-
-    def get_ADIS(self):
-        SIM900.visa_handle.write(f'SNDT {self.port},"ADIS?"')
-        time.sleep(0.1)
-        g = SIM900.read_port(self.port)
-        return g.strip()
-
-    def set_ADIS(self, ADIS):
-        SIM900.visa_handle.write(f'SNDT {self.port},"ADIS {ADIS}"')
-        time.sleep(0.1)
-
-    def get_TCON(self):
-        SIM900.visa_handle.write(f'SNDT {self.port},"TCON?"')
-        time.sleep(0.1)
-        g = SIM900.read_port(self.port)
-        return int(g.strip())
-
-    def set_TCON(self, TCON):
-        SIM900.visa_handle.write(f'SNDT {self.port},"TCON {TCON:d}"')
-        time.sleep(0.1)
+        super().__init__(parent, name, port)
+
 
 # SIM922, text based
-class SIM922(InstrumentModule):
+# VOLT? and TVAL? take a sample count as well, so they are written out below.
+SIM922_COMMANDS = [
+    SIMCommand('EXON', str, channel=True),
+    SIMCommand('DISX', str),
+    SIMCommand('DTEM', str),
+    SIMCommand('CURV', str, channel=True),
+    SIMCommand('TOKN', str),
+    SIMCommand('LCME', str, 'get', cached=False),
+    SIMCommand('LEXE', str, 'get', cached=False),
+    SIMCommand('TERM', str, 'get', cached=False),
+]
+
+@sim_commands(SIM922_COMMANDS)
+class SIM922(SIM9XXModule):
     def __init__(self, parent=SIM900, name='SIM922', port=5, **kwargs): # Make sure port is correct
-        super().__init__(parent, name)
-        self.port = port
-        SIM900.visa_handle.write(f'TERM {self.port},LF')
-        SIM900.visa_handle.write(f'FLSH {self.port}')
-        SIM900.idn_port(self.port)
-
-    def get_VOLT(self, c): # n = 1
-        SIM900.visa_handle.write(f'SNDT {self.port},"VOLT? {c:d}"')
-        time.sleep(0.5) # Need to wait long enough to take the reading
-        g = SIM900.read_port(self.port)
-        if c == 0:
-            r = [float(_x) for _x in g.strip().split(',')]
-        else:
-            r = float(g.strip())
-        return r
+        super().__init__(parent, name, port)
 
-    def get_VOLT1(self, c, n=1): # n != 1 not implemented
-        SIM900.visa_handle.write(f'SNDT {self.port},"VOLT? {c:d},{n:d}"')
-        time.sleep(0.5)
-        g = SIM900.read_port(self.port)
-        if c == 0:
-            r = [float(_x) for _x in g.strip().split(',')]
-        else:
-            r = float(g.strip())
-        return r
+    # Time for one reading, n readings are streamed back one per update
+    reading_time = 0.5
 
-    def get_VOLT2(self, c, n=1): # n != 1 not implemented
-        SIM900.visa_handle.write(f'SNDT {self.port},"VOLT? {c:d},{n:d}"')
-        time.sleep(0.5)
-        SIM900.visa_handle.write(f'GETN? {self.port},80')
-        g = SIM900.visa_handle.read()
-        return g
-
-    def get_TVAL(self, c, n=1): # n != 1 not implemented
-        SIM900.visa_handle.write(f'SNDT {self.port},"TVAL? {c:d},{n:d}"')
-        time.sleep(0.5)
-        g = SIM900.read_port(self.port)
-        if c == 0:
-            r = [float(_x) for _x in g.strip().split(',')]
-        else:
-            r = float(g.strip())
+    # c == 0 reads all four channels and gives a list, otherwise a float
+    @staticmethod
+    def parse_channels(g):
+        r = [float(_x) for _x in g.strip().split(',')]
+        if len(r) == 1:
+            r = r[0]
         return r
 
-    def get_EXON(self, c):
-        SIM900.visa_handle.write(f'SNDT {self.port},"EXON? {c:d}"')
-        time.sleep(0.1)
-        g = SIM900.read_port(self.port)
-        if c == 0:
-            r = g.strip().split(',')
-        else:
-            r = g.strip()
-        return r
+    # n > 1 readings come back one line each; gives an array of shape (n, channels)
+    @staticmethod
+    def parse_block(g):
+        lines = g.strip().split('\n')
+        return np.array(','.join(lines).split(','), dtype=float).reshape(len(lines), -1)
+
+    def channel_request(self, cmd, c, n):
+        if n == 1:
+            return SIMRequest(self.port, f'{cmd}? {c:d}', self.parse_channels,
+                              timeout=4*self.reading_time)
+        return SIMRequest(self.port, f'{cmd}? {c:d},{n:d}', self.parse_block,
+                          nlines=n, timeout=(n+3)*self.reading_time)
+
+    def req_VOLT(self, c, n=1):
+        return self.channel_request('VOLT', c, n)
+
+    # n == 1 gives a float (or a list of four for c == 0),
+    # n > 1 gives an array of shape (n, channels)
+    def get_VOLT(self, c, n=1):
+        return self.parent.read_request(self.req_VOLT(c, n), self.priority)
+
+    # Older names for get_VOLT, kept so existing scripts still run
+    def get_VOLT1(self, c, n=1):
+        return self.get_VOLT(c, n)
+
+    def get_VOLT2(self, c, n=1):
+        return self.get_VOLT(c, n)
+
+    def req_TVAL(self, c, n=1):
+        return self.channel_request('TVAL', c, n)
+
+    def get_TVAL(self, c, n=1):
+        return self.parent.read_request(self.req_TVAL(c, n), self.priority)
 
-        return g.strip()
-
-    def set_EXON(self, c, EXON):
-        SIM900.visa_handle.write(f'SNDT {self.port},"EXON {c:d},{EXON}"')
-        time.sleep(0.1)
-
-    def get_DISX(self):
-        SIM900.visa_handle.write(f'SNDT {self.port},"DISX?"')
-        time.sleep(0.1)
-        g = SIM900.read_port(self.port)
-        return g.strip()
-
-    def set_DISX(self, DISX):
-        SIM900.visa_handle.write(f'SNDT {self.port},"DISX {DISX}"')
-        time.sleep(0.1)
-
-    def get_DTEM(self):
-        SIM900.visa_handle.write(f'SNDT {self.port},"DTEM?"')
-        time.sleep(0.1)
-        g = SIM900.read_port(self.port)
-        return g.strip()
-
-    def set_DTEM(self, DTEM):
-        SIM900.visa_handle.write(f'SNDT {self.port},"DTEM {DTEM}"')
-        time.sleep(0.1)
-
-    def get_CURV(self, c):
-        SIM900.visa_handle.write(f'SNDT {self.port},"CURV? {c}"')
-        time.sleep(0.1)
-        g = SIM900.read_port(self.port)
-        return g.strip()
-
-    def set_CURV(self, c, CURV):
-        SIM900.visa_handle.write(f'SNDT {self.port},"CURV {c},{CURV}"')
-        time.sleep(0.1)
-
-    def get_TOKN(self):
-        SIM900.visa_handle.write(f'SNDT {self.port},"TOKN?"')
-        time.sleep(0.1)
-        g = SIM900.read_port(self.port)
-        return g.strip()
-
-    def set_TOKN(self, TOKN):
-        SIM900.visa_handle.write(f'SNDT {self.port},"TOKN {TOKN}"')
-        time.sleep(0.1)
-
-    def get_LCME(self):
-        SIM900.visa_handle.write(f'SNDT {self.port},"LCME?"')
-        time.sleep(0.1)
-        g = SIM900.read_port(self.port)
-        return g.strip()
-
-    def get_LEXE(self):
-        SIM900.visa_handle.write(f'SNDT {self.port},"LEXE?"')
-        time.sleep(0.1)
-        g = SIM900.read_port(self.port)
-        return g.strip()
-
-    def get_TERM(self):
-        SIM900.visa_handle.write(f'SNDT {self.port},"TERM?"')
-        time.sleep(0.1)
-        g = SIM900.read_port(self.port)
-        return g.strip()
 
 # SIM925, text based
-class SIM925(InstrumentModule):
+SIM925_COMMANDS = [
+    SIMCommand('MODE', str),
+    SIMCommand('BPAS', str),
+    SIMCommand('BUFR', str),
+    SIMCommand('CHAN', int),
+]
+
+@sim_commands(SIM925_COMMANDS)
+class SIM925(SIM9XXModule):
     def __init__(self, parent=SIM900, name='SIM925', port=6, **kwargs): # Make sure port is correct
-        super().__init__(parent, name)
-        self.port = port
-        # SIM900.visa_handle.write(f"CONN {self.port},'CCC'") # CCC is arbitrary escape string
-        SIM900.visa_handle.write(f'TERM {self.port},LF')
-        SIM900.visa_handle.write(f'FLSH {self.port}')
-        SIM900.idn_port(self.port)
-
-    def get_MODE(self):
-        SIM900.visa_handle.write(f'SNDT {self.port},"MODE?"')
-        time.sleep(0.1)
-        g = SIM900.read_port(self.port)
-        return g.strip()
-
-    def set_MODE(self, MODE):
-        SIM900.visa_handle.write(f'SNDT {self.port},"MODE {MODE}"')
-        time.sleep(0.1)
-
-    def get_BPAS(self):
-        SIM900.visa_handle.write(f'SNDT {self.port},"BPAS?"')
-        time.sleep(0.1)
-        g = SIM900.read_port(self.port)
-        return g.strip()
-
-    def set_BPAS(self, BPAS):
-        SIM900.visa_handle.write(f'SNDT {self.port},"BPAS {BPAS}"')
-        time.sleep(0.1)
-
-    def get_BUFR(self):
-        SIM900.visa_handle.write(f'SNDT {self.port},"BUFR?"')
-        time.sleep(0.1)
-        g = SIM900.read_port(self.port)
-        return g.strip()
-
-    def set_BUFR(self, BUFR):
-        SIM900.visa_handle.write(f'SNDT {self.port},"BUFR {BUFR}"')
-        time.sleep(0.1)
-
-    def get_CHAN(self):
-        SIM900.visa_handle.write(f'SNDT {self.port},"CHAN?"')
-        time.sleep(0.1)
-        g = SIM900.read_port(self.port)
-        return int(g.strip())
-
-    def set_CHAN(self, CHAN):
-        SIM900.visa_handle.write(f'SNDT {self.port},"CHAN {CHAN:d}"')
-        time.sleep(0.1)
+        super().__init__(parent, name, port)
 
 
 # SIM970, text based
-class SIM970(InstrumentModule):
+class SIM970(SIM9XXModule):
     def __init__(self, parent=SIM900, name='SIM970', port=7, **kwargs): # Make sure port is correct
-        super().__init__(parent, name)
-        self.port = port
-        # SIM900.visa_handle.write(f"CONN {self.port},'CCC'") # CCC is arbitrary escape string
-        SIM900.visa_handle.write(f'TERM {self.port},LF')
-        SIM900.visa_handle.write(f'FLSH {self.port}')
-        SIM900.idn_port(self.port)
-
-    def get_VOLT(self, c, n=1): # n != 1 not implemented
-        SIM900.visa_handle.write(f'SNDT {self.port},"VOLT? {c:d},{n:d}"')
-        time.sleep(0.1)
-        g = SIM900.read_port(self.port)
-        if c == 0:
-            r = [float(_x) for _x in g.strip().split(',')]
-        else:
-            r = float(g.strip())
-        return r
+        super().__init__(parent, name, port)
+
+    reading_time = 0.1
+
+    def req_VOLT(self, c, n=1):
+        if n == 1:
+            return SIMRequest(self.port, f'VOLT? {c:d},{n:d}', SIM922.parse_channels,
+                              timeout=10*self.reading_time)
+        return SIMRequest(self.port, f'VOLT? {c:d},{n:d}', SIM922.parse_block,
+                          nlines=n, timeout=(n+10)*self.reading_time)
+
+    # n == 1 gives a float (or a list of four for c == 0),
+    # n > 1 gives an array of shape (n, channels)
+    def get_VOLT(self, c, n=1):
+        return self.parent.read_request(self.req_VOLT(c, n), self.priority)
 
 
 #### Usage
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+In-memory stand-in for the NI DIO boxes, as a daqmx_session backend.
+
+It models what is on the lines:
+    ADR_DIO          the heat switch, moved by a rising edge on its open or
+                     close line (HPD_Heat_Switch.move_lines). The limit lines
+                     go low for the travel time, then both high. The touch
+                     sensors read 0 while touching.
+    ADR_RESISTOR_BOX latching relays (ADR_Resistor_Box.switches). A coil
+                     line held low for the latch time flips the relay, which
+                     then stays put. Resets don't move it.
+
+Times are on a clock with monotonic() and sleep_time() (ADR_Ramp.RealClock,
+or an ADR_Simulator clock to go faster than real time), and the drivers
+wait on the same clock through the session:
+
+>>> from daqmx_session import session
+>>> from daqmx_emulator import DAQmxEmulator
+>>> dio = DAQmxEmulator(hs_travel_time=5.)
+>>> session.use(dio)
+>>> round(HPD_Heat_Switch.Driver.startMove('Open').result())
+5
+>>> dio.set_touch('Touch 4K-1K', True)
+>>> ADR_DIO.decode(ADR_DIO.DIOSnapshot().read())['Touch 4K-1K']
+'Touch'
+
+Or set ADR_DIO_BACKEND=emulator to get one in real time on first use.
+"""
+
+import threading
+import time
+
+from ADR_Ramp import RealClock
+from daqmx_session import split_lines
+from HPD_Heat_Switch import move_lines, limit_lines
+from ADR_Resistor_Box import switches
+import ADR_DIO
+
+# Output ports and their word at power up and after a reset.
+# The relay coils are active low.
+idle_outputs = {'ADR_DIO/port1':0x00,
+                'ADR_RESISTOR_BOX/port1':0xFF}
+input_ports = ['ADR_DIO/port0', 'ADR_RESISTOR_BOX/port2']
+touch_sensors = [name for name in ADR_DIO.inputs if name.startswith('Touch')]
+
+
+# word with the lines of channel set to bits
+def set_lines(word, channel, bits):
+    port, lines = split_lines(channel)
+    for line, bit in zip(lines, bits):
+        word = (word & ~(1 << line)) | (int(bit) << line)
+    return word
+
+
+class DAQmxEmulator():
+    def __init__(self, clock=None, hs_closed=True, hs_travel_time=5., relay_latch_time=0.01,
+                 relays=None, on_heat_switch=None):
+        self.clock = RealClock() if clock is None else clock
+        self.lock = threading.RLock()
+        self.outputs = dict(idle_outputs)
+        self.hs_travel_time = hs_travel_time # s from the pulse to the limit lines
+        self.hs_closed = hs_closed # Where the switch is, or is going
+        self.hs_arrive = None # Clock time the move in progress gets there
+        self.on_heat_switch = on_heat_switch # Called with closed when a move gets there
+        self.touch = dict([(name, False) for name in touch_sensors])
+        self.relay_latch_time = relay_latch_time # s a coil has to be held
+        # Relays start in the last state of each (Regulate, resistors out)
+        self.relays = dict([(quant, list(states.values())[-1])
+                            for quant, (pulses, sense, states) in switches.items()])
+        if relays is not None:
+            self.relays.update(relays)
+        # (port, line): (quant, value) the coil latches the relay to
+        self.coils = dict()
+        for quant, (pulses, sense, states) in switches.items():
+            for value, channel in pulses.items():
+                port, lines = split_lines(channel)
+                self.coils[(port, lines[0])] = (quant, value)
+        self.energised = dict() # (port, line): clock time it went low
+
+    def monotonic(self):
+        return self.clock.monotonic()
+
+    def sleep(self, dt):
+        time.sleep(self.clock.sleep_time(dt))
+
+    # Set the heat switch touch sensor name touching or not
+    def set_touch(self, name, touching):
+        assert name in self.touch, "Error: unknown touch sensor"
+        with self.lock:
+            self.touch[name] = touching
+
+    # Where the heat switch is: 'Closed', 'Open' or 'Moving'
+    @property
+    def heat_switch(self):
+        with self.lock:
+            self.update()
+            if self.hs_arrive is not None:
+                return 'Moving'
+            return 'Closed' if self.hs_closed else 'Open'
+
+    # Finish the moves and latch the relays that are due
+    def update(self):
+        now = self.monotonic()
+        if self.hs_arrive is not None and now >= self.hs_arrive:
+            self.hs_arrive = None
+            if self.on_heat_switch is not None:
+                self.on_heat_switch(self.hs_closed)
+        for coil, t_on in self.energised.items():
+            quant, value = self.coils[coil]
+            partner = [c for c in self.energised if c != coil and self.coils[c][0] == quant]
+            if now - t_on >= self.relay_latch_time and not partner:
+                self.relays[quant] = value
+
+    # The backend calls daqmx_session.DIOSession makes
+    def create(self, channel, kind):
+        if kind == 'DO':
+            port, lines = split_lines(channel)
+            assert port in self.outputs, "Error: no emulated output "+channel
+            return (port, lines), len(lines)
+        assert channel in input_ports, "Error: no emulated input port "+channel
+        return (channel, None), 1
+
+    def write(self, task, values):
+        port, lines = task
+        with self.lock:
+            self.update()
+            old = self.outputs[port]
+            new = old
+            for line, value in zip(lines, values):
+                new = (new & ~(1 << line)) | (int(value) << line)
+            self.outputs[port] = new
+            self.changed(port, old, new)
+
+    def changed(self, port, old, new):
+        now = self.monotonic()
+        for line in range(32):
+            rose = (new >> line) & 1 and not (old >> line) & 1
+            fell = (old >> line) & 1 and not (new >> line) & 1
+            channel = port+'/line'+str(line)
+            if rose and channel in move_lines.values():
+                self.hs_closed = channel == move_lines['Close']
+                self.hs_arrive = now + self.hs_travel_time
+                # Nothing reads the lines when it gets there, so call back on
+                # time (right away on a clock that only moves when waited on)
+                timer = threading.Timer(self.hs_travel_time/self.clock.speedup, self.arrive)
+                timer.daemon = True
+                timer.start()
+            if (port, line) in self.coils:
+                if fell:
+                    self.energised[(port, line)] = now
+                elif rose:
+                    self.update()
+                    self.energised.pop((port, line), None)
+
+    def arrive(self):
+        with self.lock:
+            self.update()
+
+    def read_port(self, task):
+        port, lines = task
+        with self.lock:
+            self.update()
+            word = 0
+            if port == 'ADR_DIO/port0':
+                at_limit = int(self.hs_arrive is None)
+                word = set_lines(word, limit_lines, (at_limit, at_limit))
+                for name in touch_sensors:
+                    word = set_lines(word, ADR_DIO.inputs[name][0], (int(not self.touch[name]),))
+            else:
+                for quant, (pulses, sense, states) in switches.items():
+                    bits = dict([(value, key) for key, value in states.items()])[self.relays[quant]]
+                    word = set_lines(word, sense, bits)
+            return word
+
+    def clear(self, task):
+        pass
+
+    def reset_device(self, device):
+        with self.lock:
+            self.update()
+            for port in self.outputs:
+                if port.split('/')[0] == device:
+                    self.outputs[port] = idle_outputs[port]
+            for coil in [coil for coil in self.energised if coil[0].split('/')[0] == device]:
+                self.energised.pop(coil)
+
+
+if __name__ == '__main__':
+    import HPD_Heat_Switch
+    import ADR_Resistor_Box
+    from daqmx_session import session
+    dio = DAQmxEmulator(hs_travel_time=1.)
+    session.use(dio)
+    HPD_Heat_Switch.Driver.performOpen()
+    print('Heat switch opened in {:.2f} s'.format(HPD_Heat_Switch.Driver.startMove('Open').result()))
+    print('Heat switch', dio.heat_switch)
+    ADR_Resistor_Box.Driver.performSetValue('Relay Position', 'Mag Cycle')
+    print('Relay Position', ADR_Resistor_Box.Driver.performGetValue('Relay Position'))
+    dio.set_touch('Touch 4K-50mK', True)
+    print(ADR_DIO.decode(ADR_DIO.DIOSnapshot().read()))
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+Digital line tasks for the NI DIO boxes (ADR_DIO, ADR_RESISTOR_BOX), made
+once and kept.
+
+Making a DAQmx task, adding the channel and clearing it again costs far more
+than the line write or read itself. The session keeps one committed task per
+channel string and direction, so a write or read is a single driver call:
+
+>>> from daqmx_session import session
+>>> session.pulse('ADR_DIO/port1/line1', on=1, off=0)
+>>> session.read_lines('ADR_DIO/port0/line0:1')
+array([1, 1], dtype=uint8)
+
+Inputs are read a whole port at a time: one task per port, and line reads
+are cut out of the port word.
+
+The tasks themselves come from a backend: DAQmxBackend for the NI hardware,
+or daqmx_emulator.DAQmxEmulator, in memory. PyDAQmx is only imported when
+the hardware is first used, so the drivers import without it. Set
+ADR_DIO_BACKEND=emulator before the first use, or call
+session.use(DAQmxEmulator(...)), to run on the emulator.
+"""
+
+import os
+import threading
+import time
+
+import numpy as np
+
+
+# 'dev/port0/line2:4' -> ('dev/port0', [2, 3, 4])
+def split_lines(channel):
+    port, _, lines = channel.rpartition('/')
+    first, _, last = lines.replace('line', '').partition(':')
+    first = int(first)
+    last = first if last == '' else int(last)
+    step = 1 if last >= first else -1
+    return port, list(range(first, last+step, step))
+
+
+# What a backend has to do. DAQmxEmulator does the same on the lines it
+# models.
+class DAQmxBackend():
+    def __init__(self):
+        import PyDAQmx
+        self.mx = PyDAQmx
+
+    # A committed task for an output line channel (kind 'DO') or a whole
+    # input port ('DI'), and its number of channels
+    def create(self, channel, kind):
+        mx = self.mx
+        task = mx.Task()
+        try:
+            if kind == 'DO':
+                task.CreateDOChan(channel, '', mx.DAQmx_Val_ChanPerLine)
+            else: # One channel with every line of the port
+                task.CreateDIChan(channel, '', mx.DAQmx_Val_ChanForAllLines)
+            # Verify and reserve it now, not on every write/read
+            task.TaskControl(mx.DAQmx_Val_Task_Commit)
+            nlines = mx.uInt32()
+            task.GetTaskNumChans(mx.byref(nlines))
+        except Exception:
+            task.ClearTask()
+            raise
+        return task, nlines.value
+
+    def write(self, task, values):
+        mx = self.mx
+        sampsPer = mx.int32()
+        task.WriteDigitalLines(1, mx.bool32(True), 0, mx.DAQmx_Val_GroupByScanNumber,
+                               values, mx.byref(sampsPer), None)
+
+    def read_port(self, task):
+        mx = self.mx
+        value = np.zeros(1, dtype=np.uint32)
+        sampsPer = mx.int32()
+        task.ReadDigitalU32(1, 10.0, mx.DAQmx_Val_GroupByChannel, value, 1,
+                            mx.byref(sampsPer), None)
+        return int(value[0])
+
+    def clear(self, task):
+        task.ClearTask()
+
+    def reset_device(self, device):
+        self.mx.DAQmxResetDevice(device)
+
+    # The time the drivers see
+    def monotonic(self):
+        return time.monotonic()
+
+    def sleep(self, dt):
+        time.sleep(dt)
+
+
+class DIOSession():
+    def __init__(self, backend=None):
+        self._backend = backend
+        self.tasks = dict() # (channel, 'DO' or 'DI'): (task, number of lines)
+        self.lock = threading.RLock()
+
+    # The backend given, or the hardware (the emulator with
+    # ADR_DIO_BACKEND=emulator), made on first use
+    @property
+    def backend(self):
+        with self.lock:
+            if self._backend is None:
+                if os.environ.get('ADR_DIO_BACKEND', 'daqmx') == 'emulator':
+                    from daqmx_emulator import DAQmxEmulator
+                    self._backend = DAQmxEmulator()
+                else:
+                    self._backend = DAQmxBackend()
+            return self._backend
+
+    # Switch to another backend, e.g. an emulator
+    def use(self, backend):
+        with self.lock:
+            self.close()
+            self._backend = backend
+
+    def task(self, channel, kind):
+        key = (channel, kind)
+        with self.lock:
+            if key not in self.tasks:
+                self.tasks[key] = self.backend.create(channel, kind)
+            return self.tasks[key]
+
+    def write_lines(self, channel, values):
+        task, nlines = self.task(channel, 'DO')
+        values = np.broadcast_to(np.asarray(values, dtype=np.uint8), (nlines,)).copy()
+        with self.lock:
+            self.backend.write(task, values)
+
+    # All the lines of an input port (e.g. 'ADR_DIO/port0') as one word,
+    # line 0 in bit 0
+    def read_port(self, port):
+        task, nchans = self.task(port, 'DI')
+        with self.lock:
+            return self.backend.read_port(task)
+
+    # Input lines, e.g. 'ADR_DIO/port0/line0:1', one value per line
+    def read_lines(self, channel):
+        port, lines = split_lines(channel)
+        word = self.read_port(port)
+        return np.array([(word >> line) & 1 for line in lines], dtype=np.uint8)
+
+    # Set a line to on for width seconds, then back to off
+    def pulse(self, channel, on, off, width=0.1):
+        self.write_lines(channel, on)
+        self.sleep(width)
+        self.write_lines(channel, off)
+
+    def monotonic(self):
+        return self.backend.monotonic()
+
+    def sleep(self, dt):
+        self.backend.sleep(dt)
+
+    # Tasks on a device don't survive a reset, so they go first
+    def reset_device(self, device):
+        with self.lock:
+            for key in [key for key in self.tasks if key[0].split('/')[0] == device]:
+                self.backend.clear(self.tasks.pop(key)[0])
+            self.backend.reset_device(device)
+
+    def close(self):
+        with self.lock:
+            for task, nlines in self.tasks.values():
+                self._backend.clear(task)
+            self.tasks = dict()
+
+
+session = DIOSession()
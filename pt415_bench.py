@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the pt415 serial code, run against a fake serial port so no
+compressor is needed.
+
+FakePT415Serial answers SMDP read requests like the CP2800 would. Requests
+and replies each take their time on the line at the baud rate, the device
+answers one request a fixed turnaround after it has come in, and read()
+hands back whatever has arrived, the same as pyserial does.
+
+    python pt415_bench.py
+"""
+
+import struct
+import time
+
+import numpy as np
+
+import pt415_interface
+from pt415_interface import PT415DictEntry, PT415Error, pt415_dict, pt415_bytes, read_until, SMDPFrameReader
+from pt415_emulator import make_read_response, make_write_response
+
+
+codes = dict([(tuple(_field.code), _field) for _field in pt415_dict.values()])
+
+
+class FakePT415Serial():
+    def __init__(self, latency=0.002, baudrate=115200, timeout=2, values=None):
+        self.latency = latency # s, from the end of a request to the first reply byte
+        self.byte_time = 10./baudrate # s, 8N1
+        self.timeout = timeout
+        self.values = dict() if values is None else values # id: value
+        self.pending = [] # (arrival time, byte)
+        self.tx_end = 0. # When the last request finishes arriving at the device
+        self.n_reads = 0
+        self.n_writes = 0
+        self._open = True
+
+    def reply(self, request):
+        body = PT415DictEntry.destuffEscapeChars(request[1:-3])
+        entry = codes[tuple(body[3:6])]
+        if body[2] == pt415_bytes['DATA_WRITE']:
+            return make_write_response(entry.code)
+        return make_read_response(entry, self.values.get(entry.id, 1))
+
+    def write(self, data):
+        self.n_writes += 1
+        now = time.perf_counter()
+        self.tx_end = max(now, self.tx_end) + len(data)*self.byte_time
+        # Replies go out one after the other on the return line
+        t = self.tx_end + self.latency
+        if self.pending:
+            t = max(t, self.pending[-1][0] + self.byte_time)
+        for i, b in enumerate(self.reply(bytearray(data))):
+            self.pending.append((t + i*self.byte_time, b))
+        return len(data)
+
+    def _arrived(self, now):
+        n = 0
+        while n < len(self.pending) and self.pending[n][0] <= now:
+            n += 1
+        return n
+
+    @property
+    def in_waiting(self):
+        return self._arrived(time.perf_counter())
+
+    # Like pyserial: blocks until size bytes are in or the timeout runs out
+    def read(self, size=1):
+        self.n_reads += 1
+        n = min(size, len(self.pending))
+        if n > 0:
+            wait = self.pending[n-1][0] - time.perf_counter()
+            if self.timeout is not None and wait > self.timeout:
+                wait = self.timeout
+            if wait > 0:
+                time.sleep(wait)
+        n = min(size, self._arrived(time.perf_counter()))
+        data = bytes([b for t, b in self.pending[:n]])
+        del self.pending[:n]
+        return data
+
+    def reset_input_buffer(self):
+        self.pending = []
+
+    def isOpen(self):
+        return self._open
+
+    def close(self):
+        self._open = False
+
+
+def bench_reader(nrep=5, latency=0.002):
+    """
+    Full status read (every readable field) with the old byte at a time
+    read_until and with SMDPFrameReader.
+
+    The wall time is mostly the line rate and turnaround either way, the
+    difference is in read calls and CPU time.
+    """
+    fields = [_field for _field in pt415_interface.pt415_fields if _field.permission == 'read']
+    results = dict()
+    for name in ['read_until', 'SMDPFrameReader']:
+        ser = FakePT415Serial(latency=latency)
+        reader = SMDPFrameReader(ser)
+        times = []
+        cpu0 = time.process_time()
+        for rep in range(nrep):
+            t0 = time.perf_counter()
+            for _field in fields:
+                ser.write(_field.read_request)
+                if name == 'read_until':
+                    frame = read_until(ser, '\r', 2)
+                else:
+                    frame = reader.read_frame(2)
+                _field.parseOutput(frame)
+            times.append(time.perf_counter() - t0)
+        cpu = (time.process_time() - cpu0)/nrep
+        results[name] = (np.mean(times), cpu, ser.n_reads/nrep)
+        print(f'{name:16s} {np.mean(times)*1000:8.2f} ms per status read, {cpu*1000:7.2f} ms CPU, {ser.n_reads/nrep:6.0f} read calls')
+    return results
+
+
+def bench_pipeline(nrep=5, latency=0.002, depths=[1, 2, 4, 8]):
+    """
+    Full status read through readFields with different pipeline depths.
+    Depth 1 is one request, one reply.
+    """
+    results = dict()
+    reference = None
+    for depth in depths:
+        ser = FakePT415Serial(latency=latency)
+        times = []
+        for rep in range(nrep):
+            t0 = time.perf_counter()
+            status = pt415_interface.readFields(ser, depth=depth)
+            times.append(time.perf_counter() - t0)
+        if reference is None:
+            reference = status
+        assert status == reference, "Different values back"
+        results[depth] = np.mean(times)
+        print(f'depth {depth}: {np.mean(times)*1000:8.2f} ms per status read')
+    return results
+
+
+# A random, possibly damaged, reply frame for a random read field
+def random_frame(rng, fields, p_damage=0.3):
+    _field = fields[rng.integers(len(fields))]
+    # Values made of 0x02/0x07/0x0D bytes now and then, to exercise the stuffing
+    if rng.random() < 0.3:
+        raw = int.from_bytes(bytes([int(b) for b in rng.choice([0x02, 0x07, 0x0D, 0x30, 0xFF], 4)]), 'big', signed=True)
+    else:
+        raw = int(rng.integers(-2**31, 2**31))
+    body = bytearray([pt415_bytes['PT415_ADDR'], pt415_bytes['CMD_OK'], pt415_bytes['DATA_READ']]) + bytearray(_field.code) + struct.pack('>l', raw)
+    if rng.random() < 0.1:
+        body[1] = int(rng.integers(256)) # Command error
+    frame = (bytearray([pt415_bytes['STX']]) + PT415DictEntry.stuffEscapeChars(body) +
+             PT415DictEntry.getChecksumBytes(body) + bytearray([pt415_bytes['CR']]))
+    if rng.random() < p_damage:
+        kind = rng.integers(5)
+        i = rng.integers(len(frame))
+        if kind == 0: # Flip a byte
+            frame[i] = int(rng.integers(256))
+        elif kind == 1: # Lose a byte
+            del frame[i]
+        elif kind == 2: # Stray escape
+            frame.insert(i, 0x07)
+        elif kind == 3: # Cut short
+            frame = frame[:i]
+        else: # Reply to another field
+            _field = fields[rng.integers(len(fields))]
+    return _field, frame
+
+
+def check_codec(n=20000, seed=0):
+    """
+    decodeFrames against parseOutput on random good and damaged frames.
+    Values must be identical and errors must carry the same code.
+    A quick check before benchmarking; the tests are in test_pt415_codec.py.
+    """
+    rng = np.random.default_rng(seed)
+    fields = [_field for _field in pt415_interface.pt415_fields if _field.permission == 'read']
+    pairs = [random_frame(rng, fields) for i in range(n)]
+    decoded = pt415_interface.decodeFrames([frame for _field, frame in pairs], [_field for _field, frame in pairs])
+    for (_field, frame), row in zip(pairs, decoded):
+        value, ok, error = pt415_interface._parseFrame(_field, frame)
+        assert ok == row['ok'] and error == row['error'], (frame, row, ok, error)
+        if ok:
+            assert np.float64(value).tobytes() == row['value'].tobytes(), (frame, row, value)
+            assert _field.data_type(row['value']) == value
+    print(f'decodeFrames matches parseOutput on {n} random frames ({np.sum(~decoded["ok"])} bad)')
+
+
+def bench_codec(n=20000, seed=1):
+    """
+    Frames per second through parseOutput one at a time and decodeFrames.
+    """
+    rng = np.random.default_rng(seed)
+    fields = [_field for _field in pt415_interface.pt415_fields if _field.permission == 'read']
+    pairs = [random_frame(rng, fields, p_damage=0) for i in range(n)]
+    frames = [frame for _field, frame in pairs]
+    field_list = [_field for _field, frame in pairs]
+
+    t0 = time.perf_counter()
+    for _field, frame in pairs:
+        try:
+            _field.parseOutput(frame)
+        except PT415Error:
+            pass
+    t_loop = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    pt415_interface.decodeFrames(frames, field_list)
+    t_batch = time.perf_counter() - t0
+    print(f'parseOutput  {n/t_loop:12.0f} frames/s')
+    print(f'decodeFrames {n/t_batch:12.0f} frames/s')
+    return n/t_loop, n/t_batch
+
+
+if __name__ == '__main__':
+    print(f'{len(pt415_interface.pt415_names)} fields, 115200 baud, 2 ms turnaround')
+    bench_reader()
+    bench_pipeline()
+    check_codec()
+    bench_codec()
@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+"""
+Emulator of the pt415's CP2800 compressor controller, speaking the Sycon
+Multi-Drop Protocol subset pt415_interface uses, on a pty.
+
+pt415_interface runs against it unchanged:
+
+>>> from pt415_emulator import PT415Emulator
+>>> emu = PT415Emulator(latency=0.005, drop_rate=1e-3, corrupt_rate=0.01).start()
+>>> status = pt415_interface.readPT415Status_Serial(port=emu.port_name)
+
+Or run this file to start one and stress the driver against it:
+    python pt415_emulator.py [--serve]
+
+Handles DATA_READ of every hash code in pt415_fields and DATA_WRITE of
+turn_on, turn_off and reset_min_max, with byte stuffing and checksums both
+ways. Requests with a bad checksum or an unknown hash code get an error
+reply; requests for another address get none, as on a multi-drop line.
+
+Faults for testing the driver:
+    latency: s from the end of a request to the start of its reply
+    drop_rate: chance that any one reply byte is lost
+    corrupt_rate: chance that a reply has a wrong checksum
+
+Values come from model.values, or from model.signals if a function of time
+is set there (e.g. by a physics simulator).
+"""
+
+import struct
+import sys
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+from pty_emulator import PtyEmulator
+from pt415_interface import PT415DictEntry, pt415_fields, pt415_dict, pt415_bytes
+
+# SMDP response codes, in the low bits of the reply's command byte
+RSP_OK = 1
+RSP_INVALID_CMD = 2 # Unknown hash code or command
+RSP_SYNTAX = 3 # Bad checksum or malformed frame
+
+# Frames
+
+def make_frame(body):
+    return (bytearray([pt415_bytes['STX']]) + PT415DictEntry.stuffEscapeChars(body) +
+            PT415DictEntry.getChecksumBytes(body) + bytearray([pt415_bytes['CR']]))
+
+def response_byte(code):
+    return 0x88 | code # CMD_OK is 0x89
+
+# Reply frame to a read request for entry, holding value (in entry units)
+def make_read_response(entry, value, rsp=RSP_OK):
+    raw = int(round(value/entry.increment)) if entry.increment else int(value)
+    body = bytearray([pt415_bytes['PT415_ADDR'], response_byte(rsp), pt415_bytes['DATA_READ']]) + bytearray(entry.code) + struct.pack('>l', raw)
+    return make_frame(body)
+
+# Reply frame to a write request, or an error reply to anything
+def make_write_response(entry_code, cmd=pt415_bytes['DATA_WRITE'], rsp=RSP_OK):
+    body = bytearray([pt415_bytes['PT415_ADDR'], response_byte(rsp), cmd]) + bytearray(entry_code)
+    return make_frame(body)
+
+
+####################################################################
+class PT415Model():
+    """
+    The compressor's data dictionary and how it answers requests.
+    """
+    defaults = {'cpu_temp':35.0, 'compressor_hours':12345.0, 'motor_current':11.0,
+                'temp_water_in':18.0, 'temp_water_out':27.0, 'temp_helium':60.0, 'temp_oil':35.0,
+                'pressure_high_side':280.0, 'pressure_low_side':95.0,
+                'avg_pressure_low_side':95.0, 'avg_pressure_high_side':280.0, 'avg_pressure_delta':185.0,
+                'diodes_uv':0.0, 'diode1_temp':45.0, 'diode2_temp':3.5,
+                'compressor_on':True, 'error_code':0}
+
+    def __init__(self):
+        self.values = dict([(name, 0.0) for name in pt415_dict])
+        self.values.update(self.defaults)
+        self.signals = dict() # name: function of time giving the value
+        self.codes = dict([(tuple(_field.code), _field) for _field in pt415_fields])
+        self.reset_min_max(time.monotonic())
+        self.requests = 0
+        self.writes = []
+
+    def value(self, name, t):
+        if name in self.signals:
+            return self.signals[name](t)
+        return self.values[name]
+
+    def reset_min_max(self, t):
+        for name in pt415_dict:
+            for prefix in ['min_', 'max_']:
+                if name.startswith(prefix) and name[4:] in self.values:
+                    self.values[name] = self.value(name[4:], t)
+
+    def set_on(self, on):
+        self.values['compressor_on'] = on
+        self.values['motor_current'] = self.defaults['motor_current'] if on else 0.0
+
+    def reply(self, request, t):
+        """
+        Reply to one request frame (STX ... CR) as bytes, or None for no reply.
+        """
+        self.requests += 1
+        body = PT415DictEntry.destuffEscapeChars(request[1:-3])
+        if len(body) < 1 or body[0] != pt415_bytes['PT415_ADDR']:
+            return None # Someone else on the line
+        if len(body) < 6 or PT415DictEntry.getChecksumBytes(body) != request[-3:-1]:
+            return make_write_response(body[3:6] if len(body) >= 6 else b'\x00\x00\x00',
+                                       body[2] if len(body) > 2 else 0, RSP_SYNTAX)
+        cmd, code = body[2], tuple(body[3:6])
+        entry = self.codes.get(code)
+        if entry is None or body[1] != pt415_bytes['CMD'] or cmd not in [pt415_bytes['DATA_READ'], pt415_bytes['DATA_WRITE']]:
+            return make_write_response(code, cmd, RSP_INVALID_CMD)
+
+        if cmd == pt415_bytes['DATA_READ']:
+            if entry.permission != 'read':
+                return make_write_response(code, cmd, RSP_INVALID_CMD)
+            return make_read_response(entry, self.value(entry.id, t))
+
+        if entry.permission != 'write' or len(body) != 10:
+            return make_write_response(code, cmd, RSP_INVALID_CMD)
+        self.writes.append((t, entry.id, struct.unpack('>l', body[6:10])[0]))
+        if entry.id == 'turn_on':
+            self.set_on(True)
+        elif entry.id == 'turn_off':
+            self.set_on(False)
+        elif entry.id == 'reset_min_max':
+            self.reset_min_max(t)
+        return make_write_response(code)
+
+
+####################################################################
+class PT415Emulator(PtyEmulator):
+    def __init__(self, model=None, latency=0.005, baudrate=115200,
+                 drop_rate=0., corrupt_rate=0., seed=None):
+        super().__init__()
+        self.model = PT415Model() if model is None else model
+        self.latency = latency
+        self.byte_time = 10./baudrate # s, 8N1
+        self.drop_rate = drop_rate
+        self.corrupt_rate = corrupt_rate
+        self.rng = np.random.default_rng(seed)
+        self.rx = bytearray()
+        self.output = deque() # (time due, bytes)
+        self.busy_until = 0. # The reply line is busy until then
+        self.lock = threading.Lock()
+        self.dropped = 0
+        self.corrupted = 0
+
+    def damage(self, frame):
+        frame = bytearray(frame)
+        if self.corrupt_rate and self.rng.random() < self.corrupt_rate:
+            frame[-2] = 0x30 + (frame[-2] - 0x30 + 1) % 16
+            self.corrupted += 1
+        if self.drop_rate:
+            keep = self.rng.random(len(frame)) >= self.drop_rate
+            self.dropped += int(np.sum(~keep))
+            frame = bytearray(np.frombuffer(bytes(frame), dtype=np.uint8)[keep].tobytes())
+        return bytes(frame)
+
+    def handle_bytes(self, data):
+        now = time.monotonic()
+        self.rx += data
+        while True:
+            start = self.rx.find(b'\x02')
+            if start < 0:
+                self.rx.clear()
+                return
+            end = self.rx.find(b'\x0D', start)
+            if end < 0:
+                del self.rx[:start]
+                return
+            request = bytes(self.rx[start:end+1])
+            del self.rx[:end+1]
+            frame = self.model.reply(request, now)
+            if frame is None:
+                continue
+            frame = self.damage(frame)
+            with self.lock:
+                # One reply at a time on the line, each after the turnaround
+                due = max(now + self.latency, self.busy_until)
+                self.busy_until = due + len(frame)*self.byte_time
+                self.output.append((self.busy_until, frame))
+
+    def tick(self, now):
+        out = bytearray()
+        with self.lock:
+            while self.output and self.output[0][0] <= now:
+                out += self.output.popleft()[1]
+        if out:
+            self.send(bytes(out))
+
+
+####################################################################
+def stress(nrep=20, **faults):
+    """
+    Status reads through pt415_interface against an emulator with the given
+    faults, at a few pipeline depths. Prints the time per read and how many
+    fields came back wrong.
+    """
+    import io
+    import pt415_interface
+    with PT415Emulator(seed=0, **faults) as emu:
+        expected = pt415_interface.readFields(PerfectPort(emu.model), io.StringIO())
+        print(f'Emulator on {emu.port_name}, {faults}')
+        default_depth = pt415_interface.pipeline_depth
+        for depth in [1, 4]:
+            pt415_interface.pipeline_depth = depth
+            client = pt415_interface.PT415Client(emu.port_name, timeout=0.2)
+            errors = io.StringIO()
+            wrong = 0
+            t0 = time.perf_counter()
+            for _i in range(nrep):
+                status = client.read_status(errfile=errors, force=True)
+                wrong += sum([status[k] != expected[k] for k in status])
+            dt = (time.perf_counter() - t0)/nrep
+            client.close()
+            print(f'  depth {depth}: {dt*1000:7.1f} ms per status read, '
+                  f'{wrong} wrong fields, {len(errors.getvalue().splitlines())} errors logged')
+        pt415_interface.pipeline_depth = default_depth
+        print(f'  {emu.dropped} bytes dropped, {emu.corrupted} checksums corrupted')
+
+
+# Serial port stand-in that answers straight from a model, for reference values
+class PerfectPort():
+    def __init__(self, model):
+        self.model = model
+        self.pending = bytearray()
+        self.timeout = 0
+
+    def write(self, data):
+        self.pending += self.model.reply(bytes(data), time.monotonic())
+        return len(data)
+
+    @property
+    def in_waiting(self):
+        return len(self.pending)
+
+    def read(self, size=1):
+        data = bytes(self.pending[:size])
+        del self.pending[:size]
+        return data
+
+    def reset_input_buffer(self):
+        self.pending.clear()
+
+
+if __name__ == '__main__':
+    if '--serve' in sys.argv:
+        emu = PT415Emulator().start()
+        print(f'PT415 emulator on {emu.port_name}')
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        emu.close()
+    else:
+        stress()
+        stress(drop_rate=1e-3, corrupt_rate=0.01)
@@ -2,8 +2,11 @@
 Code used to interact with the pt415 pulse-tube cooler via a serial port.
 
 To query the pt415, invoke the following:
->>> import pt415_reader
->>> pt415_status = pt415_reader.readPT415Status()
+>>> import pt415_interface
+>>> pt415_status = pt415_interface.readPT415Status_Serial()
+
+The port stays open between calls (see PT415Client). To let go of it:
+>>> pt415_interface.get_client().close()
 
 This module is laid out as follows:
     Exception(s)
@@ -28,17 +31,39 @@ Stephen Hoover, 18 Jan 2012
 """
 
 
+import asyncio
+import functools
 import serial
 import struct
 import sys
+import threading
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 
+import serial_trace
+
 com_port = 'COM4'
 baudrate = 115200
 
-# PySerial no longer has a read until method, so need to make our own
+# Serial trace recorder (see serial_trace.py), None for no tracing
+trace_recorder = serial_trace.default_recorder()
+
+def set_trace(recorder):
+    global trace_recorder
+    trace_recorder = recorder
+
+# Open the serial port to the pt415, wrapped for tracing if it's on
+def open_connection(port=com_port, baudrate=baudrate, timeout=2):
+    conn = serial.Serial(port, baudrate, timeout=timeout)
+    if trace_recorder is not None:
+        conn = serial_trace.TracedSerial(conn, trace_recorder, 'PT415')
+    return conn
+
+# PySerial no longer has a read until method, so need to make our own.
+# One byte per read; SMDPFrameReader below is what the driver uses.
 def read_until(ser, term=0x0D, timeout=2):
     if type(term) != int:
         term = ord(term)
@@ -49,12 +74,82 @@ def read_until(ser, term=0x0D, timeout=2):
         next_byte = ser.read(1)
         if next_byte != b'':
             response.append(ord(next_byte))
-        if time.time() - start > 2.0:
+        if time.time() - start > timeout:
             raise Exception("Serial read timed out")
 
     return response
 
 
+class SMDPFrameReader():
+    """
+    Reads whole SMDP frames (STX ... CR) from a serial port.
+
+    Takes everything waiting in the input buffer in one read and keeps any
+    bytes past the end of a frame for the next call, so a frame split over
+    reads or several frames in one read are both fine. Bytes before an STX
+    (line noise, the tail of a frame we gave up on) are dropped, and so is a
+    frame that lost its CR, when the next STX turns up.
+
+    Byte stuffing means STX and CR only ever appear as frame delimiters.
+    """
+    # Shortest replies: STX, address, CMD_OK, DATA_READ/DATA_WRITE, 3 byte code,
+    # 4 data bytes (reads only), 2 check bytes, CR
+    min_read_frame = 14
+    min_write_frame = 10
+
+    def __init__(self, ser):
+        self.ser = ser
+        self.buffer = bytearray()
+
+    def clear(self):
+        self.buffer.clear()
+        self.ser.reset_input_buffer()
+
+    # Split the first complete frame off the buffer, or None
+    def _pop_frame(self):
+        start = self.buffer.find(b'\x02')
+        if start < 0:
+            self.buffer.clear()
+            return None
+        end = self.buffer.find(b'\x0D', start)
+        # A second STX before the CR means this frame lost its end
+        restart = self.buffer.rfind(b'\x02', start+1, len(self.buffer) if end < 0 else end)
+        if restart > 0:
+            start = restart
+        if end < 0:
+            del self.buffer[:start]
+            return None
+        frame = self.buffer[start:end+1]
+        del self.buffer[:end+1]
+        return frame
+
+    def read_frame(self, timeout=2, deadline=None, min_frame=min_read_frame):
+        """
+        Returns the next frame as a bytearray. Raises PT415Error if none is
+        complete by the deadline (time.monotonic() value), or timeout
+        seconds from now if no deadline is given.
+
+        min_frame is the shortest frame we expect, so we can wait for that
+        many bytes in one read instead of picking them up as they trickle in.
+        """
+        if deadline is None:
+            deadline = time.monotonic() + timeout
+        while True:
+            frame = self._pop_frame()
+            if frame is not None:
+                return frame
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise PT415Error((-5, "Serial read timed out"))
+            n = self.ser.in_waiting
+            if n == 0:
+                # Nothing there yet: block until at least a whole frame
+                # could be in, but not past the deadline
+                self.ser.timeout = remaining
+                n = max(1, min_frame - len(self.buffer))
+            self.buffer += self.ser.read(n)
+
+
 # Bytes which have special significance in communicating with the pt415.
 # See "Sycon Multi Drop Protocol, DOC VERSION 1.5, 2008-10-09"
 pt415_bytes  = {'STX':0x02, # Start text
@@ -106,7 +201,7 @@ class PT415DictEntry:
             A tuple of the two checksum bytes used by the SMDP, created by
             summing together every byte in the input.
         """
-        cksum = sum([b for b in bytearray(byte_list)])
+        cksum = sum(bytearray(byte_list))
         check_byte1 = ((cksum & 0xF0) >> 4) + 0x30
         check_byte2 = (cksum & 0x0F) + 0x30
 
@@ -130,20 +225,8 @@ class PT415DictEntry:
             A list of bytes, in which reserved characters in the input byte_list
             have been translated to an escape character followed by another character.
         """
-        stuffed_list = bytearray()
-        for byte in bytearray(byte_list):
-            if byte == 0x02:
-                stuffed_list.append(0x07)
-                stuffed_list.append(0x30)
-            elif byte == 0x0D:
-                stuffed_list.append(0x07)
-                stuffed_list.append(0x31)
-            elif byte == 0x07:
-                stuffed_list.append(0x07)
-                stuffed_list.append(0x32)
-            else:
-                stuffed_list.append(byte)
-
+        # 0x07 first, so the escapes added for 0x02 and 0x0D aren't stuffed again
+        stuffed_list = bytearray(byte_list).replace(b'\x07', b'\x07\x32').replace(b'\x02', b'\x07\x30').replace(b'\x0D', b'\x07\x31')
         return stuffed_list
 
     ####################################################################
@@ -170,7 +253,8 @@ class PT415DictEntry:
 
     ####################################################################
     def __init__(self, _id, code, units="", increment=0.1,
-                 data_type=float, default_value=0, permission='read'):
+                 data_type=float, default_value=0, permission='read', poll_interval=0,
+                 dtype=None):
         """
         INPUTS
             _id: (string) The name of this data type.
@@ -190,6 +274,13 @@ class PT415DictEntry:
 
             default_value [0]: Default value returned for this dictionary entry,
                 if the data read fails.
+
+            poll_interval [0]: (float) Seconds between reads of this entry by
+                PT415Client. 0 reads it every time; slow or rarely changing
+                entries reuse their last value in between.
+
+            dtype [None]: numpy type of this entry in status records (see
+                status_dtype). Defaults to float32, bool or int32 by data_type.
         """
         self.id = _id
         self.code = code
@@ -200,6 +291,33 @@ class PT415DictEntry:
 
         # Can we read from this dictionary entry?
         self.permission = permission
+        self.poll_interval = poll_interval
+        if dtype is None:
+            dtype = {float:'f4', bool:'?', int:'i4'}[data_type]
+        self.dtype = np.dtype(dtype)
+
+        # The request frames never change, so build them once
+        self.read_request = bytes(self.getReadRequest()) if permission == 'read' else None
+        self.write_request = bytes(self.getWriteRequest()) if permission == 'write' else None
+
+    ####################################################################
+    @staticmethod
+    def checksumOK(output_array):
+        """
+        True if the check bytes of a reply frame match its contents.
+        """
+        destuffed_array = PT415DictEntry.destuffEscapeChars(output_array[1:-3])
+        return PT415DictEntry.getChecksumBytes(destuffed_array) == output_array[-3:-1]
+
+    ####################################################################
+    @staticmethod
+    def echoedCode(output_array):
+        """
+        The dictionary hash code echoed in a reply frame, as a tuple, so the
+        reply can be matched to its request.
+        """
+        destuffed_array = PT415DictEntry.destuffEscapeChars(output_array[1:-3])
+        return tuple(destuffed_array[3:6])
 
 
     ####################################################################
@@ -282,10 +400,11 @@ class PT415DictEntry:
         it sees anything that looks wrong.
         """
         # First, verify that the bytearray we received has the correct form.
-        if (output_array[0]!=pt415_bytes['STX'] or
+        if (len(output_array) < 4 or
+            output_array[0]!=pt415_bytes['STX'] or
             output_array[-1]!=pt415_bytes['CR'] or
             output_array[3]!=pt415_bytes['DATA_READ']):
-            raise PT415Error((-1, "Invalid return data ("+output_array+")."))
+            raise PT415Error((-1, "Invalid return data ("+repr(output_array)+")."))
 
         # Verify the device address.
         if output_array[1]!=pt415_bytes['PT415_ADDR']:
@@ -294,7 +413,7 @@ class PT415DictEntry:
         # Examine the "command received" byte to see if the pt415 itself
         # has indicated an error with the data read.
         if output_array[2]!=pt415_bytes['CMD_OK']:
-            raise PT415Error(( bytearray(output_array[2])[0] & 0x07, "Command error!"))
+            raise PT415Error(( output_array[2] & 0x07, "Command error!"))
 
         # Compute the check bytes and compare to the check bytes in the received string.
         destuffed_array = self.destuffEscapeChars(output_array[1:-3])
@@ -309,8 +428,14 @@ class PT415DictEntry:
                                ") is for a different command!"))
 
         # Pull out the data. The data should be a 4-byte, big-endian long integer.
-        # The call to struct.unpack will complain if the size is wrong.
-        data_bytes = self.destuffEscapeChars(output_array)[4+len(self.code):-3]
+        # Reuse the destuffed body, unless its last byte is a lone escape
+        # that destuffing the whole frame would pair with a check byte.
+        if output_array[-4] != 0x07:
+            data_bytes = destuffed_array[3+len(self.code):]
+        else:
+            data_bytes = self.destuffEscapeChars(output_array)[4+len(self.code):-3]
+        if len(data_bytes) != 4:
+            raise PT415Error((-1, "Invalid return data ("+repr(output_array)+")."))
         data = self.increment*self.data_type(struct.unpack(">l",data_bytes)[0])
         data = self.data_type(data) # Mostly used when data_type is bool. Can't hurt other data_types.
 
@@ -318,11 +443,15 @@ class PT415DictEntry:
 ####################################################################
 ####################################################################
 
+# Entries with this poll_interval (s) are read by PT415Client only now and
+# then: counters, min/max values and settings.
+cold_interval = 60.
+
 # Hash values for accessing the pt415's data dictionary.
 # This list will be converted to a dictionary immediately
 # after we finish defining it.
-pt415_fields = [PT415DictEntry('cpu_temp',[0x35,0x74,0x00],"Celcius",0.1),
-                PT415DictEntry('compressor_hours',[0x45,0x4C,0x00],"Hours",1./60),
+pt415_fields = [PT415DictEntry('cpu_temp',[0x35,0x74,0x00],"Celcius",0.1,poll_interval=cold_interval),
+                PT415DictEntry('compressor_hours',[0x45,0x4C,0x00],"Hours",1./60,poll_interval=cold_interval,dtype='f8'),
                 PT415DictEntry('motor_current',[0x63,0x8B,0x00],'Amps',1.),
 
                 # Temperatures
@@ -330,14 +459,14 @@ pt415_fields = [PT415DictEntry('cpu_temp',[0x35,0x74,0x00],"Celcius",0.1),
                 PT415DictEntry('temp_water_out',[0x0D,0x8F,0x01],"Celcius",0.1),
                 PT415DictEntry('temp_helium',[0x0D,0x8F,0x02],"Celcius",0.1),
                 PT415DictEntry('temp_oil',[0x0D,0x8F,0x03],"Celcius",0.1),
-                PT415DictEntry('min_temp_water_in',[0x6E,0x58,0x00],"Celcius",0.1),
-                PT415DictEntry('min_temp_water_out',[0x6E,0x58,0x01],"Celcius",0.1),
-                PT415DictEntry('min_temp_helium',[0x6E,0x58,0x02],"Celcius",0.1),
-                PT415DictEntry('min_temp_oil',[0x6E,0x58,0x03],"Celcius",0.1),
-                PT415DictEntry('max_temp_water_in',[0x8A,0x1C,0x00],"Celcius",0.1),
-                PT415DictEntry('max_temp_water_out',[0x8A,0x1C,0x01],"Celcius",0.1),
-                PT415DictEntry('max_temp_helium',[0x8A,0x1C,0x02],"Celcius",0.1),
-                PT415DictEntry('max_temp_oil',[0x8A,0x1C,0x03],"Celcius",0.1),
+                PT415DictEntry('min_temp_water_in',[0x6E,0x58,0x00],"Celcius",0.1,poll_interval=cold_interval),
+                PT415DictEntry('min_temp_water_out',[0x6E,0x58,0x01],"Celcius",0.1,poll_interval=cold_interval),
+                PT415DictEntry('min_temp_helium',[0x6E,0x58,0x02],"Celcius",0.1,poll_interval=cold_interval),
+                PT415DictEntry('min_temp_oil',[0x6E,0x58,0x03],"Celcius",0.1,poll_interval=cold_interval),
+                PT415DictEntry('max_temp_water_in',[0x8A,0x1C,0x00],"Celcius",0.1,poll_interval=cold_interval),
+                PT415DictEntry('max_temp_water_out',[0x8A,0x1C,0x01],"Celcius",0.1,poll_interval=cold_interval),
+                PT415DictEntry('max_temp_helium',[0x8A,0x1C,0x02],"Celcius",0.1,poll_interval=cold_interval),
+                PT415DictEntry('max_temp_oil',[0x8A,0x1C,0x03],"Celcius",0.1,poll_interval=cold_interval),
                 PT415DictEntry('temp_error',[0x6E,0x2D,0x00],data_type=bool),
 
                 # Pressures
@@ -345,10 +474,10 @@ pt415_fields = [PT415DictEntry('cpu_temp',[0x35,0x74,0x00],"Celcius",0.1),
                 # 1 psi approximately equals 6,894.757 Pa
                 PT415DictEntry('pressure_high_side',[0xAA,0x50,0x00],"PSIA",0.1),
                 PT415DictEntry('pressure_low_side',[0xAA,0x50,0x01],"PSIA",0.1),
-                PT415DictEntry('min_pressure_high_side',[0x5E,0x0B,0x00],"PSIA",0.1),
-                PT415DictEntry('min_pressure_low_side',[0x5E,0x0B,0x01],"PSIA",0.1),
-                PT415DictEntry('max_pressure_high_side',[0x7A,0x62,0x00],"PSIA",0.1),
-                PT415DictEntry('max_pressure_low_side',[0x7A,0x62,0x01],"PSIA",0.1),
+                PT415DictEntry('min_pressure_high_side',[0x5E,0x0B,0x00],"PSIA",0.1,poll_interval=cold_interval),
+                PT415DictEntry('min_pressure_low_side',[0x5E,0x0B,0x01],"PSIA",0.1,poll_interval=cold_interval),
+                PT415DictEntry('max_pressure_high_side',[0x7A,0x62,0x00],"PSIA",0.1,poll_interval=cold_interval),
+                PT415DictEntry('max_pressure_low_side',[0x7A,0x62,0x01],"PSIA",0.1,poll_interval=cold_interval),
                 PT415DictEntry('pressure_error',[0xF8,0x2B,0x00],data_type=bool),
                 PT415DictEntry('avg_pressure_low_side',[0xBB,0x94,0x00],"PSIA",0.1),
                 PT415DictEntry('avg_pressure_high_side',[0x7E,0x90,0x00],"PSIA",0.1),
@@ -361,7 +490,7 @@ pt415_fields = [PT415DictEntry('cpu_temp',[0x35,0x74,0x00],"Celcius",0.1),
                 PT415DictEntry('diode2_temp',[0x58,0x13,0x01],"Kelvin",0.01),
                 PT415DictEntry('diode1_error',[0xD6,0x44,0x00],data_type=bool),
                 PT415DictEntry('diode2_error',[0xD6,0x44,0x01],data_type=bool),
-                PT415DictEntry('diodes_using_custom_cal_curve',[0x99,0x65,0x00],data_type=bool),
+                PT415DictEntry('diodes_using_custom_cal_curve',[0x99,0x65,0x00],data_type=bool,poll_interval=cold_interval),
 
                 # Compressor control and status
                 PT415DictEntry('compressor_on',[0x5F,0x95,0x00],data_type=bool),
@@ -377,68 +506,466 @@ pt415_dict = dict( [(_field.id, _field)
                           for _field in pt415_fields] )
 pt415_names = [_field.id for _field in pt415_fields if _field.permission=='read']
 
+# A status read as one numpy record, fields in pt415_names order
+status_dtype = np.dtype([(_field.id, _field.dtype) for _field in pt415_fields if _field.permission=='read'])
+
+def newStatusRecord():
+    return np.zeros((), dtype=status_dtype)
+
+# Copy a status dictionary into a status record in one go
+def fillStatusRecord(status, record=None):
+    if record is None:
+        record = newStatusRecord()
+    record[()] = tuple([status[name] for name in pt415_names])
+    return record
+
 ####################################################################
+# Decoding many reply frames at once
+
+# decodeFrames output, one row per frame. ok is False if parseOutput would
+# have raised; error is then the PT415Error code (-6 for any other exception).
+frame_dtype = np.dtype([('value', 'f8'), ('ok', '?'), ('error', 'i2')])
+
+_unescape = np.arange(256, dtype=np.uint8)
+_unescape[[0x30, 0x31, 0x32]] = [0x02, 0x0D, 0x07]
+
+# (value, ok, error) from parseOutput
+def _parseFrame(_field, frame):
+    try:
+        return _field.parseOutput(frame), True, 0
+    except PT415Error as err:
+        return 0, False, err.args[0][0]
+    except Exception:
+        return 0, False, -6
+
+def decodeFrames(frames, fields):
+    """
+    Parse a batch of reply frames in one go, with the same result as
+    fields[i].parseOutput(frames[i]) for each frame, bit for bit.
+
+    The checks, destuffing, checksums and data words are done on all the
+    frames together with numpy. Frames that only parseOutput knows how to
+    take apart (wrong length, stray escape bytes) are handed to it.
+
+    INPUTS
+        frames: list of reply frames (STX ... CR)
+        fields: list of PT415DictEntry, the request each frame answers
 
-def readPT415Status_Serial(port=com_port, baudrate = baudrate, errfile=sys.stderr):
+    OUTPUT
+        numpy array of frame_dtype
     """
-    Open a socket connection to the pt415 and read out the values of
-    every dictionary entry in the "pt415_fields" variable.
+    out = np.zeros(len(frames), dtype=frame_dtype)
+    if len(frames) == 0:
+        return out
+    lens = np.array([len(frame) for frame in frames])
+    buf = np.frombuffer(b''.join([bytes(frame) for frame in frames]), dtype=np.uint8)
+    starts = np.concatenate([[0], np.cumsum(lens)[:-1]])
+
+    # Byte positions in their frame, and the body (between STX and the check bytes)
+    frame_idx = np.repeat(np.arange(len(frames)), lens)
+    pos = np.arange(len(buf)) - starts[frame_idx]
+    in_body = (pos >= 1) & (pos < lens[frame_idx] - 3)
+
+    # Escapes we can undo in one pass: 0x07 followed by 0x30-0x32, inside the body
+    escape = in_body & (buf == 0x07)
+    escape_at = np.nonzero(escape)[0]
+    good_escape = np.zeros(len(buf), dtype=bool)
+    ok_pair = (escape_at + 1 < len(buf))
+    ok_pair[ok_pair] &= in_body[escape_at[ok_pair] + 1] & (buf[escape_at[ok_pair] + 1] >= 0x30) & (buf[escape_at[ok_pair] + 1] <= 0x32)
+    good_escape[escape_at[ok_pair]] = True
+    bad_escapes = np.bincount(frame_idx[escape & ~good_escape], minlength=len(frames))
+
+    n_escapes = np.bincount(frame_idx[good_escape], minlength=len(frames))
+    body_len = lens - 4 - n_escapes
+    # Address, CMD, DATA_READ, 3 code bytes and 4 data bytes
+    fast = (lens >= 14) & (bad_escapes == 0) & (body_len == 10)
+
+    destuffed = buf.copy()
+    destuffed[escape_at[ok_pair] + 1] = _unescape[buf[escape_at[ok_pair] + 1]]
+    keep = in_body & ~good_escape & fast[frame_idx]
+    body = destuffed[keep].reshape(-1, 10)
+    f_starts = starts[fast]
+    f_ends = f_starts + lens[fast]
+    f_fields = [fields[i] for i in np.nonzero(fast)[0]]
+
+    # Same checks, same order as parseOutput (later ones overwritten by earlier ones)
+    error = np.zeros(len(body), dtype=np.int16)
+    codes = np.array([_field.code for _field in f_fields], dtype=np.uint8).reshape(-1, 3)
+    error[np.any(body[:, 3:6] != codes, axis=1)] = -3
+    cksum = body.sum(axis=1, dtype=np.int64)
+    check_bytes_ok = ((buf[f_ends-3] == ((cksum & 0xF0) >> 4) + 0x30) &
+                      (buf[f_ends-2] == (cksum & 0x0F) + 0x30))
+    error[~check_bytes_ok] = -4
+    cmd = buf[f_starts+2]
+    error[cmd != pt415_bytes['CMD_OK']] = cmd[cmd != pt415_bytes['CMD_OK']] & 0x07
+    error[buf[f_starts+1] != pt415_bytes['PT415_ADDR']] = -2
+    error[(buf[f_starts] != pt415_bytes['STX']) |
+          (buf[f_ends-1] != pt415_bytes['CR']) |
+          (buf[f_starts+3] != pt415_bytes['DATA_READ'])] = -1
+    ok = (error == 0) & (cmd == pt415_bytes['CMD_OK']) & check_bytes_ok
+
+    # The data word, scaled like parseOutput does it for each data_type
+    raw = np.ascontiguousarray(body[:, 6:10]).view('>i4')[:, 0].astype(np.float64)
+    increment = np.array([float(_field.increment) for _field in f_fields])
+    is_bool = np.array([_field.data_type == bool for _field in f_fields], dtype=bool)
+    is_int = np.array([_field.data_type == int for _field in f_fields], dtype=bool)
+    value = increment*raw
+    value[is_bool] = (increment[is_bool] != 0) & (raw[is_bool] != 0)
+    value[is_int] += 0. # Integer products have no -0
+
+    out['value'][fast] = np.where(ok, value, 0)
+    out['ok'][fast] = ok
+    out['error'][fast] = error
+
+    # Everything else the slow way
+    for i in np.nonzero(~fast)[0]:
+        out[i] = _parseFrame(fields[i], frames[i])
+    return out
+
+
+# How many read requests readFields keeps outstanding at once. SMDP is
+# half-duplex poll/response, so the default is strictly one request, one
+# reply. Deeper pipelining (e.g. 4, see pt415_bench.bench_pipeline) is
+# opt-in, and only once the CP2800 has been checked to take it.
+pipeline_depth = 1
+
+####################################################################
+
+def defaultStatus():
+    return dict( [(_field.id, _field.default_value)
+                  for _field in pt415_fields if _field.permission == 'read'] )
+
+
+def readFields(connection, errfile=sys.stderr, timeout=2, depth=None):
+    """
+    Read every readable field in "pt415_fields" over an open connection.
+    Fields that fail keep their default value; the error goes to errfile.
+    """
+    # Create an empty dict in which to store the pt415 status that we'll read out.
+    # Default to every field being zero.
+    pt415_status = defaultStatus()
+    pt415_status.update(readValues(connection, pt415_status.keys(), errfile, timeout, depth))
+    return pt415_status
+
+
+def readValues(connection, names, errfile=sys.stderr, timeout=2, depth=None,
+               deadline=None, cancel=None):
+    """
+    Read the named fields over an open connection. Returns a dictionary of
+    the ones that were read successfully; errors go to errfile.
+
+    Up to depth (default pipeline_depth) requests are kept in flight, so the
+    pt415's turnaround for one field overlaps with the replies to the
+    others. Replies are matched to requests by the echoed hash code.
+
+    Fields not read by deadline (a time.monotonic() value) are left out.
+    If cancel (a threading.Event) gets set, PT415Error -7 is raised at the
+    next request or reply.
+    """
+    if depth is None:
+        depth = pipeline_depth
+
+    pt415_status = dict()
+    reader = SMDPFrameReader(connection)
+    to_send = deque([pt415_dict[name] for name in names])
+    in_flight = dict() # echoed code: field, in the order sent
+
+    while to_send or in_flight:
+        if cancel is not None and cancel.is_set():
+            raise PT415Error((-7, "Cancelled"))
+
+        # Top up the requests in flight
+        while to_send and len(in_flight) < depth:
+            _field = to_send.popleft()
+            connection.write(_field.read_request)
+            in_flight[tuple(_field.code)] = _field
+
+        frame_deadline = time.monotonic() + timeout
+        if deadline is not None:
+            frame_deadline = min(frame_deadline, deadline)
+        try:
+            pt415_response = reader.read_frame(deadline=frame_deadline)
+        except PT415Error as err:
+            for _field in in_flight.values():
+                errfile.write("Field "+_field.id+": got error "+str(err)+'.\n')
+            in_flight.clear()
+            reader.clear() # Don't leave late replies for the next fields
+            if deadline is not None and time.monotonic() >= deadline:
+                for _field in to_send:
+                    errfile.write("Field "+_field.id+": not read before the deadline.\n")
+                to_send.clear()
+            continue
+
+        code = PT415DictEntry.echoedCode(pt415_response)
+        if code not in in_flight:
+            if PT415DictEntry.checksumOK(pt415_response):
+                continue # A late reply to a request we already gave up on
+            # Garbled echo, give it to the oldest request and let parseOutput complain
+            code = next(iter(in_flight))
+        # Replies come back in order, so anything sent before this one was lost
+        for lost in list(in_flight):
+            if lost == code:
+                break
+            errfile.write("Field "+in_flight.pop(lost).id+": got no reply.\n")
+        _field = in_flight.pop(code)
+
+        try:
+            # Parse the response and store it in the output dictionary.
+            pt415_status[_field.id] = _field.parseOutput(pt415_response)
+        except PT415Error as err:
+            errfile.write("Field "+_field.id+": got error "+str(err)+
+                             " from response string "+repr(pt415_response)+".\n")
+    return pt415_status
+
+####################################################################
+####################################################################
+class PT415Client():
+    """
+    Owns one long-lived serial connection to the pt415.
+
+    The port is opened on first use and kept open between status reads,
+    instead of being opened and closed for every sweep. Reads and commands
+    are serialized with a lock, so a manual turn_off from another thread
+    waits for the DAQ's status read to finish instead of interleaving with
+    it. After a serial error the port is closed, and it is reopened on the
+    next call.
+
+    Fields with a poll_interval are only read when that much time has passed
+    since their last read; in between read_status reuses the last value.
+    ages() tells how old each value is.
+
+    Use get_client() to share one client per port.
+    """
+    def __init__(self, port=com_port, baudrate=baudrate, timeout=2):
+        self.port = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.connection = None
+        self.lock = threading.RLock()
+
+        # Last good value of each field and when it was read (time.monotonic())
+        self.values = dict()
+        self.read_times = dict()
+
+        # Bookkeeping
+        self.n_connects = 0
+        self.connect_time = 0. # s, total spent opening the port
+
+    def connect(self):
+        with self.lock:
+            if self.connection is None or not self.connection.isOpen():
+                t0 = time.perf_counter()
+                self.connection = open_connection(self.port, self.baudrate, timeout=self.timeout)
+                assert self.connection.isOpen(), "Serial port connection error"
+                self.connect_time += time.perf_counter() - t0
+                self.n_connects += 1
+            return self.connection
+
+    def disconnect(self):
+        with self.lock:
+            if self.connection is not None:
+                try:
+                    self.connection.close()
+                except Exception:
+                    pass
+            self.connection = None
+
+    close = disconnect
+
+    # Run func(connection) with the port open and to ourselves.
+    # Any error closes the port so the next call starts from a fresh one.
+    # With a deadline, gives up (PT415Error -5) if the port doesn't come
+    # free in time.
+    def transaction(self, func, deadline=None):
+        timeout = -1 if deadline is None else max(deadline - time.monotonic(), 0)
+        if not self.lock.acquire(timeout=timeout):
+            raise PT415Error((-5, "Timed out waiting for the port"))
+        try:
+            return func(self.connect())
+        except Exception:
+            self.disconnect()
+            raise
+        finally:
+            self.lock.release()
+
+    # Readable fields that are due for a read (see PT415DictEntry.poll_interval)
+    def due_fields(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        return [name for name in pt415_names
+                if name not in self.read_times or now - self.read_times[name] >= pt415_dict[name].poll_interval]
+
+    def ages(self):
+        """
+        Seconds since each field's value was read from the pt415, inf for
+        fields never read.
+        """
+        now = time.monotonic()
+        return dict([(name, now - self.read_times[name] if name in self.read_times else np.inf)
+                     for name in pt415_names])
+
+    def read_status(self, errfile=sys.stderr, force=False, deadline=None, cancel=None):
+        """
+        Same as readPT415Status_Serial: always returns a dictionary of
+        every readable field, with default values for those that failed.
+
+        Only fields that are due are read from the pt415; the others keep
+        the last value read. force reads every field.
+
+        deadline and cancel are passed on to readValues. Fields not read by
+        the deadline get their default; a cancel raises PT415Error -7.
+        """
+        status = defaultStatus()
+        values = dict()
+        names = pt415_names if force else self.due_fields()
+        try:
+            values = self.transaction(lambda conn: readValues(conn, names, errfile, self.timeout,
+                                                              deadline=deadline, cancel=cancel),
+                                      deadline)
+        except PT415Error as err:
+            if err.args[0][0] == -7:
+                raise
+            errfile.write("Got an unexpected error! "+str(err)+'\n')
+        except Exception as err:
+            errfile.write("Got an unexpected error! "+str(err)+'\n')
+        with self.lock:
+            now = time.monotonic()
+            for name in values:
+                self.read_times[name] = now
+            self.values.update(values)
+            for name in status:
+                if name in values or name not in names:
+                    status[name] = self.values.get(name, status[name])
+        return status
+
+    def read_record(self, record=None, errfile=sys.stderr, force=False, deadline=None, cancel=None):
+        """
+        read_status, into a status_dtype record. Pass record to reuse one.
+        """
+        return fillStatusRecord(self.read_status(errfile, force, deadline, cancel), record)
+
+    def set_value(self, quant, deadline=None, cancel=None):
+        request = pt415_dict[quant].write_request
+        frame_deadline = time.monotonic() + self.timeout
+        if deadline is not None:
+            frame_deadline = min(frame_deadline, deadline)
+        def command(conn):
+            if cancel is not None and cancel.is_set():
+                raise PT415Error((-7, "Cancelled"))
+            conn.reset_input_buffer()
+            conn.write(request)
+            #Make sure to do a read so it flushes out the buffer for the next cmd
+            return SMDPFrameReader(conn).read_frame(deadline=frame_deadline, min_frame=SMDPFrameReader.min_write_frame)
+        return self.transaction(command, deadline)
+
+
+class AsyncPT415Client():
+    """
+    asyncio front end to a PT415Client.
+
+    The serial I/O runs on one dedicated thread, so awaiting a status read
+    leaves the event loop free for the rest of the DAQ.
+    >>> pt415 = pt415_interface.AsyncPT415Client()
+    >>> status = await pt415.read_status(timeout=5)
+    >>> await pt415.set_value('turn_off')
+
+    timeout is a deadline for the whole call, queueing for the port
+    included. Cancelling the awaiting task (or asyncio.wait_for running
+    out) stops the I/O thread at its next request or reply and closes the
+    port, so no stray replies are left for the next call. Errors are the
+    same PT415Error codes as the blocking client.
+    """
+    def __init__(self, client=None, port=com_port, baudrate=baudrate, timeout=None):
+        self.client = get_client(port, baudrate) if client is None else client
+        self.timeout = timeout # Default for calls that don't give one
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='PT415')
+
+    async def _run(self, func, timeout, *args, **kwargs):
+        if timeout is None:
+            timeout = self.timeout
+        cancel = threading.Event()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        loop = asyncio.get_running_loop()
+        call = functools.partial(func, *args, deadline=deadline, cancel=cancel, **kwargs)
+        try:
+            return await loop.run_in_executor(self.executor, call)
+        except asyncio.CancelledError:
+            cancel.set()
+            raise
+
+    async def read_status(self, timeout=None, force=False, errfile=sys.stderr):
+        return await self._run(self.client.read_status, timeout, errfile=errfile, force=force)
+
+    async def status_read_simple(self, timeout=None, errfile=sys.stderr):
+        status = await self.read_status(timeout, errfile=errfile)
+        return [float(status[k]) for k in status.keys()]
+
+    async def status_read_record(self, record=None, timeout=None, errfile=sys.stderr):
+        return await self._run(self.client.read_record, timeout, record, errfile=errfile)
+
+    async def set_value(self, quant, timeout=None):
+        assert quant in pt415_dict.keys(), "Error: Unknown quantity"
+        return await self._run(self.client.set_value, timeout, quant)
+
+    def ages(self):
+        return self.client.ages()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.client.close()
+
+
+# One client per port, shared by the DAQ and manual commands
+_clients = dict()
+_clients_lock = threading.Lock()
+
+def get_client(port=com_port, baudrate=baudrate):
+    with _clients_lock:
+        if port not in _clients:
+            _clients[port] = PT415Client(port, baudrate)
+        client = _clients[port]
+        client.baudrate = baudrate
+        return client
+
+####################################################################
+
+def readPT415Status_Serial(port=com_port, baudrate = baudrate, errfile=sys.stderr, connection=None):
+    """
+    Read out the values of every dictionary entry in the "pt415_fields"
+    variable, through the shared PT415Client for this port.
 
     Always return a dictionary filled with values, no matter what happens.
     If we receive an exception when trying to read from a particular field,
     that field will receive a default entry in the dictionary.
 
+    Fields with a poll_interval that aren't due yet hold their last value
+    (see PT415Client.ages). A given connection always reads every field.
+
     INPUTS
-        ip [moxabox_ip]: (string) The IP address of the Moxa box.
+        port [com_port]: (string) The serial port of the pt415.
 
-        port [pt415_port]: (int) The port of the pt415 on the Moxa box.
+        baudrate [baudrate]: (int) Baud rate of the serial port.
 
         errfile [sys.stderr]: (opened file) Where to send error messages.
 
+        connection [None]: An already open serial connection (e.g. a
+            serial_trace.ReplaySerial) to use instead of the shared client.
+
     OUTPUT
         A dictionary containing the status of the pt415. The same dictionary
         will be returned regardless of any read errors: fields which encounter
         a read error will be filled with a default value.
     """
-    # Create an empty dict in which to store the pt415 status that we'll read out.
-    # Default to every field being zero.
-    pt415_status = dict( [(_field.id, _field.default_value)
-                          for _field in pt415_fields if _field.permission == 'read'] )
-    
-    connection = None
-    try:
-        # Establish a connection to the pt415 via the Moxa box.
-        connection = serial.Serial(port, baudrate, timeout = 2)
-        assert connection.isOpen(), "Serial port connection error"
+    if connection is None:
+        return get_client(port, baudrate).read_status(errfile)
 
-        # Query the pt415 about the value of each field.
-        for _field in pt415_fields:
-            if _field.permission =='read':
-                try:
-                    # Send the inquiry and get a response.
-                    connection.write(_field.getReadRequest())
-                    pt415_response = read_until(connection, '\r', 2)
-    
-                except Exception as err:
-                    errfile.write("Field "+_field.id+": got error "+str(err)+'.\n')
-                    continue
-    
-                try:
-                    # Parse the response and store it in the output dictionary.
-                    pt415_status[_field.id] = _field.parseOutput(pt415_response)
-                except PT415Error as err:
-                    errfile.write("Field "+_field.id+": got error "+str(err)+
-                                     " from response string "+repr(pt415_response)+".\n")
-                    continue
+    try:
+        return readFields(connection, errfile)
     except Exception as err:
         # Don't let an exception crash the function, but do let the
         # user know that something bad happened.
         errfile.write("Got an unexpected error! "+str(err)+'\n')
-    finally:
-        # Make sure to close the socket connection.
-        if connection.isOpen(): connection.close()
-
-    return pt415_status
+        return defaultStatus()
 
 
 def status_read_simple(port=com_port, baudrate = baudrate, errfile=sys.stderr):
@@ -448,6 +975,12 @@ def status_read_simple(port=com_port, baudrate = baudrate, errfile=sys.stderr):
         status_data.append(float(status[k]))
     return status_data
 
+def status_read_record(record=None, port=com_port, baudrate=baudrate, errfile=sys.stderr):
+    """
+    The status as a status_dtype record, filled in place if one is given.
+    """
+    return get_client(port, baudrate).read_record(record, errfile)
+
 #%% Turns pt415 on and off remotely
 # >>> import pt415_interface
 # >>> pt415_status = pt415_interface.readPT415Status_Serial(port=com_port, baudrate = baudrate)
@@ -458,16 +991,8 @@ def performSetValue(quant, port=com_port, baudrate=baudrate, errfile='pt415.log'
     # quant is one of 'turn_on', 'turn_off', 'reset_min_max'
     assert quant in pt415_dict.keys(), "Error: Unknown quantity"
 
-    with serial.Serial(port, baudrate, timeout = 2) as conn:
-        key = quant
-        request = pt415_dict[key].getWriteRequest()
-        # Commented out for pyserial 3.4, which explicitly opens. Should test with 2.7
-        # conn.open()
-        conn.flushInput()
-        conn.write(request)
-
-        #Make sure to do a read so it flushes out the buffer for the next cmd
-        response = read_until(conn, '\r', 2)
+    # Goes through the shared client, so it waits for any status read in progress
+    response = get_client(port, baudrate).set_value(quant)
     with open(errfile, 'a') as f:
         f.write(time.ctime() + ', ' + quant + '\n')
 
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+Base class for instrument emulators that sit on a pseudo-terminal.
+
+The driver side opens the slave end of the pty like any serial port
+(e.g. ASRL/dev/pts/5::INSTR for pyvisa, or /dev/pts/5 for pyserial) and the
+emulator answers on the master end from a background thread. Used by
+SIM900_emulator and pt415_emulator to run the drivers without hardware.
+
+Only works on Linux/macOS (needs the pty module).
+"""
+
+import os
+import pty
+import select
+import threading
+import time
+import tty
+
+
+class PtyEmulator():
+    def __init__(self):
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave) # No echo or line editing
+        self.port_name = os.ttyname(self.slave)
+        self.visa_address = f'ASRL{self.port_name}::INSTR'
+        self.tick_time = 0.001 # s, how often tick() is called when idle
+        self._stop_event = threading.Event()
+        self._write_lock = threading.Lock()
+        self.thread = None
+
+    # Called with every chunk of bytes the driver writes
+    def handle_bytes(self, data):
+        raise NotImplementedError
+
+    # Called regularly, for output that is due at a later time
+    def tick(self, now):
+        return
+
+    def send(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        with self._write_lock:
+            os.write(self.master, data)
+
+    def serve(self):
+        while not self._stop_event.is_set():
+            ready, _, _ = select.select([self.master], [], [], self.tick_time)
+            if ready:
+                try:
+                    data = os.read(self.master, 4096)
+                except OSError: # Slave side closed
+                    data = b''
+                if data:
+                    self.handle_bytes(data)
+            self.tick(time.monotonic())
+
+    def start(self):
+        if self.thread is None or not self.thread.is_alive():
+            self._stop_event.clear()
+            self.thread = threading.Thread(target=self.serve, name=type(self).__name__, daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self):
+        self._stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def close(self):
+        self.stop()
+        os.close(self.master)
+        os.close(self.slave)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+"""
+Record and replay the traffic on our serial connections.
+
+The recorder sits between a driver and its connection (the SIM900
+visa_handle or the PT415 serial.Serial) and logs every write and read with
+a monotonic timestamp to a compact binary file. It is cheap enough to leave
+on all the time, so when something odd happens (read_port giving None, a
+PT415 checksum error, ...) the bytes are there to look at afterwards.
+
+Turn it on for everything by setting ADR_SERIAL_TRACE to a file name before
+the drivers are imported, or by hand:
+>>> rec = serial_trace.TraceRecorder('trace.bin')
+>>> SIM900.start_trace(rec)
+>>> pt415_interface.set_trace(rec)
+
+Replay a trace back into the drivers, as fast as they ask for it:
+>>> events = serial_trace.load_trace('trace.bin')
+>>> conn = serial_trace.ReplaySerial(events, 'PT415')
+>>> pt415_interface.readPT415Status_Serial(connection=conn)
+
+Dump a trace:
+    python serial_trace.py trace.bin
+
+File layout: b'ADRTRACE' and a version byte, then one record per event
+    int64 time [ns, monotonic], uint8 stream id, uint8 kind, uint32 length, data
+A NAME record (kind 0) ties a stream id to a name before its first use.
+"""
+
+import atexit
+import os
+import struct
+import sys
+import threading
+import time
+
+MAGIC = b'ADRTRACE'
+VERSION = 1
+RECORD = struct.Struct('<qBBI')
+
+# Event kinds
+NAME = 0
+WRITE = 1
+READ = 2
+ERROR = 3 # Exception text from a read or write (e.g. a timeout)
+KIND_NAMES = {NAME:'name', WRITE:'write', READ:'read', ERROR:'error'}
+
+
+####################################################################
+class TraceMismatch(Exception):
+    """
+    A replayed driver did something different from the recording.
+    """
+    def __init__(self, *args, **kwds):
+        super(TraceMismatch,self).__init__(*args, **kwds)
+
+
+class TraceRecorder():
+    def __init__(self, path, buffer_size=1<<16):
+        self.path = path
+        self.file = open(path, 'wb', buffering=buffer_size)
+        self.file.write(MAGIC + bytes([VERSION]))
+        self.lock = threading.Lock()
+        self.streams = dict() # name: id
+        atexit.register(self.close)
+
+    def stream_id(self, name):
+        with self.lock:
+            if name not in self.streams:
+                self.streams[name] = len(self.streams)
+                data = name.encode()
+                self.file.write(RECORD.pack(time.monotonic_ns(), self.streams[name], NAME, len(data)) + data)
+            return self.streams[name]
+
+    def record(self, stream, kind, data):
+        t = time.monotonic_ns()
+        with self.lock:
+            if not self.file.closed:
+                self.file.write(RECORD.pack(t, stream, kind, len(data)))
+                self.file.write(data)
+
+    def flush(self):
+        with self.lock:
+            if not self.file.closed:
+                self.file.flush()
+
+    def close(self):
+        with self.lock:
+            if not self.file.closed:
+                self.file.close()
+
+
+_default_recorder = None
+
+def default_recorder():
+    """
+    The process wide recorder if ADR_SERIAL_TRACE is set, otherwise None.
+    """
+    global _default_recorder
+    path = os.environ.get('ADR_SERIAL_TRACE')
+    if path and _default_recorder is None:
+        _default_recorder = TraceRecorder(path)
+    return _default_recorder
+
+
+####################################################################
+# Wrappers that record, everything else is passed through to the connection
+
+class TracedVisaHandle():
+    def __init__(self, handle, recorder, name):
+        object.__setattr__(self, 'handle', handle)
+        object.__setattr__(self, 'recorder', recorder)
+        object.__setattr__(self, 'stream', recorder.stream_id(name))
+
+    def __getattr__(self, attr):
+        return getattr(self.handle, attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self.handle, attr, value)
+
+    def _call(self, func, *args):
+        try:
+            return func(*args)
+        except Exception as err:
+            self.recorder.record(self.stream, ERROR, repr(err).encode())
+            raise
+
+    def write(self, message, *args, **kwargs):
+        term = kwargs.get('termination', self.handle.write_termination) or ''
+        self.recorder.record(self.stream, WRITE, (message + term).encode())
+        return self._call(self.handle.write, message, *args)
+
+    def read(self, *args, **kwargs):
+        msg = self._call(self.handle.read, *args)
+        self.recorder.record(self.stream, READ, (msg + (self.handle.read_termination or '')).encode())
+        return msg
+
+    def read_bytes(self, count, *args, **kwargs):
+        data = self._call(self.handle.read_bytes, count)
+        self.recorder.record(self.stream, READ, bytes(data))
+        return data
+
+    def read_raw(self, *args, **kwargs):
+        data = self._call(self.handle.read_raw, *args)
+        self.recorder.record(self.stream, READ, bytes(data))
+        return data
+
+    def query(self, message, *args, **kwargs):
+        self.write(message)
+        return self.read()
+
+
+class TracedSerial():
+    def __init__(self, ser, recorder, name):
+        object.__setattr__(self, 'ser', ser)
+        object.__setattr__(self, 'recorder', recorder)
+        object.__setattr__(self, 'stream', recorder.stream_id(name))
+
+    def __getattr__(self, attr):
+        return getattr(self.ser, attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self.ser, attr, value)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.ser.close()
+
+    def write(self, data):
+        self.recorder.record(self.stream, WRITE, bytes(data))
+        return self.ser.write(data)
+
+    def read(self, size=1):
+        try:
+            data = self.ser.read(size)
+        except Exception as err:
+            self.recorder.record(self.stream, ERROR, repr(err).encode())
+            raise
+        if data:
+            self.recorder.record(self.stream, READ, bytes(data))
+        return data
+
+
+####################################################################
+def load_trace(path):
+    """
+    Returns
+    -------
+    list of (time [s], stream name, kind, data) in recorded order
+
+    """
+    with open(path, 'rb') as f:
+        raw = f.read()
+    if raw[:len(MAGIC)] != MAGIC:
+        raise ValueError(f"{path} is not a serial trace")
+    pos = len(MAGIC) + 1
+    names = dict()
+    events = []
+    while pos + RECORD.size <= len(raw):
+        t, stream, kind, n = RECORD.unpack_from(raw, pos)
+        pos += RECORD.size
+        data = raw[pos:pos+n]
+        pos += n
+        if kind == NAME:
+            names[stream] = data.decode()
+        else:
+            events.append((t*1e-9, names.get(stream, str(stream)), kind, data))
+    return events
+
+
+class ReplaySerial():
+    """
+    Stands in for serial.Serial and plays back one stream of a trace.
+
+    Reads are served from the bytes recorded as read before the next
+    recorded write, so a driver that reads in different sized chunks
+    still gets the same bytes. With check_writes, every write must match
+    the recording or TraceMismatch is raised.
+    """
+    def __init__(self, events, name, check_writes=True):
+        self.events = [(kind, data) for t, stream, kind, data in events if stream == name]
+        self.idx = 0
+        self.pending = bytearray() # Read bytes available before the next write
+        self.check_writes = check_writes
+        self.timeout = None
+        self._fill()
+
+    # Move read data up to the next write into pending
+    def _fill(self):
+        while self.idx < len(self.events) and self.events[self.idx][0] != WRITE:
+            kind, data = self.events[self.idx]
+            if kind == READ:
+                self.pending += data
+            self.idx += 1
+
+    def write(self, data):
+        if self.idx >= len(self.events):
+            raise TraceMismatch(f"Write past the end of the trace: {bytes(data)!r}")
+        kind, recorded = self.events[self.idx]
+        if self.check_writes and bytes(data) != recorded:
+            raise TraceMismatch(f"Wrote {bytes(data)!r}, trace has {recorded!r}")
+        self.idx += 1
+        self._fill()
+        return len(data)
+
+    def read(self, size=1):
+        data = bytes(self.pending[:size])
+        del self.pending[:size]
+        return data
+
+    @property
+    def in_waiting(self):
+        return len(self.pending)
+
+    def isOpen(self):
+        return True
+
+    is_open = property(isOpen)
+
+    def reset_input_buffer(self):
+        self.pending.clear()
+
+    flushInput = reset_input_buffer
+
+    def close(self):
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return
+
+
+class ReplayVisaHandle(ReplaySerial):
+    """
+    Stands in for a pyvisa resource (e.g. SIM900.visa_handle).
+    Messages are str and terminated like the recording.
+    """
+    def __init__(self, events, name, check_writes=True, write_termination='\n', read_termination='\n'):
+        super().__init__(events, name, check_writes)
+        self.write_termination = write_termination
+        self.read_termination = read_termination
+        self.timeout = 2000
+
+    def write(self, message, termination=None):
+        term = self.write_termination if termination is None else termination
+        return super().write((message + (term or '')).encode())
+
+    def read(self, termination=None):
+        term = (self.read_termination if termination is None else termination).encode()
+        idx = self.pending.find(term)
+        if idx < 0:
+            raise TraceMismatch(f"Read with no terminated reply left in the trace ({bytes(self.pending)!r})")
+        msg = bytes(self.pending[:idx])
+        del self.pending[:idx+len(term)]
+        return msg.decode()
+
+    def read_bytes(self, count, *args, **kwargs):
+        return ReplaySerial.read(self, count)
+
+    def read_raw(self, *args, **kwargs):
+        data = bytes(self.pending)
+        self.pending.clear()
+        return data
+
+    def query(self, message):
+        self.write(message)
+        return self.read()
+
+    @property
+    def bytes_in_buffer(self):
+        return len(self.pending)
+
+
+if __name__ == '__main__':
+    events = load_trace(sys.argv[1])
+    t0 = events[0][0] if events else 0
+    for t, stream, kind, data in events:
+        print(f'{(t-t0)*1000:12.3f} ms  {stream:8s} {KIND_NAMES[kind]:5s} {data!r}')
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+Round trip tests of the SMDP codec in pt415_interface: byte stuffing,
+checksums, reply frames through parseOutput and decodeFrames.
+
+    python -m pytest -q test_pt415_codec.py
+
+The property tests need hypothesis (pip install hypothesis).
+"""
+
+import struct
+
+import numpy as np
+import pytest
+
+hypothesis = pytest.importorskip('hypothesis')
+from hypothesis import given, settings, strategies as st
+
+import pt415_interface
+from pt415_interface import PT415DictEntry, PT415Error, pt415_bytes
+
+read_fields = [_field for _field in pt415_interface.pt415_fields if _field.permission == 'read']
+RESERVED = [0x02, 0x07, 0x0D]
+
+# Bytes that are mostly the reserved ones and the escape codes, so stuffing
+# edge cases come up all the time
+smdp_bytes = st.binary() | st.lists(st.sampled_from(RESERVED + [0x30, 0x31, 0x32, 0xFF])).map(bytes)
+raw_values = st.integers(-2**31, 2**31 - 1) | st.builds(
+    lambda b: struct.unpack('>l', bytes(b))[0],
+    st.lists(st.sampled_from(RESERVED + [0x30, 0x32, 0xFF]), min_size=4, max_size=4))
+fields = st.sampled_from(read_fields)
+
+
+# Reply frame the pt415 sends for a read of _field with data word raw
+def reply_frame(_field, raw, cmd=pt415_bytes['CMD_OK']):
+    body = (bytearray([pt415_bytes['PT415_ADDR'], cmd, pt415_bytes['DATA_READ']]) +
+            bytearray(_field.code) + struct.pack('>l', raw))
+    return (bytearray([pt415_bytes['STX']]) + PT415DictEntry.stuffEscapeChars(body) +
+            PT415DictEntry.getChecksumBytes(body) + bytearray([pt415_bytes['CR']]))
+
+
+def expected_value(_field, raw):
+    return _field.data_type(_field.increment*_field.data_type(raw))
+
+
+def parse_error(_field, frame):
+    with pytest.raises(PT415Error) as err:
+        _field.parseOutput(frame)
+    return err.value.args[0][0]
+
+
+# Byte stuffing
+
+@pytest.mark.parametrize('raw, stuffed', [
+    (b'\x02', b'\x07\x30'),
+    (b'\x0D', b'\x07\x31'),
+    (b'\x07', b'\x07\x32'),
+    (b'\x07\x30', b'\x07\x32\x30'), # A literal escape code isn't a 0x02
+    (b'\x02\x0D\x07', b'\x07\x30\x07\x31\x07\x32'),
+    (b'', b''),
+])
+def test_stuff_examples(raw, stuffed):
+    assert PT415DictEntry.stuffEscapeChars(raw) == stuffed
+    assert PT415DictEntry.destuffEscapeChars(stuffed) == raw
+
+
+@given(smdp_bytes)
+def test_stuff_round_trip(raw):
+    stuffed = PT415DictEntry.stuffEscapeChars(raw)
+    assert PT415DictEntry.destuffEscapeChars(stuffed) == raw
+    # No frame delimiters left, and every escape is followed by its code
+    assert 0x02 not in stuffed and 0x0D not in stuffed
+    for i in np.nonzero(np.frombuffer(bytes(stuffed), dtype=np.uint8) == 0x07)[0]:
+        assert stuffed[i + 1] in (0x30, 0x31, 0x32)
+    assert len(stuffed) == len(raw) + sum([raw.count(b) for b in RESERVED])
+
+
+# Checksums
+
+@pytest.mark.parametrize('body, check', [
+    (b'', b'00'),
+    (b'\x01', b'01'),
+    (b'\x0F', b'0?'), # Nibbles go to 0x30-0x3F, not hex digits
+    (b'\xFF', b'??'),
+    (b'\xFF\x01', b'00'), # Only the low byte of the sum counts
+    (b'\x10\x89\x63', b'?<'),
+])
+def test_checksum_examples(body, check):
+    assert PT415DictEntry.getChecksumBytes(body) == check
+
+
+@given(st.binary())
+def test_checksum_is_low_byte_of_sum(body):
+    check = PT415DictEntry.getChecksumBytes(body)
+    assert len(check) == 2 and all([0x30 <= c <= 0x3F for c in check])
+    assert ((check[0] - 0x30) << 4) + (check[1] - 0x30) == sum(body) & 0xFF
+
+
+# Reply frames
+
+@given(fields, raw_values)
+def test_frame_round_trip(_field, raw):
+    frame = reply_frame(_field, raw)
+    assert PT415DictEntry.checksumOK(frame)
+    assert PT415DictEntry.echoedCode(frame) == tuple(_field.code)
+    assert _field.parseOutput(frame) == expected_value(_field, raw)
+
+
+# Data words whose last byte is reserved put an escape right before the
+# check bytes
+@pytest.mark.parametrize('raw', [0x00000002, 0x00000007, 0x0000000D, 0x07070707, 0x0D0D0D0D, -1])
+def test_escape_before_checksum(raw):
+    for _field in read_fields:
+        assert _field.parseOutput(reply_frame(_field, raw)) == expected_value(_field, raw)
+
+
+@given(fields, raw_values, st.data())
+def test_bad_checksum(_field, raw, data):
+    frame = reply_frame(_field, raw)
+    i = data.draw(st.sampled_from([-3, -2]))
+    frame[i] = data.draw(st.integers(0x30, 0x3F).filter(lambda b: b != frame[i]))
+    assert not PT415DictEntry.checksumOK(frame)
+    assert parse_error(_field, frame) == -4
+
+
+# A reserved command byte would be stuffed, which parseOutput sees as a
+# malformed frame before it gets to the command byte
+@given(fields, raw_values, st.integers(0, 255).filter(lambda b: b != pt415_bytes['CMD_OK'] and b not in RESERVED))
+def test_command_error(_field, raw, cmd):
+    assert parse_error(_field, reply_frame(_field, raw, cmd)) == cmd & 0x07
+
+
+@given(fields, fields, raw_values)
+def test_other_field(_field, other, raw):
+    hypothesis.assume(tuple(other.code) != tuple(_field.code))
+    assert parse_error(_field, reply_frame(other, raw)) == -3
+
+
+@pytest.mark.parametrize('frame', [b'', b'\x02', b'\x02\x10\x89\x0D', b'\x0D\x10\x89\x63\x0D'])
+def test_not_a_frame(frame):
+    assert parse_error(read_fields[0], bytearray(frame)) == -1
+
+
+# decodeFrames against parseOutput
+
+damage = st.sampled_from(['none', 'flip', 'lose', 'escape', 'cut'])
+
+
+@settings(max_examples=200)
+@given(st.lists(st.tuples(fields, raw_values, damage, st.integers(0, 2**16), st.integers(0, 255)),
+                max_size=50))
+def test_decode_frames_matches_parse_output(cases):
+    frames, field_list = [], []
+    for _field, raw, kind, where, byte in cases:
+        frame = reply_frame(_field, raw)
+        i = where % len(frame)
+        if kind == 'flip':
+            frame[i] = byte
+        elif kind == 'lose':
+            del frame[i]
+        elif kind == 'escape':
+            frame.insert(i, 0x07)
+        elif kind == 'cut':
+            frame = frame[:i]
+        frames.append(frame)
+        field_list.append(_field)
+    decoded = pt415_interface.decodeFrames(frames, field_list)
+    assert len(decoded) == len(frames)
+    for _field, frame, row in zip(field_list, frames, decoded):
+        value, ok, error = pt415_interface._parseFrame(_field, frame)
+        assert (ok, error) == (row['ok'], row['error'])
+        if ok:
+            assert np.float64(value).tobytes() == row['value'].tobytes()